@@ -0,0 +1,114 @@
+"""
+Measure how fast snapshots are cloned, compared to `cp --archive --link`.
+
+A tree of empty files is made, then cloned with `cp` and with
+`clone_tree()` using different numbers of jobs.
+Each clone is checked against the clone made by `cp`, then deleted.
+The tree should be made on the storage that backups are kept on,
+as the benefit of cloning many directories at once depends on the storage.
+
+Usage:
+
+    $ PYTHONPATH=src python benchmarks/clone.py --entries 1000000 --path /mnt/backups/tmp
+"""
+import argparse
+import errno
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+
+from ryba.targets import _helper
+
+
+def make_tree(path: pathlib.Path, *, entries: int, width: int) -> None:
+    """
+    Make a tree with about `entries` files and directories.
+    Each directory holds `width` files and up to `width` subdirectories.
+    """
+    path.mkdir()
+    directories = [path]
+    made = 0
+    while made < entries:
+        directory = directories.pop(0)
+        for index in range(width):
+            os.close(os.open(directory / f'file-{index}', os.O_CREAT | os.O_WRONLY, 0o644))
+        subdirectories = [directory / f'dir-{index}' for index in range(width)]
+        for subdirectory in subdirectories:
+            subdirectory.mkdir()
+        directories.extend(subdirectories)
+        made += width * 2
+
+
+def drop_caches() -> None:
+    """Empty the page, dentry, and inode caches so every run starts cold. Needs root."""
+    os.sync()
+    pathlib.Path('/proc/sys/vm/drop_caches').write_text('3\n')
+
+
+def listing(path: pathlib.Path) -> t.List[str]:
+    """Everything that should be the same in two clones. Files must be links to the same inode."""
+    output = subprocess.check_output([
+        'find', '.',
+        '-type', 'd', '-printf', '%p %M %U %G %T@ directory\\n',
+        '-o', '-printf', '%p %M %U %G %T@ %i\\n',
+    ], cwd=path)
+    return sorted(output.decode().splitlines())
+
+
+def run(name: str, function: t.Callable[[], t.Any], *, cold: bool) -> float:
+    if cold:
+        drop_caches()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    print(f"  {name:<20} {seconds:>8.2f}s")
+    return seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--entries', type=int, default=1_000_000, help="How many entries in the tree")
+    parser.add_argument('--width', type=int, default=20, help="How many entries in each directory")
+    parser.add_argument(
+        '--jobs', type=int, nargs='+', default=[1, 4, 16, 64],
+        help="How many directories to clone at once")
+    parser.add_argument(
+        '--path', type=pathlib.Path, default=None,
+        help="Where to make the tree. Defaults to the temporary directory")
+    parser.add_argument(
+        '--cold', action='store_true',
+        help="Drop the file system caches before each run. Needs root")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='ryba-benchmark-', dir=arguments.path) as temporary_directory:
+        root = pathlib.Path(temporary_directory)
+        source = root / 'current'
+        print(f"Making a tree with {arguments.entries} entries")
+        make_tree(source, entries=arguments.entries, width=arguments.width)
+
+        print("Cloning")
+        expected = root / 'cp'
+        run('cp --archive --link', lambda: subprocess.check_call(
+            ['cp', '--archive', '--link', str(source), str(expected)]), cold=arguments.cold)
+        expected_listing = listing(expected)
+        shutil.rmtree(expected)
+
+        for jobs in arguments.jobs:
+            clone = root / f'clone-{jobs}'
+            run(f'clone_tree, {jobs} jobs', lambda: _helper.clone_tree(
+                str(source), str(clone), jobs), cold=arguments.cold)
+            if listing(clone) != expected_listing:
+                print(f"    The clone with {jobs} jobs does not match the clone made by cp")
+            shutil.rmtree(clone)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(errno.EINTR)
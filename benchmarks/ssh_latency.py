@@ -0,0 +1,446 @@
+"""
+Measure how the SSH target performs over slow connections.
+
+An SSH server stand-in is started on localhost,
+behind a proxy that adds latency and limits bandwidth.
+Each target operation is then timed for a number of round trip times,
+counting the round trips each operation needs.
+
+Usage:
+
+    $ PYTHONPATH=src python benchmarks/ssh_latency.py --rtt 10 50 200
+
+The full backup phase needs rsync to be installed, and is skipped otherwise.
+"""
+import argparse
+import contextlib
+import datetime
+import errno
+import functools
+import getpass
+import os
+import pathlib
+import queue
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing as t
+
+import attr
+import paramiko
+import spur
+import spur.ssh
+
+from ryba import config, directories, logging, rotators, targets, units
+from ryba.commands import backup, rotate, snapshot
+
+# SSH server stand-in
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self) -> t.Union[paramiko.SFTPAttributes, int]:
+        f = getattr(self, 'readfile', None) or getattr(self, 'writefile')
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(f.fileno()))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    """Serve the local file system over SFTP."""
+
+    def list_folder(self, path: str) -> t.Union[t.List[paramiko.SFTPAttributes], int]:
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), filename=name)
+                for name in os.listdir(path)
+            ]
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    def stat(self, path: str) -> t.Union[paramiko.SFTPAttributes, int]:
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    def lstat(self, path: str) -> t.Union[paramiko.SFTPAttributes, int]:
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    def open(self, path: str, flags: int, attr: paramiko.SFTPAttributes) -> t.Union[paramiko.SFTPHandle, int]:
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _SFTPHandle(flags)
+        f = os.fdopen(fd, mode)
+        if 'r' in mode or '+' in mode:
+            handle.readfile = f
+        if 'r' not in mode or '+' in mode:
+            handle.writefile = f
+        return handle
+
+    def remove(self, path: str) -> int:
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath: str, newpath: str) -> int:
+        return self._call(os.rename, oldpath, newpath)
+
+    def mkdir(self, path: str, attr: paramiko.SFTPAttributes) -> int:
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path: str) -> int:
+        return self._call(os.rmdir, path)
+
+    def _call(self, function: t.Callable[..., None], *args: str) -> int:
+        try:
+            function(*args)
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        return paramiko.SFTP_OK
+
+
+def _run_command(channel: paramiko.Channel, command: str) -> None:
+    """Run a command locally, connecting its standard streams to the channel."""
+    process = subprocess.Popen(
+        command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.stdin is not None and process.stdout is not None and process.stderr is not None
+
+    def pump_stdin() -> None:
+        assert process.stdin is not None
+        with contextlib.suppress(OSError):
+            while data := channel.recv(1 << 16):
+                process.stdin.write(data)
+                process.stdin.flush()
+        with contextlib.suppress(OSError):
+            process.stdin.close()
+
+    def pump_stderr() -> None:
+        assert process.stderr is not None
+        while data := os.read(process.stderr.fileno(), 1 << 16):
+            channel.sendall_stderr(data)
+
+    threading.Thread(target=pump_stdin, daemon=True).start()
+    stderr_thread = threading.Thread(target=pump_stderr, daemon=True)
+    stderr_thread.start()
+    while data := os.read(process.stdout.fileno(), 1 << 16):
+        channel.sendall(data)
+    stderr_thread.join()
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    """Accepts any public key, and runs commands as the current user."""
+
+    def get_allowed_auths(self, username: str) -> str:
+        return 'publickey'
+
+    def check_auth_publickey(self, username: str, key: paramiko.PKey) -> int:
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command: bytes) -> bool:
+        threading.Thread(target=_run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+class StandInServer:
+    """An SSH server on localhost that runs commands and serves SFTP."""
+
+    def __init__(self) -> None:
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self) -> None:
+        while True:
+            connection, _ = self.listener.accept()
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPInterface)
+            transport.start_server(server=_ServerInterface())
+
+
+# Latency injection
+
+
+class LatencyProxy:
+    """
+    Forwards connections to `upstream_port`,
+    delaying data by half the round trip time in each direction
+    and limiting the bandwidth in each direction.
+
+    A round trip is counted each time the client sends data
+    after it has received data from the server.
+    """
+
+    def __init__(self, upstream_port: int, *, rtt: float, bandwidth: t.Optional[int]):
+        self.upstream_port = upstream_port
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._last_direction = 'down'
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self) -> None:
+        while True:
+            client, _ = self.listener.accept()
+            upstream = socket.create_connection(('127.0.0.1', self.upstream_port))
+            for sock in [client, upstream]:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._pipe(client, upstream, 'up')
+            self._pipe(upstream, client, 'down')
+
+    def _pipe(self, source: socket.socket, destination: socket.socket, direction: str) -> None:
+        delay = self.rtt / 2
+        chunks: 'queue.Queue[t.Tuple[float, bytes]]' = queue.Queue()
+
+        def read() -> None:
+            while True:
+                try:
+                    data = source.recv(1 << 16)
+                except OSError:
+                    data = b''
+                self._count(direction, len(data))
+                chunks.put((time.monotonic() + delay, data))
+                if not data:
+                    return
+
+        def write() -> None:
+            # Data can not be sent before this time, due to the bandwidth limit
+            free_at = 0.0
+            while True:
+                due, data = chunks.get()
+                time.sleep(max(0, due - time.monotonic(), free_at - time.monotonic()))
+                if not data:
+                    with contextlib.suppress(OSError):
+                        destination.shutdown(socket.SHUT_WR)
+                    return
+                with contextlib.suppress(OSError):
+                    destination.sendall(data)
+                if self.bandwidth:
+                    free_at = max(free_at, time.monotonic()) + len(data) / self.bandwidth
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def _count(self, direction: str, size: int) -> None:
+        if not size:
+            return
+        with self._lock:
+            if direction == 'up':
+                self.bytes_sent += size
+                if self._last_direction == 'down':
+                    self.round_trips += 1
+            else:
+                self.bytes_received += size
+            self._last_direction = direction
+
+    def counters(self) -> t.Tuple[int, int, int]:
+        with self._lock:
+            return self.round_trips, self.bytes_sent, self.bytes_received
+
+
+# ryba targets that connect to the stand-in
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class BenchmarkSSH(targets.SSH):
+    key_file: pathlib.Path
+
+    def connect(self) -> 'BenchmarkSSHContext':
+        return BenchmarkSSHContext(target=self)
+
+    def rsync_arguments(self, destination: pathlib.Path) -> t.Tuple[str, t.List[str]]:
+        target_str, _ = super().rsync_arguments(destination)
+        ssh = [
+            'ssh', '-p', str(self.port), '-i', str(self.key_file),
+            '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=ERROR',
+        ]
+        return target_str, ['-e', shlex.join(ssh)]
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class BenchmarkSSHContext(targets.SSHContext):
+    target: BenchmarkSSH
+
+    @functools.cached_property
+    def client(self) -> spur.SshShell:
+        return spur.SshShell(
+            hostname=self.target.hostname, port=self.target.port, username=self.target.username,
+            private_key_file=str(self.target.key_file), look_for_private_keys=False,
+            missing_host_key=spur.ssh.MissingHostKey.accept)
+
+
+# The benchmark
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Result:
+    phase: str
+    round_trips: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    seconds: float = 0
+    skipped: t.Optional[str] = None
+
+
+def make_tree(path: pathlib.Path, *, files: int) -> None:
+    for index in range(files):
+        file_path = path / f'dir-{index % 10}' / f'file-{index}'
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_bytes(os.urandom(1024))
+
+
+def make_snapshots(target_path: pathlib.Path, *, count: int, files: int) -> None:
+    current = target_path / 'current'
+    make_tree(current, files=files)
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    for index in range(count):
+        timestamp = start + datetime.timedelta(days=index)
+        snapshot_path = target_path / timestamp.strftime("snapshot-%Y-%m-%dT%H:%M:%S")
+        subprocess.check_call(['cp', '-al', str(current), str(snapshot_path)])
+        (snapshot_path / '.backup-timestamp').write_text(timestamp.isoformat())
+
+
+def run_benchmark(
+    *,
+    rtt: float,
+    bandwidth: t.Optional[int],
+    agent: bool,
+    snapshots: int,
+    files: int,
+    server: StandInServer,
+    key_file: pathlib.Path,
+) -> t.List[Result]:
+    proxy = LatencyProxy(server.port, rtt=rtt, bandwidth=bandwidth)
+    results: t.List[Result] = []
+
+    @contextlib.contextmanager
+    def phase(name: str) -> t.Iterator[None]:
+        before = proxy.counters()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        after = proxy.counters()
+        results.append(Result(
+            phase=name, seconds=seconds,
+            round_trips=after[0] - before[0],
+            bytes_sent=after[1] - before[1],
+            bytes_received=after[2] - before[2]))
+
+    with tempfile.TemporaryDirectory(prefix='ryba-benchmark-') as temporary_directory:
+        root = pathlib.Path(temporary_directory)
+        make_tree(root / 'source', files=files)
+        make_snapshots(root / 'target' / 'backup', count=snapshots, files=files)
+
+        target = BenchmarkSSH(
+            name='benchmark', hostname='127.0.0.1', port=proxy.port, username=getpass.getuser(),
+            path=root / 'target', agent=agent, key_file=key_file)
+        directory = directories.Directory(
+            source_path=root / 'source', target_path=pathlib.Path('backup'), target=target,
+            rotate=rotators.KeepLatest(name='benchmark', count=snapshots))
+        benchmark_config = config.Config.defaults()
+        benchmark_config.set(logging.Verbosity, logging.Verbosity.silent)
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+        context = target.connect()
+        with phase('connect'):
+            context.__enter__()
+            _ = context.agent
+        try:
+            with phase('list_backups'):
+                list(context.list_backups(directory.target_path))
+
+            if shutil.which('rsync'):
+                with phase('send files'):
+                    backup._send_files(directory, context, config=benchmark_config, dry_run=False)
+            else:
+                results.append(Result(phase='send files', skipped='rsync is not installed'))
+
+            with phase('create_snapshot'):
+                snapshot.create_snapshot(directory, context, timestamp=timestamp, dry_run=False)
+
+            with phase('rotate'):
+                rotate.rotate_directory(directory, context, timestamp=timestamp)
+        finally:
+            context.__exit__(None, None, None)
+    return results
+
+
+def print_results(title: str, results: t.List[Result]) -> None:
+    print(title)
+    print(f"  {'phase':<16} {'round trips':>11} {'sent':>10} {'received':>10} {'time':>9}")
+    for result in results:
+        if result.skipped is not None:
+            print(f"  {result.phase:<16} skipped: {result.skipped}")
+            continue
+        print(
+            f"  {result.phase:<16} {result.round_trips:>11} "
+            f"{units.format_size(result.bytes_sent):>10} "
+            f"{units.format_size(result.bytes_received):>10} "
+            f"{result.seconds:>8.2f}s")
+    print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--rtt', type=float, nargs='+', default=[10, 50, 200],
+        help="Round trip times to measure, in milliseconds")
+    parser.add_argument(
+        '--bandwidth', type=units.parse_size, default=None,
+        help="Bandwidth in each direction, in bytes per second, such as '10MB'")
+    parser.add_argument('--snapshots', type=int, default=30, help="How many snapshots to start with")
+    parser.add_argument('--files', type=int, default=200, help="How many files in each snapshot")
+    parser.add_argument(
+        '--agent', choices=['on', 'off', 'both'], default='both',
+        help="Whether to use the ryba agent on the target")
+    arguments = parser.parse_args()
+
+    server = StandInServer()
+    with tempfile.TemporaryDirectory(prefix='ryba-benchmark-key-') as key_directory:
+        key_file = pathlib.Path(key_directory) / 'id_rsa'
+        paramiko.RSAKey.generate(2048).write_private_key_file(str(key_file))
+
+        agent_settings = {'on': [True], 'off': [False], 'both': [False, True]}[arguments.agent]
+        for rtt in arguments.rtt:
+            for agent in agent_settings:
+                results = run_benchmark(
+                    rtt=rtt / 1000, bandwidth=arguments.bandwidth, agent=agent,
+                    snapshots=arguments.snapshots, files=arguments.files,
+                    server=server, key_file=key_file)
+                print_results(f"RTT {rtt:g} ms, agent {'on' if agent else 'off'}", results)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(errno.EINTR)
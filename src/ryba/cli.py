@@ -5,13 +5,17 @@ import argparse
 import contextlib
 import datetime
 import pathlib
+import shlex
 import sys
 import typing as t
 
 import iso8601
 
-from . import config, directories, exceptions, logging, rotators, targets
-from .commands import backup, rotate
+from . import (
+    config, directories, exceptions, governor, history, instrumentation,
+    logging, processes, rotators, targets, units)
+from .commands import (
+    backup, daemon, export, log, restore, rotate, stats, verify)
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +32,28 @@ def main() -> None:
         config.set(logging.Verbosity, verbosity)
 
         logging.setup_logging(config)
-        arguments.func(config, arguments)
+
+        backup_history = history.History(
+            history.get_default_history_path(), command=shlex.join(sys.argv[1:]))
+        config.set(history.History, backup_history)
+        operations = instrumentation.Operations()
+        config.set(instrumentation.Operations, operations)
+        process_stats = instrumentation.Processes()
+        config.set(instrumentation.Processes, process_stats)
+        processes.set_recorder(process_stats.record)
+        try:
+            with governor.Governor.from_config(config).running():
+                arguments.func(config, arguments)
+        finally:
+            backup_history.close()
+            if verbosity >= logging.Verbosity.some:
+                process_stats.log_summary()
+            if verbosity >= logging.Verbosity.all:
+                operations.log_summary()
+            if arguments.operation_stats is not None:
+                operations.write(arguments.operation_stats)
+            if arguments.process_stats is not None:
+                process_stats.write(arguments.process_stats)
 
 
 @contextlib.contextmanager
@@ -69,6 +94,22 @@ def _get_argparse_parser() -> argparse.ArgumentParser:
         action="store_const", const=0,
     )
     parser.set_defaults(verbosity=None)
+    parser.add_argument(
+        "--operation-stats", dest="operation_stats", metavar="FILE",
+        help=(
+            "Write statistics about every operation made on the targets to this file, as JSON. "
+            "These statistics are also printed at the end of the run when using -vv."
+        ),
+        type=pathlib.Path, default=None,
+    )
+    parser.add_argument(
+        "--process-stats", dest="process_stats", metavar="FILE",
+        help=(
+            "Write the time, CPU, memory, and disk I/O used by every process ryba runs "
+            "to this file, as JSON. A summary is also printed at the end of the run when using -v."
+        ),
+        type=pathlib.Path, default=None,
+    )
     parser.set_defaults(func=cmd_default)
 
     subparsers = parser.add_subparsers(title="Commands")
@@ -103,6 +144,195 @@ def _get_argparse_parser() -> argparse.ArgumentParser:
     )
     backup.set_defaults(func=cmd_backup)
 
+    verify = subparsers.add_parser(
+        "verify",
+        description=(
+            "Checksum the contents of the snapshots on the targets, "
+            "and report any files that have been damaged "
+            "or that differ from the source"
+        ))
+    verify.add_argument(
+        "-d", "--directory", dest="directories", metavar="DIRECTORY",
+        help=(
+            "Verify a specific directory. Can be used multiple times to "
+            "verify multiple directories. Directories must be defined in the "
+            "config."
+        ),
+        type=pathlib.Path, action="append",
+    )
+    verify.add_argument(
+        "-s", "--snapshot", dest="snapshots", metavar="NAME",
+        help=(
+            "Verify a specific snapshot. Can be used multiple times. "
+            "Defaults to all snapshots and the current backup."
+        ),
+        action="append",
+    )
+    verify.add_argument(
+        "-j", "--jobs", dest="jobs",
+        help="How many checksum commands to run at once.",
+        type=int, default=4,
+    )
+    verify_mode = verify.add_mutually_exclusive_group()
+    verify_mode.add_argument(
+        "--sample", dest="sample", metavar="PERCENT",
+        help=(
+            "Files that have not changed since they were last checksummed are skipped. "
+            "Checksum a random sample of this percentage of their data as well."
+        ),
+        type=float,
+    )
+    verify_mode.add_argument(
+        "--full", dest="full",
+        help="Checksum every file, even those that have been checksummed before.",
+        action="store_true", default=False,
+    )
+    verify.set_defaults(func=cmd_verify)
+
+    daemon = subparsers.add_parser(
+        "daemon",
+        description=(
+            "Run continuously, backing up each directory whenever it is due "
+            "according to its configured cadence"
+        ))
+    daemon.add_argument(
+        "-d", "--directory", dest="directories", metavar="DIRECTORY",
+        help=(
+            "Only back up a specific directory. Can be used multiple times. "
+            "Directories must be defined in the config."
+        ),
+        type=pathlib.Path, action="append",
+    )
+    daemon.add_argument(
+        "-j", "--jobs", dest="jobs",
+        help="How many directories to back up at once. Defaults to the `daemon.jobs` config setting.",
+        type=int, default=None,
+    )
+    daemon.set_defaults(func=cmd_daemon)
+
+    stats = subparsers.add_parser(
+        "stats",
+        description="Show statistics and trends from previous backups")
+    stats.add_argument(
+        "-d", "--directory", dest="directories", metavar="DIRECTORY",
+        help=(
+            "Show statistics for a specific directory. Can be used multiple times. "
+            "Directories must be defined in the config."
+        ),
+        type=pathlib.Path, action="append",
+    )
+    stats.add_argument(
+        "-l", "--limit", dest="limit",
+        help="How many of the most recent runs to include.",
+        type=int, default=50,
+    )
+    stats.set_defaults(func=cmd_stats)
+
+    restore_parser = subparsers.add_parser(
+        "restore",
+        description=(
+            "Restore a directory from a snapshot. "
+            "Files that already exist with the same size and modification time are skipped."
+        ))
+    restore_parser.add_argument(
+        "directory", metavar="DIRECTORY",
+        help="The directory to restore. This must be defined in the config.",
+        type=pathlib.Path,
+    )
+    restore_parser.add_argument(
+        "paths", metavar="PATH", nargs="*",
+        help=(
+            "Restore these paths first, before the rest of the directory. "
+            "Relative paths are relative to the directory."
+        ),
+        type=pathlib.Path,
+    )
+    restore_parser.add_argument(
+        "-s", "--snapshot", dest="snapshot", metavar="NAME",
+        help="The snapshot to restore. Defaults to the latest snapshot.",
+    )
+    restore_parser.add_argument(
+        "--only", dest="only",
+        help="Only restore the given paths, not the rest of the directory.",
+        action="store_true", default=False,
+    )
+    restore_parser.add_argument(
+        "--destination", dest="destination", metavar="DIRECTORY",
+        help="Restore to this directory instead of the original directory.",
+        type=pathlib.Path,
+    )
+    restore_parser.add_argument(
+        "-j", "--jobs", dest="jobs",
+        help="How many streams of files to restore at once.",
+        type=int, default=restore.RESTORE_JOBS,
+    )
+    restore_parser.add_argument(
+        "-n", "--dry-run", dest="dry_run",
+        help="Do not restore any files, only report what would happen.",
+        action="store_true", default=False,
+    )
+    restore_parser.set_defaults(func=cmd_restore)
+
+    export_parser = subparsers.add_parser(
+        "export",
+        description=(
+            "Write a snapshot of a directory as a compressed tar archive, "
+            "to standard output or to a file"
+        ))
+    export_parser.add_argument(
+        "directory", metavar="DIRECTORY",
+        help="The directory to export. This must be defined in the config.",
+        type=pathlib.Path,
+    )
+    export_parser.add_argument(
+        "-s", "--snapshot", dest="snapshot", metavar="NAME",
+        help="The snapshot to export. Defaults to the latest snapshot.",
+    )
+    export_parser.add_argument(
+        "-o", "--output", dest="output", metavar="FILE",
+        help="Write the archive to this file. Defaults to standard output.",
+        type=pathlib.Path,
+    )
+    export_parser.add_argument(
+        "--compression", dest="compression",
+        help="How to compress the archive. Defaults to a guess from the output file name, or gzip.",
+        choices=list(export.COMPRESSORS), default=None,
+    )
+    export_parser.add_argument(
+        "--volume-size", dest="volume_size", metavar="SIZE",
+        help=(
+            "Split the archive in to files of this size, such as 4GiB, "
+            "named FILE.000, FILE.001, and so on. Needs --output."
+        ),
+        type=units.parse_size, default=None,
+    )
+    export_parser.set_defaults(func=cmd_export)
+
+    log_parser = subparsers.add_parser(
+        "log",
+        description="Show the files that changed in each snapshot of a directory, newest first")
+    log_parser.add_argument(
+        "directory", metavar="DIRECTORY",
+        help="The directory to show the changes for. This must be defined in the config.",
+        type=pathlib.Path,
+    )
+    log_parser.add_argument(
+        "-s", "--snapshot", dest="snapshots", metavar="NAME",
+        help="Show a specific snapshot. Can be used multiple times. Defaults to all snapshots.",
+        action="append",
+    )
+    log_parser.add_argument(
+        "-l", "--limit", dest="limit",
+        help="How many of the most recent snapshots to show.",
+        type=int, default=None,
+    )
+    log_parser.add_argument(
+        "--summary", dest="summary",
+        help="Only show how many files changed in each snapshot.",
+        action="store_true", default=False,
+    )
+    log_parser.set_defaults(func=cmd_log)
+
     test_rotator = subparsers.add_parser(
         "test-rotator",
         description="Test a rotation strategy without making any changes")
@@ -160,9 +390,8 @@ def _get_matching_directories(
 
 
 def cmd_default(config: config.Config, arguments: argparse.Namespace) -> None:
-    timestamp = _utc_now()
-    for directory in directories.Directory.all_from_config(config):
-        backup.backup_directory(directory, config=config, timestamp=timestamp)
+    backup.backup_directories(
+        directories.Directory.all_from_config(config), config=config, timestamp=_utc_now())
 
 
 def cmd_backup(config: config.Config, arguments: argparse.Namespace) -> None:
@@ -172,14 +401,148 @@ def cmd_backup(config: config.Config, arguments: argparse.Namespace) -> None:
         directories_to_backup = _get_matching_directories(
             directories_to_backup, [p.expanduser() for p in arguments.directories])
 
-    for directory in directories_to_backup:
-        backup.backup_directory(
-            directory, config=config,
+    backup.backup_directories(
+        directories_to_backup, config=config,
+        dry_run=arguments.dry_run,
+        timestamp=arguments.timestamp,
+    )
+
+
+def cmd_verify(config: config.Config, arguments: argparse.Namespace) -> None:
+    directories_to_verify = directories.Directory.all_from_config(config)
+
+    if arguments.directories:
+        directories_to_verify = _get_matching_directories(
+            directories_to_verify, [p.expanduser() for p in arguments.directories])
+
+    problems = []
+    for directory in directories_to_verify:
+        with directory.target.connect() as context, instrumentation.phase('verify'):
+            problems.extend(verify.verify_directory_with_context(
+                directory,
+                instrumentation.instrument(context, config),
+                jobs=arguments.jobs,
+                snapshot_names=arguments.snapshots,
+                sample=arguments.sample,
+                full=arguments.full,
+            ))
+
+    if problems:
+        raise exceptions.VerifyError(f"Verification found {len(problems)} problems")
+
+
+def cmd_restore(config: config.Config, arguments: argparse.Namespace) -> None:
+    if arguments.only and not arguments.paths:
+        raise exceptions.CommandError("--only needs some paths to restore")
+    directories_to_restore = _get_matching_directories(
+        directories.Directory.all_from_config(config), [arguments.directory.expanduser()])
+    if len(directories_to_restore) > 1:
+        raise exceptions.CommandError(
+            f"{str(arguments.directory)!r} is backed up to more than one target")
+    (directory,) = directories_to_restore
+    with directory.target.connect() as context:
+        restore.restore_directory(
+            directory,
+            instrumentation.instrument(context, config),
+            config=config,
+            snapshot_name=arguments.snapshot,
+            paths=restore.resolve_paths(directory, arguments.paths),
+            only=arguments.only,
+            destination=arguments.destination.expanduser() if arguments.destination else None,
+            jobs=arguments.jobs,
             dry_run=arguments.dry_run,
-            timestamp=arguments.timestamp,
         )
 
 
+def cmd_export(config: config.Config, arguments: argparse.Namespace) -> None:
+    if arguments.volume_size is not None and arguments.output is None:
+        raise exceptions.CommandError("--volume-size needs an --output file")
+    if arguments.output is None and sys.stdout.isatty():
+        raise exceptions.CommandError(
+            "Not writing an archive to a terminal. Use --output, or redirect the output")
+    directories_to_export = _get_matching_directories(
+        directories.Directory.all_from_config(config), [arguments.directory.expanduser()])
+    if len(directories_to_export) > 1:
+        raise exceptions.CommandError(
+            f"{str(arguments.directory)!r} is backed up to more than one target")
+    (directory,) = directories_to_export
+
+    output_path = arguments.output.expanduser() if arguments.output else None
+    compression = arguments.compression or export.guess_compression(output_path)
+    with contextlib.ExitStack() as stack:
+        output: t.BinaryIO
+        if output_path is None:
+            output = stack.enter_context(export.take_stdout())
+        elif arguments.volume_size is not None:
+            output = t.cast(t.BinaryIO, stack.enter_context(
+                export.Volumes(output_path, arguments.volume_size)))
+        else:
+            output = stack.enter_context(open(output_path, 'wb'))
+        context = stack.enter_context(directory.target.connect())
+        export.export_directory(
+            directory,
+            instrumentation.instrument(context, config),
+            output,
+            snapshot_name=arguments.snapshot,
+            compression=compression,
+        )
+
+
+def cmd_log(config: config.Config, arguments: argparse.Namespace) -> None:
+    directories_to_show = _get_matching_directories(
+        directories.Directory.all_from_config(config), [arguments.directory.expanduser()])
+    # The same source directory can be backed up to more than one target
+    for directory in directories_to_show:
+        with directory.target.connect() as context, instrumentation.phase('log'):
+            log.show_directory_log(
+                directory,
+                instrumentation.instrument(context, config),
+                snapshot_names=arguments.snapshots,
+                limit=arguments.limit,
+                summary=arguments.summary,
+            )
+
+
+def cmd_daemon(config: config.Config, arguments: argparse.Namespace) -> None:
+    directories_to_backup = directories.Directory.all_from_config(config)
+
+    if arguments.directories:
+        directories_to_backup = _get_matching_directories(
+            directories_to_backup, [p.expanduser() for p in arguments.directories])
+
+    daemon_config = config['daemon']
+    try:
+        default_cadence = units.parse_duration(daemon_config['cadence'])
+        idle_timeout = units.parse_duration(daemon_config['keep_connections'])
+    except ValueError as exc:
+        raise exceptions.ConfigError(str(exc))
+
+    pool = daemon.ConnectionPool(idle_timeout=idle_timeout)
+    try:
+        scheduler = daemon.Scheduler(
+            directories_to_backup,
+            config=config,
+            jobs=arguments.jobs or daemon_config['jobs'],
+            default_cadence=default_cadence,
+            pool=pool,
+        )
+        scheduler.run_forever()
+    finally:
+        pool.close()
+
+
+def cmd_stats(config: config.Config, arguments: argparse.Namespace) -> None:
+    directories_to_show = directories.Directory.all_from_config(config)
+
+    if arguments.directories:
+        directories_to_show = _get_matching_directories(
+            directories_to_show, [p.expanduser() for p in arguments.directories])
+
+    backup_history = config.get(history.History)
+    for directory in directories_to_show:
+        stats.show_directory_stats(directory, backup_history, limit=arguments.limit)
+
+
 def cmd_test_rotator(config: config.Config, arguments: argparse.Namespace) -> None:
     timestamp = _utc_now()
     rotator = config.get((rotators.Rotator, arguments.rotator))  # type: ignore
@@ -190,7 +553,8 @@ def cmd_test_rotator(config: config.Config, arguments: argparse.Namespace) -> No
             directories.Directory.all_from_config(config),
             [arguments.directory.expanduser()])))
         with directory.target.connect() as context:
-            backups = context.list_backups(directory.target_path)
+            backups = list(context.list_backups(directory.target_path))
+            rotator = rotator.inspect(context, directory.target_path, backups)
     else:
         with open(arguments.dates_from, 'r') as f:
             trimmed_lines = (line.strip() for line in f)
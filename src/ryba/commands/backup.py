@@ -1,12 +1,32 @@
+import contextlib
 import datetime
+import os
+import pathlib
 import shlex
+import stat
 import subprocess
+import tempfile
+import time
+import typing as t
+import uuid
 
-from .. import config, constants, directories, exceptions, logging, targets
-from . import rotate, snapshot
+from .. import (
+    config, constants, digests, directories, exceptions, history,
+    instrumentation, journal, locks, logging, moves, processes, rotators,
+    rsync, targets, units)
+from . import export, rotate, snapshot
 
 logger = logging.getLogger(__name__)
 
+#: How many files to checksum at once when comparing checksums
+CHECKSUM_JOBS = 4
+
+#: Directories with more entries than this are never batched, whatever their size
+BATCH_MAX_ENTRIES = 10000
+
+#: The ways to estimate how much a backup will send, for `check_free_space()`
+PREFLIGHT_ESTIMATES = ['history', 'dry-run', 'off']
+
 
 def backup_directory(
     directory: directories.Directory,
@@ -17,6 +37,7 @@ def backup_directory(
     send_files: bool = True,
     create_snapshot: bool = True,
     rotate_snapshot: bool = True,
+    context: t.Optional[targets.TargetContext] = None,
 ) -> None:
     """
     Backup a directory.
@@ -30,11 +51,43 @@ def backup_directory(
     If `create_snapshot` is True (the default), a new timestamped snapshot directory will be create.
     If `rotate_snapshot` is True (the default), old snapshots will be rotated
     and possibly deleted if they are no longer required.
+    If `context` is given, it is used instead of connecting to the target.
+
+    Unless this is a dry run, the directory is locked for the duration of the backup,
+    and the backup is recorded in the history.
     """
-    with directory.target.connect() as context:
+    directory = directory.with_markers_found()
+    backup_history = config.get(history.History)
+    _log_estimate(directory, config=config)
+
+    locker = locks.Locker.from_config(config)
+    with contextlib.ExitStack() as stack:
+        if dry_run:
+            run = history.DirectoryRun(
+                source=str(directory.source_path), target=directory.target.name,
+                started=time.time())
+        else:
+            stack.enter_context(locker.local([directory]))
+            run = stack.enter_context(backup_history.record(directory))
+
+        if context is None:
+            with run.phase('connect'):
+                context = instrumentation.instrument(
+                    stack.enter_context(directory.target.connect()), config)
+        if not dry_run:
+            stack.enter_context(locker.target([directory], context))
         backup_directory_with_context(
             directory, context, config=config, timestamp=timestamp, dry_run=dry_run,
-            send_files=send_files, create_snapshot=create_snapshot, rotate_snapshot=rotate_snapshot)
+            send_files=send_files, create_snapshot=create_snapshot, rotate_snapshot=rotate_snapshot,
+            run=run)
+
+
+def _log_estimate(directory: directories.Directory, *, config: config.Config) -> None:
+    """Say how long a directory is expected to take to back up, from its history."""
+    if (estimate := config.get(history.History).estimate_duration(directory)) is not None:
+        logger.log(
+            logging.MESSAGE, "Estimated duration for %s: %s",
+            directory, units.format_duration(estimate.total_seconds()))
 
 
 def backup_directory_with_context(
@@ -47,19 +100,567 @@ def backup_directory_with_context(
     send_files: bool = True,
     create_snapshot: bool = True,
     rotate_snapshot: bool = True,
+    run: t.Optional[history.DirectoryRun] = None,
+    changes: t.Optional[t.List[journal.Change]] = None,
 ) -> None:
+    """
+    Backup a directory using an already connected target context.
+    If `run` is given, statistics about the backup are recorded on it.
+    If `changes` is given, it is stored in the snapshot as the changes made when the files were sent.
+    """
+    if run is None:
+        run = history.DirectoryRun(
+            source=str(directory.source_path), target=directory.target.name,
+            started=time.time())
+
     logger.log(logging.MESSAGE, "Backing up %s", directory)
+    if send_files and context.uses_rsync and not dry_run:
+        with run.phase('preflight'):
+            check_free_space(directory, context, config=config, timestamp=timestamp)
     if send_files:
-        _send_files(
-            directory, context, config=config, dry_run=dry_run)
+        with run.phase('send'):
+            stats = _send_files(
+                directory, context, config=config, dry_run=dry_run)
+        run.files_transferred = stats.files_transferred
+        run.bytes_transferred = stats.bytes_transferred
+        changes = stats.changes
 
     if create_snapshot:
-        snapshot.create_snapshot(
-            directory, context, dry_run=dry_run, timestamp=timestamp)
+        with run.phase('snapshot'):
+            snapshot.create_snapshot(
+                directory, context, dry_run=dry_run, timestamp=timestamp, changes=changes)
 
     if rotate_snapshot:
-        rotate.rotate_directory(
-            directory, context, dry_run=dry_run, timestamp=timestamp)
+        with run.phase('rotate'):
+            verdicts = rotate.rotate_directory(
+                directory, context, dry_run=dry_run, timestamp=timestamp)
+        run.snapshots_kept = sum(1 for _, verdict, _ in verdicts if verdict is rotators.Verdict.keep)
+        run.snapshots_dropped = sum(1 for _, verdict, _ in verdicts if verdict is not rotators.Verdict.keep)
+
+
+def check_free_space(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+) -> None:
+    """
+    Make sure the target has room for the files about to be sent to it.
+    The size of the transfer is estimated from the history of the directory,
+    or from a dry run of rsync, as set in the `[preflight]` section of the config.
+    When there is not enough free space, old snapshots are rotated before sending the files
+    instead of only afterwards. If there is still not enough space,
+    a `SpaceError` is raised instead of filling the target part way through the backup.
+    """
+    options = config['preflight']
+    if options['estimate'] not in PREFLIGHT_ESTIMATES:
+        raise exceptions.ConfigError(
+            f"Invalid preflight.estimate {options['estimate']!r}, "
+            f"expected one of {', '.join(PREFLIGHT_ESTIMATES)}")
+    try:
+        reserve = units.parse_size(options['reserve'])
+    except ValueError as exc:
+        raise exceptions.ConfigError(f"Invalid preflight.reserve: {exc}")
+    if options['estimate'] == 'off':
+        return
+
+    estimate = None
+    if options['estimate'] == 'history':
+        estimate = config.get(history.History).estimate_transfer(directory)
+    if estimate is None and directory.command is None:
+        estimate = _estimate_transfer(directory, context, config=config)
+    if estimate is None:
+        return
+    needed = estimate + reserve
+
+    if (available := _free_space(directory, context)) is None or available >= needed:
+        return
+    logger.log(
+        logging.WARNING, "Only %s is free on %s, but about %s is needed",
+        units.format_size(available), directory.target.name, units.format_size(needed))
+
+    if directory.rotate is not None:
+        logger.log(logging.INFO, "Rotating snapshots before sending files")
+        rotate.rotate_directory(directory, context, timestamp=timestamp)
+        if (available := _free_space(directory, context)) is None or available >= needed:
+            return
+
+    raise exceptions.SpaceError(
+        f"Not enough space on {directory.target.name} to back up {str(directory.source_path)!r}: "
+        f"about {units.format_size(needed)} is needed, but only {units.format_size(available)} is free")
+
+
+def _estimate_transfer(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+) -> t.Optional[int]:
+    """Estimate how many bytes rsync will send with a dry run."""
+    logger.log(logging.INFO, "Estimating the size of the backup")
+    with tempfile.TemporaryDirectory(prefix='ryba-rsync-') as temporary_directory:
+        command = _rsync_command(config=config, dry_run=True)
+        command.extend(_rsync_filter_options(directory, pathlib.Path(temporary_directory)))
+        command.extend(_rsync_source_and_destination(directory, context))
+        logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+        returncode, output = rsync.run(command, echo=False)
+    if returncode not in (0, *rsync.PARTIAL_RETURNCODES):
+        logger.log(logging.WARNING, "Could not estimate the size of the backup (rsync exited with %i)", returncode)
+        return None
+    return _parse_rsync_stats(output).bytes_transferred
+
+
+def _free_space(directory: directories.Directory, context: targets.TargetContext) -> t.Optional[int]:
+    """The free space on the target for a directory, which might not exist yet."""
+    path = directory.target_path
+    while not context.exists(path) and path != path.parent:
+        path = path.parent
+    try:
+        return context.free_space(path)
+    except Exception as exc:
+        logger.log(logging.WARNING, "Could not find the free space on %s: %s", directory.target.name, exc)
+        return None
+
+
+def backup_directories(
+    directories_to_backup: t.List[directories.Directory],
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+) -> None:
+    """
+    Back up many directories.
+    Directories backed up to many targets are sent to all of them at once, see `backup_fan_out()`.
+    Small directories that share a target are sent in one rsync, see `plan_batches()`.
+    Directories locked by another run are skipped, see `locks`.
+    """
+    fan_outs: t.Dict[int, t.List[directories.Directory]] = {}
+    others = []
+    for directory in map(directories.Directory.with_markers_found, directories_to_backup):
+        if directory.fan_out is None:
+            others.append(directory)
+        else:
+            fan_outs.setdefault(directory.fan_out, []).append(directory)
+    for group in fan_outs.values():
+        with _skip_locked():
+            backup_fan_out(group, config=config, timestamp=timestamp, dry_run=dry_run)
+
+    max_size = units.parse_size(config['batch']['max_size'])
+    for batch in plan_batches(others, max_size=max_size):
+        with _skip_locked():
+            if len(batch) == 1:
+                backup_directory(batch[0], config=config, timestamp=timestamp, dry_run=dry_run)
+            else:
+                backup_batch(batch, config=config, timestamp=timestamp, dry_run=dry_run)
+
+
+@contextlib.contextmanager
+def _skip_locked() -> t.Iterator[None]:
+    try:
+        yield
+    except locks.LockedError as exc:
+        logger.log(logging.WARNING, "Skipping backup: %s", exc.message)
+
+
+def plan_batches(
+    directories_to_backup: t.List[directories.Directory],
+    *,
+    max_size: int,
+) -> t.List[t.List[directories.Directory]]:
+    """
+    Group directories no larger than `max_size` that share a target in to batches.
+    Every other directory is in a batch by itself,
+    as are directories that detect moves, which are made on the target before each directory is sent.
+    Batches are in the order of the first directory in each batch.
+    """
+    plan: t.List[t.List[directories.Directory]] = []
+    batches: t.Dict[t.Tuple[str, bool], t.List[directories.Directory]] = {}
+    for directory in directories_to_backup:
+        if (
+            max_size <= 0 or directory.command is not None or directory.detect_moves
+            or not _is_small(directory, max_size)
+        ):
+            plan.append([directory])
+            continue
+        # rsync only has one --one-file-system option for all the directories
+        key = (directory.target.name, directory.one_file_system)
+        if key not in batches:
+            batches[key] = []
+            plan.append(batches[key])
+        batches[key].append(directory)
+    return plan
+
+
+def _is_small(directory: directories.Directory, max_size: int) -> bool:
+    """
+    Is the source directory no larger than `max_size`,
+    with no more than `BATCH_MAX_ENTRIES` entries?
+    This stops looking as soon as the directory is too large.
+    """
+    size = 0
+    entries = directory.filter().walk(directory.source_path)
+    for count, (_, entry_stat) in enumerate(entries, start=1):
+        size += entry_stat.st_size
+        if size > max_size or count > BATCH_MAX_ENTRIES:
+            return False
+    return True
+
+
+def backup_batch(
+    batch: t.List[directories.Directory],
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+) -> None:
+    """
+    Backup many directories that share a target,
+    sending the files for every directory in one rsync.
+    Each directory is then snapshotted and rotated as if it were backed up by itself.
+    Targets that do not use rsync back up each directory by itself.
+    """
+    backup_history = config.get(history.History)
+    locker = locks.Locker.from_config(config)
+    target = batch[0].target
+    for directory in batch:
+        _log_estimate(directory, config=config)
+
+    with contextlib.ExitStack() as stack:
+        if not dry_run:
+            stack.enter_context(locker.local(batch))
+        runs = [
+            history.DirectoryRun(
+                source=str(directory.source_path), target=target.name, started=time.time())
+            if dry_run else stack.enter_context(backup_history.record(directory))
+            for directory in batch
+        ]
+
+        with _phase(runs, 'connect'):
+            context = instrumentation.instrument(stack.enter_context(target.connect()), config)
+        if not dry_run:
+            stack.enter_context(locker.target(batch, context))
+
+        changes: t.List[t.Optional[t.List[journal.Change]]] = [None] * len(batch)
+        if context.uses_rsync:
+            if not dry_run:
+                for directory, run in zip(batch, runs):
+                    with run.phase('preflight'):
+                        check_free_space(directory, context, config=config, timestamp=timestamp)
+            logger.log(logging.MESSAGE, "Sending %d directories to %s", len(batch), target.name)
+            with _phase(runs, 'send'):
+                sent = _send_batch(batch, context, config=config, dry_run=dry_run)
+            for run, stats in zip(runs, sent):
+                run.files_transferred = stats.files_transferred
+                run.bytes_transferred = stats.bytes_transferred
+            changes = [stats.changes for stats in sent]
+
+        for directory, run, directory_changes in zip(batch, runs, changes):
+            backup_directory_with_context(
+                directory, context, config=config, timestamp=timestamp, dry_run=dry_run,
+                send_files=not context.uses_rsync, run=run, changes=directory_changes)
+
+
+def backup_fan_out(
+    group: t.List[directories.Directory],
+    *,
+    config: config.Config,
+    timestamp: datetime.datetime,
+    dry_run: bool = False,
+) -> None:
+    """
+    Backup a directory to many targets, scanning the source and computing the changes only once.
+    The files are sent to the first target using rsync, which records the changes in a batch file.
+    The batch is then replayed to the other targets, see `_send_fan_out()`.
+    Each directory is then snapshotted and rotated as if it were backed up by itself.
+    Targets that do not use rsync back up the directory by themselves,
+    as does everything in a dry run.
+    """
+    if dry_run or len(group) == 1:
+        for directory in group:
+            backup_directory(directory, config=config, timestamp=timestamp, dry_run=dry_run)
+        return
+
+    backup_history = config.get(history.History)
+    locker = locks.Locker.from_config(config)
+    for directory in group:
+        _log_estimate(directory, config=config)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(locker.local(group))
+        runs = [stack.enter_context(backup_history.record(directory)) for directory in group]
+        contexts = []
+        for directory, run in zip(group, runs):
+            with run.phase('connect'):
+                contexts.append(instrumentation.instrument(
+                    stack.enter_context(directory.target.connect()), config))
+            stack.enter_context(locker.target([directory], contexts[-1]))
+
+        members = [index for index, context in enumerate(contexts) if context.uses_rsync]
+        changes: t.List[t.Optional[t.List[journal.Change]]] = [None] * len(group)
+        if len(members) > 1:
+            for index in members:
+                with runs[index].phase('preflight'):
+                    check_free_space(group[index], contexts[index], config=config, timestamp=timestamp)
+            logger.log(
+                logging.MESSAGE, "Sending %r to %d targets",
+                str(group[0].source_path), len(members))
+            sent = _send_fan_out(
+                [group[index] for index in members], [contexts[index] for index in members],
+                [runs[index] for index in members], config=config)
+            for index, member_changes in zip(members, sent):
+                changes[index] = member_changes
+
+        for directory, context, run, directory_changes in zip(group, contexts, runs, changes):
+            backup_directory_with_context(
+                directory, context, config=config, timestamp=timestamp,
+                send_files=directory_changes is None, run=run, changes=directory_changes)
+
+
+def _send_fan_out(
+    group: t.List[directories.Directory],
+    contexts: t.List[targets.TargetContext],
+    runs: t.List[history.DirectoryRun],
+    *,
+    config: config.Config,
+) -> t.List[t.List[journal.Change]]:
+    """
+    Send a directory to the first target in the group with rsync,
+    recording the changes it makes in a batch file with `--write-batch`,
+    then replay the batch to the other targets with `--read-batch`.
+    Returns the changes made to each target.
+
+    A batch only applies cleanly to a current snapshot that is identical to the one it was made against.
+    Each target keeps the name of the last batch it matched in its state directory,
+    which is cleared while the current snapshot is being changed.
+    Targets that did not match the first target before the batch,
+    or that fail to replay it, are sent the files with a normal rsync instead.
+    They rejoin the group if the first target turns out to be unchanged from the source afterwards.
+    """
+    primary, primary_context = group[0], contexts[0]
+    # The batch is made after the moves, so every target it is replayed to needs the same moves
+    plan = _plan_moves(primary) if primary.detect_moves else None
+    states = [_read_fan_out_state(directory, context) for directory, context in zip(group, contexts)]
+    new_state = uuid.uuid4().hex
+    changes: t.List[t.List[journal.Change]] = []
+    # Targets sent the batch still need the checksum comparison, which is not part of the batch
+    batched = [primary]
+
+    with tempfile.TemporaryDirectory(prefix='ryba-fan-out-') as temporary_directory:
+        batch_file = pathlib.Path(temporary_directory) / 'batch'
+        logger.log(logging.MESSAGE, "Sending %s", primary)
+        with runs[0].phase('send'):
+            _write_fan_out_state(primary, primary_context, None)
+            stats = _send_files(
+                primary, primary_context, config=config, dry_run=False, write_batch=batch_file, plan=plan)
+            _write_fan_out_state(primary, primary_context, new_state)
+        runs[0].files_transferred = stats.files_transferred
+        runs[0].bytes_transferred = stats.bytes_transferred
+        changes.append(stats.changes or [])
+
+        for directory, context, run, state in zip(group[1:], contexts[1:], runs[1:], states[1:]):
+            logger.log(logging.MESSAGE, "Sending %s", directory)
+            with run.phase('send'):
+                _write_fan_out_state(directory, context, None)
+                if state is None or state != states[0]:
+                    logger.log(
+                        logging.INFO, "%s has diverged from %s:%r, sending with rsync",
+                        directory.target.name, primary.target.name, str(primary.target_path))
+                elif (returncode := _replay_batch(directory, context, batch_file, plan, config=config)) in (0, *rsync.PARTIAL_RETURNCODES):
+                    _write_fan_out_state(directory, context, new_state)
+                    if plan is not None:
+                        plan.save(directory)
+                    changes.append(list(stats.changes or []))
+                    batched.append(directory)
+                    continue
+                else:
+                    logger.log(
+                        logging.WARNING, "Replaying the batch failed (rsync exited with %i), sending with rsync",
+                        returncode)
+
+                fallback = _send_files(directory, context, config=config, dry_run=False, write_batch=None)
+                if _is_unchanged(primary, primary_context, config=config):
+                    _write_fan_out_state(directory, context, new_state)
+            run.files_transferred = fallback.files_transferred
+            run.bytes_transferred = fallback.bytes_transferred
+            changes.append(fallback.changes or [])
+
+    for directory, context, run, directory_changes in zip(group, contexts, runs, changes):
+        if directory.checksum and directory in batched:
+            with run.phase('send'):
+                directory_changes.extend(
+                    _send_checksum_differences(directory, context, config=config, dry_run=False))
+    return changes
+
+
+def _read_fan_out_state(directory: directories.Directory, context: targets.TargetContext) -> t.Optional[str]:
+    path = _fan_out_state_path(directory)
+    content = context.read_files([path])[path]
+    if content is None:
+        return None
+    return content.decode().strip() or None
+
+
+def _write_fan_out_state(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    state: t.Optional[str],
+) -> None:
+    """Record the batch the current snapshot matches, or `None` while it is being changed."""
+    if context.exists(directory.target_path):
+        path = _fan_out_state_path(directory)
+        context.ensure_directory(path.parent)
+        context.write_file(path, (state or '').encode())
+
+
+def _fan_out_state_path(directory: directories.Directory) -> pathlib.Path:
+    return directory.target_path / constants.STATE_DIRECTORY_NAME / constants.FAN_OUT_STATE_FILE_NAME
+
+
+def _replay_batch(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    batch_file: pathlib.Path,
+    plan: t.Optional[moves.Plan],
+    *,
+    config: config.Config,
+) -> int:
+    """
+    Replay an rsync batch to the current snapshot of a directory, returning the rsync exit code.
+    rsync can not replay a batch to a remote destination,
+    so rsync is run on the target, reading the batch from its standard input.
+    The moves in `plan` are made first, as they were before the batch was made.
+    """
+    if plan is not None:
+        _make_moves(directory, context, plan, dry_run=False)
+    current_path = context.make_path(directory.target_path / constants.CURRENT_SNAPSHOT_NAME)
+    command = _rsync_command(config=config, dry_run=False)
+    command.extend(['--read-batch=-', rsync.ensure_trailing_slash(str(current_path))])
+    logger.log(logging.INFO, "Replaying the batch")
+    verbosity = config.get(logging.Verbosity)
+    return context.run_with_input(command, batch_file, echo=verbosity is not logging.Verbosity.silent)
+
+
+def _is_unchanged(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+) -> bool:
+    """Would rsync make no changes to the current snapshot of a directory?"""
+    with tempfile.TemporaryDirectory(prefix='ryba-rsync-') as temporary_directory:
+        log_file = pathlib.Path(temporary_directory) / 'rsync.log'
+        command = ['rsync', '--dry-run', '--delete-after', '--delete-excluded', *rsync.preserve_options()]
+        command.extend(_rsync_log_options(log_file))
+        command.extend(_rsync_filter_options(directory, pathlib.Path(temporary_directory)))
+        command.extend(_rsync_source_and_destination(directory, context))
+        logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+        returncode, _ = rsync.run(command, echo=False)
+        log = log_file.read_bytes() if log_file.exists() else b''
+    return returncode == 0 and not journal.parse_rsync_log(log)
+
+
+@contextlib.contextmanager
+def _phase(runs: t.List[history.DirectoryRun], name: str) -> t.Iterator[None]:
+    """Record the wrapped block as a phase of every run."""
+    with contextlib.ExitStack() as stack:
+        for run in runs:
+            stack.enter_context(run.phase(name))
+        if len(runs) > 1:
+            # Processes in the block are shared between all the directories
+            stack.enter_context(instrumentation.phase(name, directory=f'{len(runs)} directories'))
+        yield
+
+
+def _send_batch(
+    batch: t.List[directories.Directory],
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+    dry_run: bool,
+) -> t.List[targets.TransferStats]:
+    """
+    Copy files from the sources of many directories to the target in one rsync.
+    Returns what was sent for each directory, and the changes made to it.
+
+    rsync can only send to one destination,
+    so every directory is sent relative to the root of the target using `--relative`.
+    A temporary tree of symlinks maps the path of each current snapshot on the target
+    to the source directory, which rsync follows as the source has a trailing slash.
+    The exclusion rules for each directory are scoped to its current snapshot.
+    rsync only prints statistics for the whole run, see `_batch_stats()` for each directory's share.
+    """
+    command = _rsync_command(config=config, dry_run=dry_run)
+    command.extend(['--relative', '--no-implied-dirs'])
+    if batch[0].one_file_system:
+        command.append('--one-file-system')
+
+    missing = [directory for directory in batch if not context.exists(directory.target_path)]
+    if missing:
+        logger.log(
+            logging.INFO, "Creating destination directories %s",
+            ", ".join(repr(str(directory.target_path)) for directory in missing))
+        if not dry_run:
+            context.execute_many([
+                ["mkdir", "-p", str(context.make_path(directory.target_path))]
+                for directory in missing])
+
+    with tempfile.TemporaryDirectory(prefix='ryba-batch-') as temporary_directory:
+        links = pathlib.Path(temporary_directory) / 'sources'
+        log_file = pathlib.Path(temporary_directory) / 'rsync.log'
+        command.extend(_rsync_log_options(log_file))
+        sources = []
+        prefixes = []
+        for directory in batch:
+            current = context.make_path(
+                directory.target_path / constants.CURRENT_SNAPSHOT_NAME).relative_to('/')
+            link = links / current
+            link.parent.mkdir(parents=True, exist_ok=True)
+            link.symlink_to(directory.source_path)
+            sources.append(f'{links}/./{current}/')
+            prefixes.append(str(current))
+            command.extend(_rsync_scoped_filter_options(directory, current))
+
+        target_str, target_arguments = batch[0].target.rsync_arguments(pathlib.Path('/'))
+        command.extend(target_arguments)
+        command.extend(sources)
+        command.append(rsync.ensure_trailing_slash(target_str))
+
+        logger.log(logging.INFO, "Running rsync")
+        logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+        verbosity = config.get(logging.Verbosity)
+        returncode, _ = rsync.run(command, echo=verbosity is not logging.Verbosity.silent)
+        log = log_file.read_bytes() if log_file.exists() else b''
+    rsync.check_returncode(returncode)
+    logger.log(logging.INFO, "Finished backup")
+
+    sent = [_batch_stats(directory, journal.parse_rsync_log(log, prefix)) for directory, prefix in zip(batch, prefixes)]
+    for directory, stats in zip(batch, sent):
+        if directory.checksum:
+            assert stats.changes is not None
+            stats.changes.extend(
+                _send_checksum_differences(directory, context, config=config, dry_run=dry_run))
+    return sent
+
+
+def _batch_stats(directory: directories.Directory, changes: t.List[journal.Change]) -> targets.TransferStats:
+    """
+    Count the files sent for one directory in a batch, and their size, from the changes rsync logged.
+    This matches what rsync counts in its statistics:
+    every regular file it transferred, at its full size.
+    """
+    files_transferred = bytes_transferred = 0
+    for change in changes:
+        if change.itemized[:2] not in ('>f', '<f'):
+            continue
+        files_transferred += 1
+        try:
+            bytes_transferred += os.lstat(directory.source_path / change.path).st_size
+        except OSError:
+            # Removed from the source since it was sent
+            pass
+    return targets.TransferStats(
+        files_transferred=files_transferred, bytes_transferred=bytes_transferred, changes=changes)
 
 
 def _send_files(
@@ -68,8 +669,271 @@ def _send_files(
     *,
     config: config.Config,
     dry_run: bool,
+    write_batch: t.Optional[pathlib.Path] = None,
+    plan: t.Optional[moves.Plan] = None,
+) -> targets.TransferStats:
+    """
+    Copy files from the source to the target using rsync.
+    If `write_batch` is given, rsync records the changes it makes in that batch file,
+    and the checksum comparison is left to the caller as it is not part of the batch.
+    If the directory detects moves, files moved in the source are first moved on the target,
+    using `plan` if it is given.
+    """
+    if directory.command is not None:
+        return _send_command_output(directory, context, dry_run=dry_run)
+
+    if not context.uses_rsync:
+        logger.log(logging.INFO, "Storing files")
+        stats = context.receive_files(
+            directory.source_path, directory.target_path,
+            filter=directory.filter(), dry_run=dry_run)
+        logger.log(logging.INFO, "Finished backup")
+        return stats
+
+    if not context.exists(directory.target_path):
+        logger.log(logging.INFO, "Creating destination directory %r", directory.target_path)
+        if not dry_run:
+            cmd = ["mkdir", "-p", str(context.make_path(directory.target_path))]
+            context.execute(cmd)
+
+    if plan is None and directory.detect_moves:
+        plan = _plan_moves(directory)
+    if plan is not None:
+        _make_moves(directory, context, plan, dry_run=dry_run)
+
+    # Replaying a batch needs every change to be in the batch, so batches are never seeded
+    seeded = None
+    if (
+        config['seed']['enabled'] and not dry_run and write_batch is None
+        and not context.exists(directory.target_path / constants.CURRENT_SNAPSHOT_NAME)
+    ):
+        seeded = _seed_files(directory, context, config=config)
+
+    with tempfile.TemporaryDirectory(prefix='ryba-rsync-') as temporary_directory:
+        log_file = pathlib.Path(temporary_directory) / 'rsync.log'
+        command = _rsync_command(config=config, dry_run=dry_run)
+        command.extend(_rsync_log_options(log_file))
+        if write_batch is not None:
+            command.append(f'--write-batch={write_batch}')
+        command.extend(_rsync_filter_options(directory, pathlib.Path(temporary_directory)))
+        command.extend(_rsync_source_and_destination(directory, context))
+
+        logger.log(logging.INFO, "Running rsync")
+        logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+
+        # Execute the rsync command.
+        verbosity = config.get(logging.Verbosity)
+        returncode, output = rsync.run(command, echo=verbosity is not logging.Verbosity.silent)
+        log = log_file.read_bytes() if log_file.exists() else b''
+    rsync.check_returncode(returncode)
+    logger.log(logging.INFO, "Finished backup")
+    if plan is not None and not dry_run:
+        plan.save(directory)
+    stats = _parse_rsync_stats(output)
+    stats.changes = journal.parse_rsync_log(log)
+    if seeded is not None:
+        stats = _merge_seeded(seeded, stats)
+
+    if directory.checksum and write_batch is None:
+        assert stats.changes is not None
+        stats.changes.extend(
+            _send_checksum_differences(directory, context, config=config, dry_run=dry_run))
+
+    return stats
+
+
+def _send_command_output(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    dry_run: bool,
+) -> targets.TransferStats:
+    """
+    Run the command of a directory, such as a database dump,
+    and write what it prints to a file in the current snapshot, compressing it on the way.
+    The output is streamed straight to the target, so it never takes up space on this host.
+    It is written under another name and only moved in to place if the command succeeds,
+    so a failed command leaves the last output, which older snapshots share, untouched.
+    """
+    assert directory.command is not None and directory.output is not None
+    if not context.uses_rsync:
+        raise exceptions.CommandError(
+            f"Can not back up the output of a command to {directory.target.name}, "
+            "it does not store plain files")
+    if directory.compression not in export.COMPRESSORS:
+        raise exceptions.ConfigError(
+            f"Invalid compression {directory.compression!r} for {str(directory.source_path)!r}, "
+            f"expected one of {', '.join(export.COMPRESSORS)}")
+    compressor = export.COMPRESSORS[directory.compression]
+    current = directory.target_path / constants.CURRENT_SNAPSHOT_NAME
+    path = context.make_path(current / directory.output)
+    partial = context.make_path(current / f'{directory.output}.partial')
+
+    logger.log(logging.INFO, "Running %s", shlex.join(directory.command))
+    if dry_run:
+        return targets.TransferStats()
+    existed = context.exists(current / directory.output)
+    context.execute(["mkdir", "-p", str(context.make_path(current))])
+
+    started = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        running = [stack.enter_context(subprocess.Popen(directory.command, stdout=subprocess.PIPE))]
+        if compressor is not None:
+            running.append(stack.enter_context(subprocess.Popen(
+                shlex.split(compressor), stdin=running[0].stdout, stdout=subprocess.PIPE)))
+            # The command should see the compressor exit, not wait for this process to read
+            t.cast(t.BinaryIO, running[0].stdout).close()
+        output = t.cast(t.BinaryIO, running[-1].stdout)
+        returncode = context.stream_input(['sh', '-c', 'cat > "$1"', 'sh', str(partial)], output, echo=False)
+        output.close()
+        for process in running:
+            processes.wait(process, started)
+
+    for process in running:
+        if process.returncode != 0:
+            context.execute(["rm", "-f", str(partial)])
+            raise exceptions.CommandError(
+                f"{shlex.join(t.cast(t.List[str], process.args))} exited with {process.returncode}")
+    if returncode != 0:
+        context.execute(["rm", "-f", str(partial)])
+        raise exceptions.CommandError(
+            f"Could not write {directory.output!r} to {directory.target.name} (exited with {returncode})")
+
+    context.execute(["mv", "-f", str(partial), str(path)])
+    size = int(context.check_output(["stat", "--format=%s", str(path)]))
+    logger.log(logging.INFO, "Stored %s", units.format_size(size))
+    itemized = '>f.st......' if existed else '>f+++++++++'
+    return targets.TransferStats(
+        files_transferred=1, bytes_transferred=size,
+        changes=[journal.Change(itemized=itemized, path=directory.output)])
+
+
+def _seed_files(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+) -> t.Optional[targets.TransferStats]:
+    """
+    Send the files for the first backup of a directory as one tar archive,
+    unpacked on the target as it arrives.
+    rsync spends most of a first backup of many small files talking about each file,
+    while tar just sends them. The rsync that follows fixes anything tar did not copy exactly.
+    Returns every file sent as a change, and how much was sent, or `None` if seeding failed.
+    """
+    compression = config['seed']['compression']
+    if compression not in export.COMPRESSORS:
+        raise exceptions.ConfigError(
+            f"Invalid seed.compression {compression!r}, expected one of {', '.join(export.COMPRESSORS)}")
+    compressor = export.COMPRESSORS[compression]
+    current_path = context.make_path(directory.target_path / constants.CURRENT_SNAPSHOT_NAME)
+
+    logger.log(logging.INFO, "Seeding the first backup with tar")
+    context.execute(["mkdir", "-p", str(current_path)])
+    changes = []
+    files_transferred = bytes_transferred = 0
+    with tempfile.TemporaryDirectory(prefix='ryba-seed-') as temporary_directory:
+        files_from = pathlib.Path(temporary_directory) / 'files'
+        with open(files_from, 'wb') as f:
+            for path, entry_stat in directory.filter().walk(directory.source_path):
+                f.write(os.fsencode(path) + b'\0')
+                changes.append(_created(directory.source_path, path, entry_stat))
+                if stat.S_ISREG(entry_stat.st_mode):
+                    files_transferred += 1
+                    bytes_transferred += entry_stat.st_size
+
+        tar_options = ['--numeric-owner', '--acls', '--xattrs']
+        if compressor is not None:
+            tar_options.append(f'--use-compress-program={compressor}')
+        create = [
+            'tar', '--create', '--file=-', '--directory', str(directory.source_path),
+            '--sparse', *tar_options,
+            # These only apply to the options that come after them
+            '--no-recursion', '--null', '--verbatim-files-from', f'--files-from={files_from}',
+        ]
+        extract = [
+            'tar', '--extract', '--file=-', '--directory', str(current_path),
+            '--preserve-permissions', *tar_options,
+        ]
+        logger.log(logging.DEBUG, "$ %s | %s", shlex.join(create), shlex.join(extract))
+        started = time.monotonic()
+        with subprocess.Popen(create, stdout=subprocess.PIPE) as process:
+            assert process.stdout is not None
+            returncode = context.stream_input(extract, t.cast(t.BinaryIO, process.stdout), echo=False)
+            # Stop tar if the target stopped reading
+            process.stdout.close()
+            create_returncode = processes.wait(process, started)
+
+    # tar exits with 1 when files changed while they were read, which rsync will fix
+    if create_returncode not in (0, 1) or returncode != 0:
+        logger.log(
+            logging.WARNING, "Seeding failed (tar exited with %i and %i), sending every file with rsync",
+            create_returncode, returncode)
+        return None
+    return targets.TransferStats(
+        files_transferred=files_transferred, bytes_transferred=bytes_transferred, changes=changes)
+
+
+def _created(source: pathlib.Path, path: pathlib.PurePosixPath, entry_stat: os.stat_result) -> journal.Change:
+    """The change rsync would have logged for creating `path`."""
+    if stat.S_ISDIR(entry_stat.st_mode):
+        return journal.Change(itemized='cd+++++++++', path=f'{path}/')
+    if stat.S_ISLNK(entry_stat.st_mode):
+        try:
+            return journal.Change(itemized='cL+++++++++', path=f'{path} -> {os.readlink(source / path)}')
+        except OSError:
+            return journal.Change(itemized='cL+++++++++', path=str(path))
+    if stat.S_ISREG(entry_stat.st_mode):
+        return journal.Change(itemized='>f+++++++++', path=str(path))
+    if stat.S_ISCHR(entry_stat.st_mode) or stat.S_ISBLK(entry_stat.st_mode):
+        return journal.Change(itemized='cD+++++++++', path=str(path))
+    return journal.Change(itemized='cS+++++++++', path=str(path))
+
+
+def _merge_seeded(seeded: targets.TransferStats, stats: targets.TransferStats) -> targets.TransferStats:
+    """
+    Combine what seeding sent with what the rsync after it sent.
+    Everything in a seeded backup is new, so a path that rsync fixed up is still recorded as created,
+    unless rsync deleted it again.
+    """
+    changes = {change.path: change for change in seeded.changes or []}
+    for change in stats.changes or []:
+        if change.kind == journal.DELETED:
+            changes.pop(change.path, None)
+        else:
+            changes.setdefault(change.path, change)
+    return targets.TransferStats(
+        files_transferred=(seeded.files_transferred or 0) + (stats.files_transferred or 0),
+        bytes_transferred=(seeded.bytes_transferred or 0) + (stats.bytes_transferred or 0),
+        changes=list(changes.values()))
+
+
+def _plan_moves(directory: directories.Directory) -> moves.Plan:
+    logger.log(logging.INFO, "Looking for moved files")
+    plan = moves.Plan.make(directory)
+    logger.log(logging.INFO, "Found %d moved files and directories", len(plan.moves))
+    return plan
+
+
+def _make_moves(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    plan: moves.Plan,
+    *,
+    dry_run: bool,
 ) -> None:
-    """Copy files from the source to the target using rsync."""
+    """Move files on the target that were moved in the source, so rsync finds them unchanged."""
+    current = directory.target_path / constants.CURRENT_SNAPSHOT_NAME
+    if not plan.moves or dry_run or not context.exists(current):
+        return
+    for move in plan.moves:
+        logger.log(logging.DEBUG, "Moving %r to %r", move.source, move.destination)
+    moved = context.move_files(current, [(move.source, move.destination) for move in plan.moves])
+    logger.log(logging.INFO, "Moved %d files and directories on the target", moved)
+
+
+def _rsync_command(*, config: config.Config, dry_run: bool) -> t.List[str]:
+    """The rsync command and the options common to every backup."""
     # The following flags are inspired by python-rsync-system-backup
     command = ['rsync']
 
@@ -78,12 +942,13 @@ def _send_files(
     if verbosity is logging.Verbosity.all:
         # Turn on fairly verbose logging for rsync
         command.append('--verbose')
+        command.append('--info=stats2')
     elif verbosity is logging.Verbosity.silent:
-        # rsync is silent by default
-        pass
+        # The output is not shown, but the statistics are still recorded
+        command.append('--info=stats2')
     else:
         # Some minimal rsync output
-        command.append('--info=progress2,stats')
+        command.append('--info=progress2,stats2')
 
     if dry_run:
         command.append('--dry-run')
@@ -94,66 +959,172 @@ def _send_files(
     command.append('--delete-after')
     command.append('--delete-excluded')
 
-    # The following rsync options are intended to preserve
-    # as much filesystem metadata as possible.
-    command.append('--acls')
-    command.append('--archive')
-    command.append('--hard-links')
+    command.extend(rsync.preserve_options())
     command.append('--fuzzy')
     command.append('--fuzzy')
-    command.append('--numeric-ids')
-    command.append('--xattrs')
+    return command
+
+
+def _rsync_log_options(log_file: pathlib.Path) -> t.List[str]:
+    """
+    Log every change rsync makes to a local file, to be kept as the journal for the snapshot.
+    rsync only logs the files it changes, so this costs next to nothing.
+    """
+    return [f'--log-file={log_file}', f'--log-file-format={journal.RSYNC_LOG_FORMAT}']
+
+
+def _rsync_filter_options(directory: directories.Directory, temporary_directory: pathlib.Path) -> t.List[str]:
+    """
+    The options excluding files from a directory.
+    There can be many directories excluded by markers,
+    so they are written to a file in `temporary_directory` instead of each being an argument.
+    """
+    options = []
 
     # The following rsync option avoids including mounted external
     # drives like USB sticks in system backups.
     if directory.one_file_system:
-        command.append('--one-file-system')
+        options.append('--one-file-system')
 
     # The following rsync options allow user defined exclusion.
     if (exclude_from := directory.resolve_exclude_from()) is not None:
-        command.append('--exclude-from=%s' % exclude_from)
+        options.append('--exclude-from=%s' % exclude_from)
     for pattern in directory.exclude_files:
-        command.append('--exclude=%s' % pattern)
+        options.append('--exclude=%s' % pattern)
+    marked = directory.marked_exclude_patterns()
+    # A pattern for a name with a newline in it can not be written as one line of the file
+    options.extend('--exclude=%s' % pattern for pattern in marked if '\n' in pattern)
+    if listed := [pattern for pattern in marked if '\n' not in pattern]:
+        marked_file = temporary_directory / 'marked'
+        marked_file.write_bytes(b''.join(os.fsencode(pattern) + b'\n' for pattern in listed))
+        options.append('--exclude-from=%s' % marked_file)
+
+    return options
 
+
+def _rsync_scoped_filter_options(
+    directory: directories.Directory,
+    current: pathlib.PurePath,
+) -> t.List[str]:
+    """
+    The exclusion rules for a directory in a batch,
+    rewritten to only match inside `current`, its path relative to the root of the transfer.
+    """
+    options: t.List[str] = []
+    for rule in directory.filter().rules:
+        prefix = '+ ' if rule.include else '- '
+        if rule.pattern.startswith('/'):
+            patterns = [f'/{current}{rule.pattern}']
+        else:
+            # Unanchored patterns can match at the top of the directory, or anywhere below it
+            patterns = [f'/{current}/{rule.pattern}', f'/{current}/**/{rule.pattern}']
+        options.extend(f'--filter={prefix}{pattern}' for pattern in patterns)
+    return options
+
+
+def _rsync_source_and_destination(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+) -> t.List[str]:
+    """The target specific options, then the source and the current snapshot as the destination."""
     current_path = context.make_path(directory.target_path / constants.CURRENT_SNAPSHOT_NAME)
     target_str, target_arguments = directory.target.rsync_arguments(current_path)
+    return [
+        *target_arguments,
+        rsync.ensure_trailing_slash(str(directory.source_path)),
+        rsync.ensure_trailing_slash(target_str),
+    ]
 
-    command.extend(target_arguments)
-    command.append(_ensure_trailing_slash(str(directory.source_path)))
-    command.append(_ensure_trailing_slash(target_str))
 
-    if not context.exists(directory.target_path):
-        logger.log(logging.INFO, "Creating destination directory %r", directory.target_path)
-        if not dry_run:
-            cmd = ["mkdir", "-p", str(context.make_path(directory.target_path))]
-            context.execute(cmd)
+def _send_checksum_differences(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+    dry_run: bool,
+) -> t.List[journal.Change]:
+    """
+    rsync skips files that have the same size and modification time on both sides.
+    If modification times are unreliable, files with different contents can be skipped.
+    Checksum the files that rsync skipped on both sides and send any that differ,
+    like `rsync --checksum` would.
 
-    logger.log(logging.INFO, "Running rsync")
-    logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+    Checksums are cached locally for both the source and the target,
+    keyed by `(device, inode, size, mtime, ctime)` for the source
+    and `(device, inode, size, mtime)` for the target, where snapshots change the ctime,
+    so only files that changed since the last backup need to be read again.
+    Returns the changes made by sending the files that differ.
+    """
+    current = directory.target_path / constants.CURRENT_SNAPSHOT_NAME
+    if not context.exists(current):
+        return []
 
-    # Execute the rsync command.
-    result = subprocess.run(command, check=False)
+    logger.log(logging.INFO, "Comparing checksums of unchanged files")
+    target_stats = {stat.path: stat for stat in digests.stat_tree(context, current)}
+    source_stats = {
+        stat.path: stat
+        for stat in digests.stat_local_tree(
+            directory.source_path, one_file_system=directory.one_file_system)
+    }
+    candidates = [
+        path for path, source in source_stats.items()
+        if (target := target_stats.get(path)) is not None
+        and target.size == source.size and int(target.mtime) == int(source.mtime)
+    ]
 
-    # From `man rsync':
-    #  - 23: Partial transfer due to error.
-    #  - 24: Partial transfer due to vanished source files.
-    # This can be expected on a running system
-    # without proper filesystem snapshots :-).
-    if result.returncode in (0, 23, 24):
-        logger.log(logging.INFO, "Finished backup")
-        if result.returncode != 0:
-            logger.log(
-                logging.WARNING,
-                "Ignoring `partial transfer' warnings (rsync exited with %i).",
-                result.returncode,
-            )
-    else:
-        logger.log(logging.ERROR, "Backup failed! (rsync exited with %i)", result.returncode)
-        raise exceptions.RsyncError("rsync call failed", result.returncode)
+    def hash_source(stats: t.List[digests.FileStat]) -> t.Dict[digests.FileStat, str]:
+        by_path = {directory.source_path / stat.path: stat for stat in stats}
+        found = digests.hash_local_files(by_path.keys(), jobs=CHECKSUM_JOBS)
+        return {by_path[path]: digest for path, digest in found.items()}
+
+    def hash_target(stats: t.List[digests.FileStat]) -> t.Dict[digests.FileStat, str]:
+        by_path = {current / stat.path: stat for stat in stats}
+        found = digests.hash_target_files(context, by_path.keys(), jobs=CHECKSUM_JOBS)
+        return {by_path[path]: digest for path, digest in found.items()}
+
+    with digests.DigestCache.open('local') as source_cache:
+        source_digests = digests.cached_digests(
+            [source_stats[path] for path in candidates], source_cache, hash_source)
+    with digests.DigestCache.open(f'target-{directory.target.name}') as target_cache:
+        target_digests = digests.cached_digests(
+            [target_stats[path] for path in candidates], target_cache, hash_target,
+            key=lambda stat: stat.snapshot_key)
+
+    different = [
+        path for path in candidates
+        if source_stats[path] in source_digests and target_stats[path] in target_digests
+        and source_digests[source_stats[path]] != target_digests[target_stats[path]]
+    ]
+    logger.log(
+        logging.INFO, "%d of %d unchanged files have different contents",
+        len(different), len(candidates))
+    if not different:
+        return []
+
+    with tempfile.TemporaryDirectory(prefix='ryba-checksum-') as temporary_directory:
+        files_from = pathlib.Path(temporary_directory) / 'files'
+        files_from.write_bytes(b''.join(os.fsencode(str(path)) + b'\0' for path in different))
+        log_file = pathlib.Path(temporary_directory) / 'rsync.log'
+
+        command = ['rsync', '--human-readable', '--ignore-times']
+        command.append(f'--files-from={files_from}')
+        command.append('--from0')
+        command.extend(_rsync_log_options(log_file))
+        if config.get(logging.Verbosity) is logging.Verbosity.all:
+            command.append('--verbose')
+        if dry_run:
+            command.append('--dry-run')
+        command.extend(rsync.preserve_options())
+        command.extend(_rsync_filter_options(directory, pathlib.Path(temporary_directory)))
+        command.extend(_rsync_source_and_destination(directory, context))
+
+        logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+        returncode, _ = rsync.run(command, echo=True)
+        rsync.check_returncode(returncode)
+        return journal.parse_rsync_log(log_file.read_bytes() if log_file.exists() else b'')
 
 
-def _ensure_trailing_slash(path: str) -> str:
-    """Ensure a path ends with a slash."""
-    if not path.endswith('/'):
-        return path + '/'
-    return path
+def _parse_rsync_stats(output: bytes) -> targets.TransferStats:
+    """Find the statistics printed by `rsync --info=stats2` in its output."""
+    files_transferred, bytes_transferred = rsync.parse_stats(output)
+    return targets.TransferStats(files_transferred=files_transferred, bytes_transferred=bytes_transferred)
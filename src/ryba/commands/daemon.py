@@ -0,0 +1,224 @@
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import math
+import pathlib
+import threading
+import time
+import typing as t
+
+import attr
+
+from .. import (
+    config, directories, exceptions, history, instrumentation, logging,
+    targets, units)
+from . import backup
+
+logger = logging.getLogger(__name__)
+
+#: The longest the scheduler will sleep for at once.
+#: Waking up regularly means that backups missed while the computer was suspended
+#: are noticed soon after it resumes.
+MAX_SLEEP = 60
+
+
+class ConnectionPool:
+    """
+    Keeps connections to targets open between backups.
+    Each connection is only used by one backup at a time,
+    and connections that have been idle for `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, *, idle_timeout: float):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle: t.Dict[str, t.List[t.Tuple[float, targets.TargetContext]]] = \
+            collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def connection(self, target: targets.Target) -> t.Iterator[targets.TargetContext]:
+        context = self._checkout(target)
+        try:
+            yield context
+        except BaseException:
+            # The connection might be what failed, so don't reuse it
+            self._close(context)
+            raise
+        with self._lock:
+            self._idle[target.name].append((time.monotonic(), context))
+
+    def _checkout(self, target: targets.Target) -> targets.TargetContext:
+        while True:
+            with self._lock:
+                idle = self._idle[target.name]
+                if not idle:
+                    break
+                _, context = idle.pop()
+            try:
+                context.exists(pathlib.Path('/'))
+                return context
+            except Exception:
+                logger.log(logging.INFO, "Connection to %s was lost", target)
+                self._close(context)
+
+        logger.log(logging.INFO, "Connecting to %s", target)
+        return target.connect().__enter__()
+
+    def expire(self) -> None:
+        """Close any connections that have been idle for too long."""
+        cutoff = time.monotonic() - self.idle_timeout
+        expired: t.List[targets.TargetContext] = []
+        with self._lock:
+            for idle in self._idle.values():
+                expired.extend(context for last_used, context in idle if last_used < cutoff)
+                idle[:] = [(last_used, context) for last_used, context in idle if last_used >= cutoff]
+        for context in expired:
+            self._close(context)
+
+    def close(self) -> None:
+        with self._lock:
+            contexts = [context for idle in self._idle.values() for _, context in idle]
+            self._idle.clear()
+        for context in contexts:
+            self._close(context)
+
+    def _close(self, context: targets.TargetContext) -> None:
+        try:
+            context.__exit__(None, None, None)
+        except Exception:
+            logger.log(logging.DEBUG, "Error closing connection", exc_info=True)
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class ScheduledDirectory:
+    directory: directories.Directory
+    cadence: float
+    #: When the next backup should start, as a unix timestamp
+    due: float
+    #: When the currently running backup started
+    started: t.Optional[float] = None
+    running: t.Optional[concurrent.futures.Future] = None
+
+    @property
+    def deadline(self) -> float:
+        """How long after the backup is due that it should be finished by."""
+        if self.directory.deadline is not None:
+            return self.directory.deadline
+        return self.cadence
+
+
+class Scheduler:
+    """
+    Backs up directories whenever they are due, according to their cadence.
+
+    Up to `jobs` directories are backed up at once.
+    When more directories are due than can be backed up,
+    the directories that must start soonest to meet their deadline go first,
+    using the backup history to estimate how long each one will take.
+    Directories with a higher priority win any ties.
+
+    A directory is never backed up twice at the same time.
+    If a backup takes longer than the cadence, the cycles that were missed are skipped.
+    Likewise, after the computer resumes from suspend
+    any overdue directories are backed up once, not once per missed cycle.
+    """
+
+    def __init__(
+        self,
+        directories: t.List[directories.Directory],
+        *,
+        config: config.Config,
+        jobs: int,
+        default_cadence: float,
+        pool: ConnectionPool,
+    ):
+        self.config = config
+        self.jobs = jobs
+        self.pool = pool
+        self.history = config.get(history.History)
+
+        now = time.time()
+        self.scheduled = []
+        for directory in directories:
+            cadence = directory.cadence if directory.cadence is not None else default_cadence
+            last_runs = self.history.directory_runs(directory, limit=1)
+            due = last_runs[0].started + cadence if last_runs else now
+            self.scheduled.append(ScheduledDirectory(directory=directory, cadence=cadence, due=due))
+
+    def run_forever(self) -> None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                self._start_due(executor)
+                self.pool.expire()
+
+                running = [s.running for s in self.scheduled if s.running is not None]
+                timeout = self._sleep_time()
+                if running:
+                    concurrent.futures.wait(
+                        running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+                self._collect_finished()
+
+    def _sleep_time(self) -> float:
+        waiting = [s.due for s in self.scheduled if s.running is None]
+        running = len(self.scheduled) - len(waiting)
+        if not waiting or running >= self.jobs:
+            # Nothing can start until a running backup finishes
+            return MAX_SLEEP
+        return max(0, min(min(waiting) - time.time(), MAX_SLEEP))
+
+    def _latest_start(self, scheduled: ScheduledDirectory) -> float:
+        """The latest time this directory can start and still meet its deadline."""
+        estimate = self.history.estimate_duration(scheduled.directory)
+        duration = estimate.total_seconds() if estimate is not None else 0
+        return scheduled.due + scheduled.deadline - duration
+
+    def _start_due(self, executor: concurrent.futures.Executor) -> None:
+        now = time.time()
+        free = self.jobs - sum(1 for s in self.scheduled if s.running is not None)
+        due = [s for s in self.scheduled if s.running is None and s.due <= now]
+        due.sort(key=lambda s: (self._latest_start(s), -s.directory.priority))
+
+        for scheduled in due[:max(free, 0)]:
+            logger.log(logging.MESSAGE, "Starting scheduled backup of %s", scheduled.directory)
+            scheduled.started = now
+            scheduled.running = executor.submit(self._backup, scheduled.directory)
+
+    def _backup(self, directory: directories.Directory) -> None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        with self.pool.connection(directory.target) as context:
+            backup.backup_directory(
+                directory, config=self.config, timestamp=timestamp,
+                context=instrumentation.instrument(context, self.config))
+
+    def _collect_finished(self) -> None:
+        now = time.time()
+        for scheduled in self.scheduled:
+            if scheduled.running is None or not scheduled.running.done():
+                continue
+            assert scheduled.started is not None
+
+            if (exc := scheduled.running.exception()) is not None:
+                if isinstance(exc, exceptions.CommandError):
+                    logger.log(logging.ERROR, "Backup of %s failed: %s", scheduled.directory, exc.message)
+                else:
+                    logger.log(
+                        logging.ERROR, "Backup of %s failed", scheduled.directory, exc_info=exc)
+
+            if now > scheduled.due + scheduled.deadline:
+                logger.log(
+                    logging.WARNING, "Backup of %s finished %s after its deadline",
+                    scheduled.directory,
+                    units.format_duration(now - scheduled.due - scheduled.deadline))
+
+            # Skip any cycles that would have started while this backup was running
+            cycles = max(1, math.ceil((now - scheduled.started) / scheduled.cadence))
+            if cycles > 1:
+                logger.log(
+                    logging.WARNING, "Backup of %s took longer than its cadence, skipping %d cycles",
+                    scheduled.directory, cycles - 1)
+            scheduled.due = scheduled.started + cycles * scheduled.cadence
+            scheduled.started = None
+            scheduled.running = None
@@ -0,0 +1,126 @@
+"""
+Export a snapshot as a single tar archive, for archiving offline.
+"""
+import contextlib
+import os
+import pathlib
+import sys
+import types
+import typing as t
+
+from .. import directories, instrumentation, logging, targets, units
+from . import snapshot
+
+logger = logging.getLogger(__name__)
+
+#: Commands that compress a tar archive, reading from standard input and writing to standard output
+COMPRESSORS: t.Dict[str, t.Optional[str]] = {
+    'none': None,
+    'gzip': 'gzip',
+    'zstd': 'zstd -T0',
+    'xz': 'xz -T0',
+}
+
+#: The compression to use when exporting to a file with one of these suffixes
+_SUFFIXES = {
+    '.tar': 'none',
+    '.gz': 'gzip', '.tgz': 'gzip',
+    '.zst': 'zstd', '.tzst': 'zstd',
+    '.xz': 'xz', '.txz': 'xz',
+}
+
+
+def guess_compression(output: t.Optional[pathlib.Path]) -> str:
+    """Pick a compression from the suffix of the output file, defaulting to gzip."""
+    if output is not None:
+        return _SUFFIXES.get(output.suffix, 'gzip')
+    return 'gzip'
+
+
+class Volumes:
+    """
+    A file that splits everything written to it in to volumes of at most `size` bytes,
+    named `path.000`, `path.001`, and so on.
+    The volumes can be joined back together with `cat path.* > path`.
+    """
+
+    def __init__(self, path: pathlib.Path, size: int):
+        if size <= 0:
+            raise ValueError("Volume size must be positive")
+        self.path = path
+        self.size = size
+        self.count = 0
+        self._file: t.Optional[t.BinaryIO] = None
+        self._remaining = 0
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        while view:
+            if self._file is None or self._remaining == 0:
+                self._next_volume()
+            assert self._file is not None
+            written = self._file.write(view[:self._remaining])
+            self._remaining -= written
+            view = view[written:]
+        return len(data)
+
+    def _next_volume(self) -> None:
+        self.close()
+        volume = self.path.with_name(f'{self.path.name}.{self.count:03d}')
+        logger.log(logging.INFO, "Writing volume %s", volume)
+        self._file = open(volume, 'wb')
+        self._remaining = self.size
+        self.count += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'Volumes':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: t.Optional[t.Type[BaseException]],
+        exc_value: t.Optional[BaseException],
+        traceback: t.Optional[types.TracebackType],
+    ) -> None:
+        self.close()
+
+
+@contextlib.contextmanager
+def take_stdout() -> t.Iterator[t.BinaryIO]:
+    """
+    Take standard output to write an archive to.
+    Everything else that would be written to standard output,
+    such as log messages and the output of commands, goes to standard error instead
+    for the rest of the run.
+    """
+    sys.stdout.flush()
+    archive = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    with archive:
+        yield archive
+
+
+def export_directory(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    output: t.BinaryIO,
+    *,
+    snapshot_name: t.Optional[str] = None,
+    compression: str = 'gzip',
+) -> None:
+    """
+    Write a snapshot of a directory to `output` as a compressed tar archive,
+    by default the latest snapshot.
+    The archive is streamed from the target, so it can be any size.
+    """
+    chosen = snapshot.find_snapshot(directory, context, snapshot_name)
+    snapshot_path = directory.target_path / chosen.name
+    logger.log(
+        logging.MESSAGE, "Exporting %s:%s", directory.target.name, str(snapshot_path))
+    with instrumentation.phase('export'):
+        size = context.export_snapshot(snapshot_path, output, compressor=COMPRESSORS[compression])
+    logger.log(logging.INFO, "Exported %s", units.format_size(size))
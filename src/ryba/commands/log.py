@@ -0,0 +1,59 @@
+import collections
+import typing as t
+
+from .. import constants, directories, journal, logging, targets
+
+logger = logging.getLogger(__name__)
+
+_SYMBOLS = {
+    journal.CREATED: '+',
+    journal.UPDATED: '~',
+    journal.CHANGED: '.',
+    journal.DELETED: '-',
+}
+
+
+def show_directory_log(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    snapshot_names: t.Optional[t.List[str]] = None,
+    limit: t.Optional[int] = None,
+    summary: bool = False,
+) -> None:
+    """
+    Show what changed in each snapshot of a directory, newest first,
+    using the journal stored in each snapshot.
+    Directories whose contents changed are always updated by rsync,
+    so directories where only the attributes changed are counted but not listed.
+    """
+    backups = sorted(context.list_backups(directory.target_path), reverse=True)
+    if snapshot_names:
+        backups = [backup for backup in backups if backup.name in snapshot_names]
+    if limit is not None:
+        backups = backups[:limit]
+
+    journal_files = context.read_files([
+        directory.target_path / backup.name / constants.JOURNAL_FILE_NAME for backup in backups])
+
+    logger.log(logging.MESSAGE, "%s", directory)
+    if not backups:
+        logger.log(logging.MESSAGE, "  No snapshots found")
+    for backup in backups:
+        data = journal_files[directory.target_path / backup.name / constants.JOURNAL_FILE_NAME]
+        if data is None:
+            logger.log(logging.MESSAGE, "  %s: no changes recorded", backup.name)
+            continue
+
+        changes = journal.load_journal(data)
+        counts = collections.Counter(change.kind for change in changes)
+        logger.log(
+            logging.MESSAGE, "  %s: %d created, %d updated, %d deleted, %d changed attributes",
+            backup.name, counts[journal.CREATED], counts[journal.UPDATED],
+            counts[journal.DELETED], counts[journal.CHANGED])
+        if summary:
+            continue
+        for change in changes:
+            if change.is_dir and change.kind == journal.CHANGED:
+                continue
+            logger.log(logging.MESSAGE, "    %s %s", _SYMBOLS[change.kind], change.path)
@@ -0,0 +1,193 @@
+import collections
+import concurrent.futures
+import contextvars
+import os
+import pathlib
+import shlex
+import stat
+import tempfile
+import typing as t
+
+from .. import (
+    config, constants, digests, directories, exceptions, instrumentation,
+    logging, rsync, targets, units)
+from . import snapshot
+
+logger = logging.getLogger(__name__)
+
+#: How many files to restore at once by default
+RESTORE_JOBS = 4
+
+
+def resolve_paths(directory: directories.Directory, paths: t.Iterable[pathlib.Path]) -> t.List[str]:
+    """
+    Make paths to restore relative to the backed up directory.
+    Absolute paths must be inside the source directory,
+    while relative paths are taken as relative to the source directory.
+    """
+    resolved = []
+    for path in paths:
+        path = path.expanduser()
+        if path.is_absolute():
+            try:
+                path = path.relative_to(directory.source_path)
+            except ValueError:
+                raise exceptions.CommandError(f"{str(path)!r} is not inside {str(directory.source_path)!r}")
+        resolved.append(path.as_posix())
+    return resolved
+
+
+def restore_directory(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    config: config.Config,
+    snapshot_name: t.Optional[str] = None,
+    paths: t.Sequence[str] = (),
+    only: bool = False,
+    destination: t.Optional[pathlib.Path] = None,
+    jobs: int = RESTORE_JOBS,
+    dry_run: bool = False,
+) -> None:
+    """
+    Restore a snapshot of a directory, by default the latest snapshot.
+    Files are restored to the source directory unless another `destination` is given.
+
+    `paths` are restored first, so the most important files come back first,
+    then everything else is restored unless `only` is set.
+    Files that already exist with the same size and modification time are skipped.
+    Up to `jobs` streams of files are restored at once.
+    """
+    chosen = snapshot.find_snapshot(directory, context, snapshot_name)
+    snapshot_path = directory.target_path / chosen.name
+    if destination is None:
+        destination = directory.source_path
+    logger.log(
+        logging.MESSAGE, "Restoring %s:%s to %r",
+        directory.target.name, str(snapshot_path), str(destination))
+
+    def requested(path: str) -> bool:
+        return any(path == wanted or path.startswith(wanted + '/') for wanted in paths)
+
+    if not context.uses_rsync:
+        if dry_run:
+            return
+        destination.mkdir(parents=True, exist_ok=True)
+        if paths:
+            with instrumentation.phase('restore requested'):
+                context.restore_files(snapshot_path, destination, only=requested, jobs=jobs)
+        if not only:
+            with instrumentation.phase('restore'):
+                context.restore_files(snapshot_path, destination, jobs=jobs)
+        return
+
+    for path in paths:
+        if not context.exists(snapshot_path / path):
+            raise exceptions.CommandError(f"{path!r} is not in snapshot {chosen.name}")
+
+    with instrumentation.phase('restore'):
+        files = [
+            file_stat for file_stat in digests.stat_tree(context, snapshot_path)
+            if str(file_stat.path) not in constants.SNAPSHOT_FILE_NAMES
+            and not _matches_local(destination / file_stat.path, file_stat)
+        ]
+    if not dry_run:
+        destination.mkdir(parents=True, exist_ok=True)
+
+    source, target_arguments = directory.target.rsync_arguments(context.make_path(snapshot_path))
+    command = [
+        'rsync', '--human-readable', *rsync.preserve_options(), *target_arguments]
+    if dry_run:
+        command.append('--dry-run')
+    if config.get(logging.Verbosity) is logging.Verbosity.all:
+        command.append('--verbose')
+    source = rsync.ensure_trailing_slash(source)
+    destination_str = rsync.ensure_trailing_slash(str(destination))
+
+    if paths:
+        first = [file_stat for file_stat in files if requested(str(file_stat.path))]
+        logger.log(
+            logging.INFO, "Restoring %d requested files, %s",
+            len(first), units.format_size(sum(file_stat.size for file_stat in first)))
+        _restore_streams(first, command, source, destination_str, jobs=jobs)
+    if not only:
+        rest = [file_stat for file_stat in files if not requested(str(file_stat.path))]
+        logger.log(
+            logging.INFO, "Restoring %d files, %s",
+            len(rest), units.format_size(sum(file_stat.size for file_stat in rest)))
+        _restore_streams(rest, command, source, destination_str, jobs=jobs)
+
+    # The streams only restore regular files.
+    # One last rsync restores everything else, such as directories, symlinks, and
+    # the metadata of directories, and will find that every file is already up to date.
+    logger.log(logging.INFO, "Restoring directories and links")
+    with tempfile.TemporaryDirectory(prefix='ryba-restore-') as temporary_directory:
+        final = [*command, *(f'--exclude=/{name}' for name in constants.SNAPSHOT_FILE_NAMES)]
+        if only:
+            files_from = pathlib.Path(temporary_directory) / 'paths'
+            files_from.write_bytes(b''.join(os.fsencode(path) + b'\0' for path in paths))
+            final.extend([f'--files-from={files_from}', '--from0', '--recursive'])
+        final.extend([source, destination_str])
+        logger.log(logging.DEBUG, "$ %s", shlex.join(final))
+        returncode, _ = rsync.run(final, echo=True)
+    rsync.check_returncode(returncode, action="Restore")
+
+
+def _matches_local(path: pathlib.Path, file_stat: digests.FileStat) -> bool:
+    """Is there already a file at `path` that rsync would consider the same as this one?"""
+    try:
+        local = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISREG(local.st_mode)
+        and local.st_size == file_stat.size
+        and int(local.st_mtime) == int(file_stat.mtime))
+
+
+def _partition(files: t.List[digests.FileStat], count: int) -> t.List[t.List[digests.FileStat]]:
+    """
+    Split files in to at most `count` streams of about the same size.
+    Hard linked files are kept in the same stream, so rsync can link them again.
+    """
+    groups: t.Dict[t.Tuple[int, int], t.List[digests.FileStat]] = collections.defaultdict(list)
+    for file_stat in files:
+        groups[file_stat.inode_key].append(file_stat)
+
+    streams: t.List[t.List[digests.FileStat]] = [[] for _ in range(count)]
+    sizes = [0] * count
+    for group in sorted(groups.values(), key=lambda group: group[0].size, reverse=True):
+        smallest = sizes.index(min(sizes))
+        streams[smallest].extend(group)
+        sizes[smallest] += group[0].size
+    return [stream for stream in streams if stream]
+
+
+def _restore_streams(
+    files: t.List[digests.FileStat],
+    command: t.List[str],
+    source: str,
+    destination: str,
+    *,
+    jobs: int,
+) -> None:
+    """Restore files using up to `jobs` rsync processes at once, each with its own list of files."""
+    streams = _partition(files, jobs)
+    if not streams:
+        return
+    with tempfile.TemporaryDirectory(prefix='ryba-restore-') as temporary_directory, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        futures = []
+        for index, stream in enumerate(streams):
+            files_from = pathlib.Path(temporary_directory) / f'stream-{index}'
+            files_from.write_bytes(b''.join(
+                os.fsencode(str(file_stat.path)) + b'\0' for file_stat in stream))
+            stream_command = [
+                *command, f'--files-from={files_from}', '--from0', source, destination]
+            logger.log(logging.DEBUG, "$ %s", shlex.join(stream_command))
+            # Each stream is attributed to the current directory and phase
+            futures.append(executor.submit(
+                contextvars.copy_context().run, rsync.run, stream_command, echo=False))
+        for future in futures:
+            returncode, _ = future.result()
+            rsync.check_returncode(returncode, action="Restore")
@@ -1,7 +1,11 @@
 import datetime
+import pathlib
+import shlex
 import typing as t
 
-from .. import directories, logging, rotators, targets
+from .. import (
+    constants, digests, directories, exceptions, logging, rotators, rsync,
+    targets)
 
 logger = logging.getLogger(__name__)
 
@@ -14,18 +18,20 @@ def rotate_directory(
     *,
     timestamp: datetime.datetime,
     dry_run: bool = False,
-) -> None:
+) -> t.List[TBackupVerdict]:
     """
     Rotate the existing snapshots for this directory,
     using the configured rotator for the directory.
+    Returns the verdicts for each snapshot,
+    or an empty list if the backups were not rotated.
     """
     if directory.rotate is None:
         logger.log(logging.INFO, "Not rotating backups: no rotator configured")
-        return
+        return []
 
     if (reason := directory.rotate.should_rotate()) is not True:
         logger.log(logging.INFO, f"Not rotating backups: {reason}")
-        return
+        return []
 
     logger.log(logging.INFO, f"Rotating backups using '{directory.rotate}' strategy")
     backups = list(context.list_backups(directory.target_path))
@@ -38,11 +44,14 @@ def rotate_directory(
             name=directory.snapshot_name(timestamp),
             timestamp=timestamp))
 
-    verdicts = sorted(directory.rotate.rotate_backups(timestamp, backups))
+    rotator = directory.rotate.inspect(context, directory.target_path, backups)
+    verdicts = sorted(rotator.rotate_backups(timestamp, backups))
     for message in map(format_verdict_tuple, verdicts):
         logger.log(logging.INFO, message)
     if not dry_run:
         delete_snapshots(directory, context, verdicts)
+        migrate_snapshots(directory, context, rotator, verdicts, timestamp=timestamp)
+    return verdicts
 
 
 def format_verdict_tuple(verdict_tuple: TBackupVerdict) -> t.Iterable[str]:
@@ -56,8 +65,125 @@ def delete_snapshots(
     context: targets.TargetContext,
     verdicts: t.List[TBackupVerdict],
 ) -> None:
-    for backup, verdict, explanation in sorted(verdicts):
-        if verdict is rotators.Verdict.drop:
-            entry_path = context.make_path(directory.target_path / backup.name)
-            context.execute(["chmod", "-R", "u+wX", str(entry_path)])
-            context.execute(["rm", "-rf", str(entry_path)])
+    names = [
+        backup.name for backup, verdict, explanation in sorted(verdicts)
+        if verdict is rotators.Verdict.drop
+    ]
+    if names:
+        context.delete_snapshots(directory.target_path, names)
+
+
+def migrate_snapshots(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    rotator: rotators.Rotator,
+    verdicts: t.List[TBackupVerdict],
+    *,
+    timestamp: datetime.datetime,
+) -> None:
+    """
+    Move the snapshots with the verdict `Verdict.migrate` to the cold target of the rotator.
+    Each snapshot is only deleted from this target once the copy on the cold target is verified.
+    The snapshots already on the cold target are then rotated by the rotator for that target.
+    """
+    backups = sorted(backup for backup, verdict, explanation in verdicts if verdict is rotators.Verdict.migrate)
+    if not backups:
+        return
+    if (cold_target := rotator.migrate_target()) is None:
+        raise exceptions.CommandError(f"Rotator {str(rotator)!r} has no target to migrate snapshots to")
+    if not isinstance(directory.target, targets.Local) and not isinstance(cold_target, targets.Local):
+        raise exceptions.CommandError(
+            f"Can not migrate snapshots from {directory.target.name} to {cold_target.name}: "
+            "one of the targets must be local")
+
+    with cold_target.connect() as cold_context:
+        if not cold_context.uses_rsync:
+            raise exceptions.CommandError(
+                f"Can not migrate snapshots to {cold_target.name}, it does not store plain files")
+        for snapshot in backups:
+            migrate_snapshot(directory, context, cold_target, cold_context, snapshot)
+            context.delete_snapshots(directory.target_path, [snapshot.name])
+
+        if (cold_rotator := rotator.migrated_rotator()) is not None and cold_rotator.should_rotate() is True:
+            logger.log(logging.INFO, "Rotating migrated backups on %s", cold_target.name)
+            cold_backups = list(cold_context.list_backups(directory.target_path))
+            cold_rotator = cold_rotator.inspect(cold_context, directory.target_path, cold_backups)
+            cold_verdicts = sorted(cold_rotator.rotate_backups(timestamp, cold_backups))
+            for message in map(format_verdict_tuple, cold_verdicts):
+                logger.log(logging.INFO, message)
+            delete_snapshots(directory, cold_context, cold_verdicts)
+
+
+def migrate_snapshot(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    cold_target: targets.Target,
+    cold_context: targets.TargetContext,
+    snapshot: targets.Backup,
+) -> None:
+    """
+    Copy one snapshot to the same path on the cold target, and check the copy.
+    Files that have not changed since a snapshot already on the cold target are hard linked to it.
+    The timestamp file is written last, so a copy that was interrupted is not listed as a backup,
+    and is finished off the next time the snapshot is migrated.
+    """
+    path = directory.target_path / snapshot.name
+    timestamp_path = path / constants.TIMESTAMP_FILE_NAME
+    migrated = (
+        sorted(cold_context.list_backups(directory.target_path))
+        if cold_context.exists(directory.target_path) else [])
+
+    if snapshot.name not in {backup.name for backup in migrated}:
+        logger.log(logging.INFO, "Migrating snapshot %s to %s", snapshot.name, cold_target.name)
+        if not cold_context.exists(directory.target_path):
+            cold_context.execute(["mkdir", "-p", str(cold_context.make_path(directory.target_path))])
+        source, source_arguments = directory.target.rsync_arguments(context.make_path(path))
+        destination, destination_arguments = cold_target.rsync_arguments(cold_context.make_path(path))
+        command = [
+            'rsync', '--human-readable', *rsync.preserve_options(),
+            *source_arguments, *destination_arguments,
+            f'--exclude=/{constants.TIMESTAMP_FILE_NAME}',
+        ]
+        # Share files with the closest snapshot already migrated
+        if (link := _closest(snapshot, migrated)) is not None:
+            link_path = cold_context.make_path(directory.target_path / link.name)
+            command.append(f'--link-dest={link_path}')
+        command.extend([rsync.ensure_trailing_slash(source), rsync.ensure_trailing_slash(destination)])
+        logger.log(logging.DEBUG, "$ %s", shlex.join(command))
+        returncode, _ = rsync.run(command, echo=False)
+        rsync.check_returncode(returncode, action="Migration")
+
+    _verify_migration(directory, context, cold_context, path)
+    cold_context.write_file(timestamp_path, context.read_file(timestamp_path))
+
+
+def _closest(snapshot: targets.Backup, migrated: t.List[targets.Backup]) -> t.Optional[targets.Backup]:
+    """The latest migrated snapshot older than `snapshot`, or failing that the oldest one."""
+    older = [backup for backup in migrated if backup < snapshot]
+    if older:
+        return older[-1]
+    return migrated[0] if migrated else None
+
+
+def _verify_migration(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    cold_context: targets.TargetContext,
+    path: pathlib.Path,
+) -> None:
+    """Check every file in a snapshot made it to the cold target with the same size and modification time."""
+    def files(context: targets.TargetContext) -> t.Dict[pathlib.PurePosixPath, t.Tuple[int, int]]:
+        return {
+            file_stat.path: (file_stat.size, int(file_stat.mtime))
+            for file_stat in digests.stat_tree(context, path)
+            if str(file_stat.path) not in constants.SNAPSHOT_FILE_NAMES
+        }
+
+    hot_files = files(context)
+    cold_files = files(cold_context)
+    if hot_files != cold_files:
+        different = sorted(set(hot_files.items()) ^ set(cold_files.items()))
+        raise exceptions.CommandError(
+            f"The copy of {directory.target.name}:{str(path)!r} on {cold_context.target.name} "
+            f"does not match, starting with {str(different[0][0])!r}. "
+            "The snapshot has been kept.")
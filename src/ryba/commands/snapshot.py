@@ -1,6 +1,7 @@
 import datetime
+import typing as t
 
-from .. import constants, directories, logging, targets
+from .. import constants, directories, exceptions, journal, logging, targets
 
 logger = logging.getLogger(__name__)
 
@@ -11,9 +12,11 @@ def create_snapshot(
     *,
     timestamp: datetime.datetime,
     dry_run: bool,
+    changes: t.Optional[t.List[journal.Change]] = None,
 ) -> None:
     """
     Create a snapshot of the current backup for this Directory.
+    If the `changes` made by this backup are known, they are stored in the snapshot.
     """
     target_directory = directory.target_path
     snapshot_name = directory.snapshot_name(timestamp)
@@ -21,12 +24,28 @@ def create_snapshot(
     snapshot = target_directory / snapshot_name
     logger.log(logging.INFO, "Creating snapshot %s", snapshot_name)
 
-    cmd = [
-        "cp", "--archive", "--link", "--no-target-directory", "--force",
-        str(context.make_path(current)), str(context.make_path(snapshot)),
-    ]
     if not dry_run:
-        context.execute(cmd)
+        context.create_snapshot(current, snapshot)
         context.write_file(
             snapshot / constants.TIMESTAMP_FILE_NAME,
             timestamp.isoformat().encode())
+        if changes is not None:
+            context.write_file(
+                snapshot / constants.JOURNAL_FILE_NAME, journal.dump_journal(changes))
+
+
+def find_snapshot(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    name: t.Optional[str] = None,
+) -> targets.Backup:
+    """Find a snapshot of this Directory by name, or the latest snapshot if no name is given."""
+    backups = sorted(context.list_backups(directory.target_path))
+    if not backups:
+        raise exceptions.CommandError(f"No snapshots found for {directory}")
+    if name is None:
+        return backups[-1]
+    for backup in backups:
+        if backup.name == name:
+            return backup
+    raise exceptions.CommandError(f"No snapshot named {name!r} for {directory}")
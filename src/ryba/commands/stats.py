@@ -0,0 +1,97 @@
+import datetime
+import statistics
+import typing as t
+
+from .. import directories, history, logging, units
+
+logger = logging.getLogger(__name__)
+
+#: Runs that take this many times longer than the median run are reported
+OUTLIER_FACTOR = 2
+#: ... as long as they also took at least this many seconds longer
+OUTLIER_MINIMUM = 60
+
+#: How many of the most recent runs are compared with the older runs to find a trend
+RECENT_RUNS = 5
+
+
+def show_directory_stats(
+    directory: directories.Directory,
+    backup_history: history.History,
+    *,
+    limit: int,
+) -> None:
+    """
+    Summarise the recorded runs of this directory: durations, transfer sizes,
+    trends, and any runs that failed or took much longer than usual.
+    """
+    logger.log(logging.MESSAGE, "%s", directory)
+    runs = backup_history.directory_runs(directory, limit=limit)
+    if not runs:
+        logger.log(logging.MESSAGE, "  No runs recorded")
+        return
+
+    successful = [run for run in runs if run.status == history.STATUS_OK]
+    latest = runs[0]
+    logger.log(
+        logging.MESSAGE, "  %d runs, %d failed. Last run %s: %s",
+        len(runs), len(runs) - len(successful), _format_time(latest.started), latest.status)
+    if not successful:
+        return
+
+    durations = [run.duration for run in successful if run.duration is not None]
+    median_duration = statistics.median(durations)
+    logger.log(
+        logging.MESSAGE, "  Duration: median %s%s",
+        units.format_duration(median_duration), _format_trend(durations))
+
+    transferred = [run.bytes_transferred for run in successful if run.bytes_transferred is not None]
+    files = [run.files_transferred for run in successful if run.files_transferred is not None]
+    if transferred and files:
+        logger.log(
+            logging.MESSAGE, "  Transferred: median %s in %d files%s",
+            units.format_size(statistics.median(transferred)),
+            statistics.median(files), _format_trend(transferred))
+
+    phase_names = sorted({name for run in successful for name in run.phases})
+    if phase_names:
+        logger.log(logging.MESSAGE, "  Phases: %s", ", ".join(
+            f"{name} {units.format_duration(statistics.median(run.phases.get(name, 0) for run in successful))}"
+            for name in phase_names
+        ))
+
+    outliers = [
+        run for run in runs
+        if run.status != history.STATUS_OK
+        or (
+            run.duration is not None
+            and run.duration > median_duration * OUTLIER_FACTOR
+            and run.duration > median_duration + OUTLIER_MINIMUM
+        )
+    ]
+    if outliers:
+        logger.log(logging.MESSAGE, "  Outliers:")
+    for run in outliers:
+        if run.status != history.STATUS_OK:
+            logger.log(logging.MESSAGE, "    - %s: %s", _format_time(run.started), run.status)
+        elif run.duration is not None:
+            logger.log(
+                logging.MESSAGE, "    - %s: took %s, median is %s",
+                _format_time(run.started), units.format_duration(run.duration),
+                units.format_duration(median_duration))
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+def _format_trend(values: t.Sequence[float]) -> str:
+    """
+    Compare the most recent values with the older values.
+    `values` should be sorted newest first.
+    """
+    recent, older = values[:RECENT_RUNS], values[RECENT_RUNS:]
+    if not older or statistics.median(older) == 0:
+        return ""
+    change = statistics.median(recent) / statistics.median(older) - 1
+    return f", recently {change:+.0%}"
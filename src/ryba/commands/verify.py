@@ -0,0 +1,171 @@
+import collections
+import pathlib
+import random
+import typing as t
+
+import attr
+
+from .. import constants, digests, directories, exceptions, logging, targets
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Problem:
+    path: pathlib.Path
+    message: str
+
+    def __str__(self) -> str:
+        return f"{str(self.path)!r}: {self.message}"
+
+
+def verify_directory(
+    directory: directories.Directory,
+    *,
+    jobs: int,
+    snapshot_names: t.Optional[t.List[str]] = None,
+    sample: t.Optional[float] = None,
+    full: bool = False,
+) -> t.List[Problem]:
+    """
+    Checksum the contents of the snapshots for this directory,
+    and report any files that have changed since they were last checksummed,
+    or that differ from the source.
+    """
+    with directory.target.connect() as context:
+        return verify_directory_with_context(
+            directory, context, jobs=jobs,
+            snapshot_names=snapshot_names, sample=sample, full=full)
+
+
+def verify_directory_with_context(
+    directory: directories.Directory,
+    context: targets.TargetContext,
+    *,
+    jobs: int,
+    snapshot_names: t.Optional[t.List[str]] = None,
+    sample: t.Optional[float] = None,
+    full: bool = False,
+) -> t.List[Problem]:
+    """
+    Every snapshot shares most of its inodes with the other snapshots,
+    so each inode is only checksummed once no matter how many snapshots it appears in.
+    Checksums are cached between runs keyed by `(device, inode, size, mtime)`.
+    Inodes that have been checksummed before are skipped,
+    unless `full` is set or they are picked as part of a random `sample`,
+    a percentage of the already checksummed bytes.
+    A cached checksum that no longer matches the file indicates that
+    the file was damaged on the target.
+    """
+    logger.log(logging.MESSAGE, "Verifying %s", directory)
+    if not context.uses_rsync:
+        raise exceptions.VerifyError(
+            f"Can not verify {directory}: target {directory.target.name} does not store plain files")
+
+    if snapshot_names is None:
+        backups = sorted(context.list_backups(directory.target_path))
+        snapshot_names = [constants.CURRENT_SNAPSHOT_NAME] + [b.name for b in backups]
+
+    # Every location an inode can be found at
+    locations: t.Dict[t.Tuple[int, int], t.List[pathlib.Path]] = collections.defaultdict(list)
+    stats: t.Dict[t.Tuple[int, int], digests.FileStat] = {}
+    for name in snapshot_names:
+        logger.log(logging.INFO, "Scanning %s", name)
+        for stat in digests.stat_tree(context, directory.target_path / name):
+            locations[stat.inode_key].append(pathlib.Path(name) / stat.path)
+            stats.setdefault(stat.inode_key, stat)
+
+    problems: t.List[Problem] = []
+    with digests.DigestCache.open(f'verify-{directory.target.name}') as cache:
+        def cache_key(stat: digests.FileStat) -> t.Tuple[int, int, int, int]:
+            return (stat.device, stat.inode, stat.size, int(stat.mtime))
+
+        known = {key: cache.get(cache_key(stat)) for key, stat in stats.items()}
+        to_hash = [key for key, digest in known.items() if digest is None or full]
+        if sample is not None and not full:
+            to_hash.extend(_sample_inodes(
+                [key for key, digest in known.items() if digest is not None],
+                stats, sample))
+
+        logger.log(
+            logging.INFO, "Checksumming %d of %d files (%s bytes)",
+            len(to_hash), len(stats), sum(stats[key].size for key in to_hash))
+        paths = {directory.target_path / locations[key][0]: key for key in to_hash}
+        found = digests.hash_target_files(context, paths.keys(), jobs=jobs)
+
+        hashed: t.Dict[t.Tuple[int, int], str] = {}
+        for path, key in paths.items():
+            if path not in found:
+                problems.append(Problem(path=locations[key][0], message="Could not be read"))
+                continue
+            digest = hashed[key] = found[path]
+            if (previous := known[key]) is None:
+                cache.set(cache_key(stats[key]), digest)
+            elif previous != digest:
+                # The recorded checksum is kept so the damage is reported again next time
+                problems.extend(
+                    Problem(path=location, message="Contents changed since last verified")
+                    for location in locations[key])
+
+    problems.extend(_compare_with_source(directory, stats, locations, hashed, jobs=jobs))
+
+    for problem in problems:
+        logger.log(logging.WARNING, "  - %s", problem)
+    logger.log(
+        logging.MESSAGE, "Checksummed %d files, found %d problems",
+        len(hashed), len(problems))
+    return problems
+
+
+def _sample_inodes(
+    candidates: t.List[t.Tuple[int, int]],
+    stats: t.Mapping[t.Tuple[int, int], digests.FileStat],
+    percentage: float,
+) -> t.List[t.Tuple[int, int]]:
+    """Pick a random set of inodes totalling `percentage` of the candidates' bytes."""
+    candidates = list(candidates)
+    random.shuffle(candidates)
+    budget = sum(stats[key].size for key in candidates) * percentage / 100
+    picked = []
+    for key in candidates:
+        if budget <= 0:
+            break
+        picked.append(key)
+        budget -= stats[key].size
+    return picked
+
+
+def _compare_with_source(
+    directory: directories.Directory,
+    stats: t.Mapping[t.Tuple[int, int], digests.FileStat],
+    locations: t.Mapping[t.Tuple[int, int], t.List[pathlib.Path]],
+    hashed: t.Mapping[t.Tuple[int, int], str],
+    *,
+    jobs: int,
+) -> t.Iterable[Problem]:
+    """
+    Compare files in the current snapshot with the source.
+    rsync skips files with a matching size and modification time,
+    so a file like that with different contents will never be fixed by a backup.
+    Only files checksummed in this run are compared.
+    """
+    current = pathlib.Path(constants.CURRENT_SNAPSHOT_NAME)
+    candidates: t.Dict[pathlib.Path, t.Tuple[pathlib.Path, str]] = {}
+    for key, digest in hashed.items():
+        stat = stats[key]
+        for location in locations[key]:
+            if location.parts[0] != current.name:
+                continue
+            source = directory.source_path / location.relative_to(current)
+            try:
+                source_stat = source.stat()
+            except OSError:
+                continue
+            if source_stat.st_size == stat.size and int(source_stat.st_mtime) == int(stat.mtime):
+                candidates[source] = (location, digest)
+
+    source_digests = digests.hash_local_files(candidates.keys(), jobs=jobs)
+    for source, digest in source_digests.items():
+        location, target_digest = candidates[source]
+        if digest != target_digest:
+            yield Problem(path=location, message="Contents differ from the source")
@@ -13,6 +13,16 @@ def get_default_config_path() -> pathlib.Path:
     return xdg.xdg_config_home() / 'ryba' / 'config.toml'
 
 
+def get_data_path() -> pathlib.Path:
+    """The directory to store persistent data in, such as the backup history."""
+    return xdg.xdg_data_home() / 'ryba'
+
+
+def get_cache_path() -> pathlib.Path:
+    """The directory to store caches in. These can be deleted at any time."""
+    return xdg.xdg_cache_home() / 'ryba'
+
+
 class Configurable(abc.ABC):
     @classmethod
     @abc.abstractmethod
@@ -32,7 +42,31 @@ class Config:
     DEFAULTS = {
         'ryba': {
             'verbosity': 1,
-        }
+        },
+        'daemon': {
+            'jobs': 2,
+            'cadence': '1d',
+            'keep_connections': '10m',
+        },
+        'batch': {
+            'max_size': 0,
+        },
+        'governor': {
+            'nice': 0,
+            'interval': '5s',
+        },
+        'lock': {
+            'wait': '0s',
+            'lease': '10m',
+        },
+        'preflight': {
+            'estimate': 'history',
+            'reserve': 0,
+        },
+        'seed': {
+            'enabled': True,
+            'compression': 'none',
+        },
     }
 
     _config: t.Mapping[str, t.Any]
@@ -114,9 +148,9 @@ class NestedChainMap(collections.ChainMap):
             if len(_items) == 0:
                 return prototype
 
-            return NestedChainMap(prototype, *items)
+            return NestedChainMap(prototype, *_items)
 
-        if isinstance(prototype, t.Iterable):
+        if isinstance(prototype, t.Iterable) and not isinstance(prototype, str):
             return list(itertools.chain(prototype, *items))
 
         return prototype  # type: ignore
@@ -6,3 +6,29 @@ EXCLUDE_FROM_FILE_NAME = '.rsync-exclude'
 
 #: The name of the timestamp file in a snapshot directory
 TIMESTAMP_FILE_NAME = '.backup-timestamp'
+
+#: The name of the file in a snapshot directory listing the changes made by that backup
+JOURNAL_FILE_NAME = '.backup-changes.gz'
+
+#: Files that ryba keeps in each snapshot, which are not part of the backed up directory
+SNAPSHOT_FILE_NAMES = [TIMESTAMP_FILE_NAME, JOURNAL_FILE_NAME]
+
+#: The name of the manifest file in a snapshot directory,
+#: for targets that store snapshots as a manifest
+MANIFEST_FILE_NAME = '.backup-manifest.gz'
+
+#: The name of the directory that content-addressed objects are stored in
+OBJECTS_DIRECTORY_NAME = '.objects'
+
+
+#: The name of the directory next to the snapshots of a directory that ryba keeps its own state in.
+#: Like every name starting with a dot, it is never taken for a snapshot.
+STATE_DIRECTORY_NAME = '.ryba'
+
+#: The name of the file in the state directory
+#: recording which run of ryba is backing up a directory, see `locks`
+LOCK_FILE_NAME = 'lock'
+
+#: The name of the file in the state directory of a directory backed up to many targets,
+#: naming the last rsync batch that the current snapshot matches
+FAN_OUT_STATE_FILE_NAME = 'fan-out'
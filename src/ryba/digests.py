@@ -0,0 +1,250 @@
+"""
+Checksum files on the local machine and on targets,
+and remember the checksums between runs.
+"""
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import sqlite3
+import stat as stat_module
+import types
+import typing as t
+
+import attr
+
+from . import config, targets
+
+#: How many files to checksum with each remote command
+HASH_BATCH_SIZE = 256
+
+#: How much of a file to read at a time when checksumming locally
+READ_SIZE = 1 << 20
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class FileStat:
+    """
+    The interesting parts of a `stat()` of a regular file.
+    `path` is relative to the directory that was scanned.
+    """
+    path: pathlib.PurePosixPath
+    device: int
+    inode: int
+    size: int
+    mtime: float
+    ctime: float
+
+    @property
+    def inode_key(self) -> t.Tuple[int, int]:
+        return (self.device, self.inode)
+
+    @property
+    def change_key(self) -> t.Tuple[int, int, int, float, float]:
+        """A key that will be different if the contents of the file change."""
+        return (self.device, self.inode, self.size, self.mtime, self.ctime)
+
+    @property
+    def snapshot_key(self) -> t.Tuple[int, int, int, float]:
+        """
+        A key for a file in the snapshots on a target.
+        Making or deleting a snapshot adds or removes a hard link to every file,
+        which changes the ctime of every file, so only the mtime is used.
+        """
+        return (self.device, self.inode, self.size, self.mtime)
+
+
+def stat_tree(context: targets.TargetContext, path: pathlib.Path) -> t.List[FileStat]:
+    """
+    Find every regular file under `path` on the target.
+    This is done with one `find` command, regardless of the number of files.
+    """
+    output = context.check_output([
+        'find', str(context.make_path(path)), '-type', 'f',
+        '-printf', '%D\\t%i\\t%s\\t%T@\\t%C@\\t%P\\0',
+    ])
+    stats = []
+    for record in output.split(b'\0'):
+        if not record:
+            continue
+        device, inode, size, mtime, ctime, name = record.split(b'\t', 5)
+        stats.append(FileStat(
+            path=pathlib.PurePosixPath(os.fsdecode(name)),
+            device=int(device), inode=int(inode), size=int(size),
+            mtime=float(mtime), ctime=float(ctime),
+        ))
+    return stats
+
+
+def stat_local_tree(path: pathlib.Path, *, one_file_system: bool = False) -> t.List[FileStat]:
+    """
+    Find every regular file under the local directory `path`.
+    If `one_file_system` is set, directories on other file systems are skipped.
+    """
+    root_device = path.stat().st_dev
+    stats = []
+    stack = [str(path)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat_module.S_ISDIR(stat.st_mode):
+                    if not one_file_system or stat.st_dev == root_device:
+                        stack.append(entry.path)
+                elif stat_module.S_ISREG(stat.st_mode):
+                    stats.append(FileStat(
+                        path=pathlib.PurePosixPath(os.path.relpath(entry.path, path)),
+                        device=stat.st_dev, inode=stat.st_ino, size=stat.st_size,
+                        mtime=stat.st_mtime, ctime=stat.st_ctime,
+                    ))
+    return stats
+
+
+def hash_target_files(
+    context: targets.TargetContext,
+    paths: t.Iterable[pathlib.Path],
+    *,
+    jobs: int,
+) -> t.Dict[pathlib.Path, str]:
+    """
+    Checksum files on the target using `sha256sum`.
+    Files are checksummed in batches, with up to `jobs` batches running at once.
+    Files that could not be read are missing from the returned mapping.
+    """
+    paths = list(paths)
+    batches = [paths[i:i + HASH_BATCH_SIZE] for i in range(0, len(paths), HASH_BATCH_SIZE)]
+
+    def hash_batch(batch: t.List[pathlib.Path]) -> t.Dict[pathlib.Path, str]:
+        full_paths = {str(context.make_path(path)): path for path in batch}
+        # Unreadable files are reported on stderr and left out of the output,
+        # but should not stop the other files in the batch being checksummed.
+        output = context.check_output([
+            'sh', '-c', 'sha256sum --zero -- "$@" || true', 'sha256sum',
+            *full_paths.keys(),
+        ])
+        digests = {}
+        for line in output.split(b'\0'):
+            if not line:
+                continue
+            digest, _, name = line.partition(b'  ')
+            digests[full_paths[os.fsdecode(name)]] = digest.decode()
+        return digests
+
+    results: t.Dict[pathlib.Path, str] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for digests in executor.map(hash_batch, batches):
+            results.update(digests)
+    return results
+
+
+def hash_local_file(path: pathlib.Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_local_files(
+    paths: t.Iterable[pathlib.Path],
+    *,
+    jobs: int,
+) -> t.Dict[pathlib.Path, str]:
+    """
+    Checksum local files using a pool of `jobs` threads.
+    Files that could not be read are missing from the returned mapping.
+    """
+    def hash_file(path: pathlib.Path) -> t.Tuple[pathlib.Path, t.Optional[str]]:
+        try:
+            return path, hash_local_file(path)
+        except OSError:
+            return path, None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return {
+            path: digest
+            for path, digest in executor.map(hash_file, paths)
+            if digest is not None
+        }
+
+
+class DigestCache:
+    """
+    A persistent mapping of keys to checksums, stored in a SQLite database
+    in the cache directory.
+
+    Callers pick what goes into a key, usually a tuple of `stat()` fields
+    that will change if the file contents change.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS digests (key TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+
+    @classmethod
+    def open(cls, name: str) -> 'DigestCache':
+        return cls(config.get_cache_path() / 'digests' / f'{name}.sqlite')
+
+    def __enter__(self) -> 'DigestCache':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: t.Optional[t.Type[BaseException]],
+        exc_value: t.Optional[BaseException],
+        traceback: t.Optional[types.TracebackType],
+    ) -> None:
+        if exc_type is None:
+            self._db.commit()
+        self._db.close()
+
+    @staticmethod
+    def _key(key: t.Tuple[t.Any, ...]) -> str:
+        return ':'.join(map(str, key))
+
+    def get(self, key: t.Tuple[t.Any, ...]) -> t.Optional[str]:
+        row = self._db.execute(
+            "SELECT digest FROM digests WHERE key = ?", (self._key(key),)).fetchone()
+        return None if row is None else t.cast(str, row[0])
+
+    def set(self, key: t.Tuple[t.Any, ...], digest: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO digests (key, digest) VALUES (?, ?)",
+            (self._key(key), digest))
+
+
+def cached_digests(
+    stats: t.Iterable[FileStat],
+    cache: DigestCache,
+    hasher: t.Callable[[t.List[FileStat]], t.Dict[FileStat, str]],
+    *,
+    key: t.Callable[[FileStat], t.Tuple[t.Any, ...]] = lambda stat: stat.change_key,
+) -> t.Dict[FileStat, str]:
+    """
+    Find the checksum of each file, using the cached checksum if the file has not changed
+    according to `key`, which defaults to `FileStat.change_key`.
+    `hasher` is called to checksum all the other files.
+    """
+    results = {}
+    to_hash = []
+    for stat in stats:
+        if (digest := cache.get(key(stat))) is not None:
+            results[stat] = digest
+        else:
+            to_hash.append(stat)
+
+    if to_hash:
+        for stat, digest in hasher(to_hash).items():
+            cache.set(key(stat), digest)
+            results[stat] = digest
+    return results
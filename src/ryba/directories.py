@@ -1,10 +1,13 @@
 import datetime
+import hashlib
 import pathlib
+import shlex
 import typing as t
 
 import attr
 
-from . import config, constants, exceptions, rotators, targets
+from . import (
+    config, constants, exceptions, filters, markers, rotators, targets, units)
 
 
 @attr.s(auto_attribs=True, kw_only=True, )
@@ -16,15 +19,53 @@ class Directory:
 
     exclude_from: t.Optional[pathlib.Path] = None
     exclude_files: t.List[str] = attr.ib(factory=list)
+    #: Exclude directories marked as caches or build output, see `markers`
+    exclude_markers: t.List[markers.Marker] = attr.ib(factory=list)
 
     one_file_system: bool = True
+    #: Compare the contents of files that rsync considers unchanged
+    checksum: bool = False
+    #: Move files on the target that were moved in the source before rsync runs, see `moves`
+    detect_moves: bool = False
+
+    #: Back up what this command prints instead of a directory, see `backup._send_command_output()`
+    command: t.Optional[t.List[str]] = None
+    #: The name of the file in each snapshot that the output of `command` is written to
+    output: t.Optional[str] = None
+    #: How to compress the output of `command`, one of `export.COMPRESSORS`
+    compression: str = 'none'
+
+    #: How often to back up this directory when running as a daemon, in seconds
+    cadence: t.Optional[float] = None
+    #: Directories with a higher priority are backed up first
+    priority: int = 0
+    #: How long after a backup is due that it should be finished by, in seconds
+    deadline: t.Optional[float] = None
+    #: Directories from one `[[backup]]` entry with many targets share a fan out group.
+    #: The first of them is the primary target, see `backup.backup_fan_out()`.
+    fan_out: t.Optional[int] = None
+    #: The patterns excluding the directories found by `exclude_markers`, see `with_markers_found()`
+    _marked: t.Optional[t.List[str]] = attr.ib(default=None, repr=False, eq=False)
 
     @classmethod
     def all_from_config(cls, config: config.Config) -> t.List['Directory']:
         """
         Create a Directory for every directory found in the config.
+        An entry with a list of targets makes a Directory for each target,
+        in one fan out group. Commands are run once for each target instead.
         """
-        return [cls.from_options(entry, config) for entry in config["backup"]]
+        found = []
+        for index, entry in enumerate(config["backup"]):
+            if not isinstance(entry.get('target'), list):
+                found.append(cls.from_options(entry, config))
+                continue
+            if not entry['target']:
+                raise exceptions.ConfigError(f"No targets for {entry.get('source')!r}")
+            fan_out = index if len(entry['target']) > 1 and 'command' not in entry else None
+            found.extend(
+                cls.from_options({**entry, 'target': target, 'fan_out': fan_out}, config)
+                for target in entry['target'])
+        return found
 
     @classmethod
     def from_options(cls, directory: dict, config: config.Config) -> 'Directory':
@@ -36,6 +77,15 @@ class Directory:
         directory = directory.copy()
         target_bits = directory.pop('target').split(':', 2)
 
+        if isinstance(command := directory.get('command'), str):
+            directory['command'] = command = shlex.split(command)
+        if command is not None:
+            if not command or not directory.get('output') or '/' in directory['output']:
+                raise exceptions.ConfigError(f"Backup of command {command!r} needs a command and an output file name")
+            # The command names the backup unless it is given a name
+            directory.setdefault('source', shlex.join(command))
+        if 'source' not in directory:
+            raise exceptions.ConfigError("Backup has no 'source'")
         source_path = pathlib.Path(directory.pop("source")).expanduser()
         target_path = pathlib.Path(target_bits[1]).expanduser()
 
@@ -49,6 +99,17 @@ class Directory:
         if 'exclude_from' in directory:
             exclude_from = pathlib.Path(directory.pop('exclude_from')).expanduser()
 
+        if 'exclude_markers' in directory:
+            directory['exclude_markers'] = [
+                markers.Marker.parse(marker) for marker in directory['exclude_markers']]
+
+        for option in ['cadence', 'deadline']:
+            if option in directory:
+                try:
+                    directory[option] = units.parse_duration(directory[option])
+                except ValueError as exc:
+                    raise exceptions.ConfigError(f"Invalid {option} for {str(source_path)!r}: {exc}")
+
         return cls(
             source_path=source_path, target_path=target_path,
             target=target, rotate=rotate,
@@ -80,6 +141,44 @@ class Directory:
             else:
                 return None
 
+    def filter(self) -> filters.Filter:
+        """
+        The files to exclude from this directory,
+        for targets that are not sent files using rsync.
+        """
+        return filters.Filter.from_options(
+            exclude_from=self.resolve_exclude_from(),
+            exclude_files=[*self.exclude_files, *self.marked_exclude_patterns()],
+            one_file_system=self.one_file_system)
+
+    def marked_exclude_patterns(self) -> t.List[str]:
+        """
+        Patterns excluding every directory marked by one of `exclude_markers`.
+        They come after the other exclusion rules, so those can include a marked directory again.
+        The source is scanned for markers each time, unless they were found by `with_markers_found()`.
+        """
+        if self._marked is not None:
+            return self._marked
+        if not self.exclude_markers:
+            return []
+        base = filters.Filter.from_options(
+            exclude_from=self.resolve_exclude_from(),
+            exclude_files=self.exclude_files,
+            one_file_system=self.one_file_system)
+        name = hashlib.sha1(str(self.source_path).encode()).hexdigest()[:16]
+        with markers.MarkerCache.open(name) as cache:
+            marked = markers.find_marked(self.source_path, self.exclude_markers, filter=base, cache=cache)
+        return [markers.exclude_pattern(path) for path in marked]
+
+    def with_markers_found(self) -> 'Directory':
+        """
+        A copy of this directory that remembers the directories excluded by `exclude_markers`,
+        so the source is only scanned for markers once in each backup.
+        """
+        if self._marked is not None or not self.exclude_markers:
+            return self
+        return attr.evolve(self, marked=self.marked_exclude_patterns())
+
     def snapshot_name(self, timestamp: datetime.datetime) -> str:
         """
         Convert a timestamp into a snapshot directory name.
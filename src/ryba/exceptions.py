@@ -13,3 +13,11 @@ class ConfigError(CommandError):
 
 class RsyncError(CommandError):
     pass
+
+
+class VerifyError(CommandError):
+    pass
+
+
+class SpaceError(CommandError):
+    pass
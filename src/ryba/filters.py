@@ -0,0 +1,144 @@
+"""
+Walk a source directory applying the same exclusions that rsync would,
+for targets that are not written to using rsync.
+
+Only the commonly used parts of rsync filter rules are supported:
+include (`+ `) and exclude (`- `) rules, anchored patterns, directory-only patterns,
+the `*`, `**`, `***`, `?` and `[...]` wildcards, and escaping wildcards with a backslash.
+"""
+import os
+import pathlib
+import re
+import stat
+import typing as t
+
+import attr
+
+
+def _glob_to_regex(pattern: str) -> str:
+    regex = []
+    has_wildcards = any(char in pattern for char in '*?[')
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if char == '\\' and i + 1 < len(pattern) and has_wildcards:
+            # Like rsync, a backslash matches the next character literally,
+            # but only in patterns with wildcards
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[' and (end := pattern.find(']', i + 1)) != -1:
+            regex.append(pattern[i:end + 1])
+            i = end + 1
+            continue
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return ''.join(regex)
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Rule:
+    include: bool
+    pattern: str
+    regex: t.Pattern[str]
+    directories_only: bool
+
+    @classmethod
+    def parse(cls, line: str, include: bool = False) -> 'Rule':
+        pattern = line
+        if line.startswith('+ '):
+            include, pattern = True, line[2:]
+        elif line.startswith('- '):
+            include, pattern = False, line[2:]
+
+        directories_only = pattern.endswith('/')
+        body = pattern.rstrip('/')
+
+        suffix = '$'
+        if body.endswith('/***'):
+            # `dir/***` matches the directory and everything inside it
+            body, suffix = body[:-4], '(?:/.*)?$'
+            directories_only = False
+
+        if body.startswith('/'):
+            # Anchored patterns match from the top of the source directory
+            prefix = '^'
+            body = body[1:]
+        else:
+            # Other patterns match the end of the path, starting at a path component
+            prefix = '(?:^|.*/)'
+
+        regex = re.compile(prefix + _glob_to_regex(body) + suffix)
+        return cls(include=include, pattern=pattern, regex=regex, directories_only=directories_only)
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        if self.directories_only and not is_dir:
+            return False
+        return self.regex.match(path) is not None
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Filter:
+    rules: t.List[Rule] = attr.ib(factory=list)
+    one_file_system: bool = False
+
+    @classmethod
+    def from_options(
+        cls,
+        *,
+        exclude_from: t.Optional[pathlib.Path] = None,
+        exclude_files: t.Iterable[str] = (),
+        one_file_system: bool = False,
+    ) -> 'Filter':
+        """Build a filter equivalent to the `--exclude-from` and `--exclude` rsync options."""
+        rules = []
+        if exclude_from is not None:
+            for line in exclude_from.read_text().splitlines():
+                if not line.strip() or line.startswith(('#', ';')):
+                    continue
+                rules.append(Rule.parse(line))
+        rules.extend(Rule.parse(pattern, include=False) for pattern in exclude_files)
+        return cls(rules=rules, one_file_system=one_file_system)
+
+    def excluded(self, path: str, is_dir: bool) -> bool:
+        """Is a path, relative to the source directory, excluded? The first matching rule wins."""
+        for rule in self.rules:
+            if rule.matches(path, is_dir):
+                return not rule.include
+        return False
+
+    def walk(self, root: pathlib.Path) -> t.Iterator[t.Tuple[pathlib.PurePosixPath, os.stat_result]]:
+        """
+        Find every file, directory, and symlink under `root` that is not excluded,
+        along with its `lstat()`. Directories are listed before their contents.
+        The contents of excluded directories are skipped.
+        """
+        root_device = root.stat().st_dev
+        stack = [pathlib.PurePosixPath()]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = sorted(os.scandir(root / directory), key=lambda e: e.name)
+            except OSError:
+                continue
+            for entry in entries:
+                path = directory / entry.name
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                is_dir = stat.S_ISDIR(entry_stat.st_mode)
+                if self.excluded(str(path), is_dir):
+                    continue
+                yield path, entry_stat
+                if is_dir and not (self.one_file_system and entry_stat.st_dev != root_device):
+                    stack.append(path)
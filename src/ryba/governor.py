@@ -0,0 +1,206 @@
+"""
+Keep backups from slowing down everything else running on the host.
+
+The governor lowers the CPU and I/O priority of ryba,
+which every process that ryba runs inherits, such as rsync, cp, and rm.
+It can also watch the load average and disk latency of the host,
+pausing those processes while the host is busy
+and resuming them once the host is quiet again.
+"""
+import contextlib
+import os
+import signal
+import subprocess
+import threading
+import typing as t
+
+import attr
+
+from . import config, exceptions, logging, units
+
+logger = logging.getLogger(__name__)
+
+#: Paused processes are resumed once the load and disk latency drop below
+#: this fraction of their limits, so they are not paused and resumed on every check
+RESUME_FRACTION = 0.75
+
+#: Processes that are never paused.
+#: A paused ssh can not answer keep alive messages, and the server might disconnect it.
+_NEVER_PAUSE = {'ssh'}
+
+_IO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Governor:
+    #: Added to the niceness of ryba and every process it runs
+    nice: int = 0
+    #: The I/O scheduling class for ryba and every process it runs: `idle`, `best-effort`, or `realtime`
+    io_class: t.Optional[str] = None
+    #: The priority within the I/O scheduling class, from 0 (highest) to 7 (lowest)
+    io_priority: t.Optional[int] = None
+    #: Pause while the one minute load average is above this
+    max_load: t.Optional[float] = None
+    #: Pause while the average time taken to complete a disk request is above this many seconds
+    max_disk_latency: t.Optional[float] = None
+    #: How often to check the load and disk latency, in seconds
+    interval: float = 5.0
+
+    _paused: t.Set[int] = attr.ib(factory=set, init=False)
+
+    @classmethod
+    def from_config(cls, config: config.Config) -> 'Governor':
+        options = dict(config['governor'])
+        for option in ['max_disk_latency', 'interval']:
+            if option in options:
+                try:
+                    options[option] = units.parse_duration(options[option])
+                except ValueError as exc:
+                    raise exceptions.ConfigError(f"Invalid governor.{option}: {exc}")
+        if options.get('io_class') not in [None, *_IO_CLASSES]:
+            raise exceptions.ConfigError(
+                f"Invalid governor.io_class {options['io_class']!r}, "
+                f"expected one of {', '.join(_IO_CLASSES)}")
+        try:
+            return cls(**options)
+        except TypeError as exc:
+            raise exceptions.ConfigError(str(exc))
+
+    @contextlib.contextmanager
+    def running(self) -> t.Iterator[None]:
+        """
+        Lower the priority of ryba,
+        and pause the processes it runs whenever the host is busy.
+        """
+        self.set_priority()
+        if self.max_load is None and self.max_disk_latency is None:
+            yield
+            return
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self._watch, args=(stop,), name='ryba-governor', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self._resume()
+
+    def set_priority(self) -> None:
+        """Set the CPU and I/O priority of ryba. Processes started afterwards inherit them."""
+        if self.nice:
+            os.nice(self.nice)
+        if self.io_class is not None:
+            command = ['ionice', '-c', str(_IO_CLASSES[self.io_class])]
+            if self.io_priority is not None:
+                command.extend(['-n', str(self.io_priority)])
+            command.extend(['-p', str(os.getpid())])
+            logger.log(logging.DEBUG, logging.command(command))
+            try:
+                subprocess.check_call(command)
+            except (OSError, subprocess.CalledProcessError) as exc:
+                logger.log(logging.WARNING, "Could not set the I/O priority: %s", exc)
+
+    def _watch(self, stop: threading.Event) -> None:
+        previous = _read_diskstats()
+        while not stop.wait(self.interval):
+            current = _read_diskstats()
+            load = os.getloadavg()[0]
+            latency = _disk_latency(previous, current)
+            previous = current
+
+            if not self._paused:
+                if (reason := self._busy(load, latency)) is not None:
+                    logger.log(logging.INFO, "Pausing while the host is busy: %s", reason)
+                    self._pause()
+            elif self._quiet(load, latency):
+                logger.log(logging.INFO, "Resuming now the host is quiet")
+                self._resume()
+            else:
+                # Catch any processes started since the last check
+                self._pause()
+
+    def _busy(self, load: float, latency: float) -> t.Optional[str]:
+        if self.max_load is not None and load > self.max_load:
+            return f"load average {load:.1f} is above {self.max_load}"
+        if self.max_disk_latency is not None and latency > self.max_disk_latency:
+            return f"disk latency {latency * 1000:.0f}ms is above {self.max_disk_latency * 1000:.0f}ms"
+        return None
+
+    def _quiet(self, load: float, latency: float) -> bool:
+        return (
+            (self.max_load is None or load < self.max_load * RESUME_FRACTION)
+            and (self.max_disk_latency is None or latency < self.max_disk_latency * RESUME_FRACTION))
+
+    def _pause(self) -> None:
+        for pid, name in _descendants(os.getpid()):
+            if name in _NEVER_PAUSE or pid in self._paused:
+                continue
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGSTOP)
+                self._paused.add(pid)
+
+    def _resume(self) -> None:
+        for pid in self._paused:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGCONT)
+        self._paused.clear()
+
+
+def _descendants(pid: int) -> t.List[t.Tuple[int, str]]:
+    """Find every process descended from `pid`, and its command name."""
+    children: t.Dict[int, t.List[t.Tuple[int, str]]] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                line = f.read()
+        except OSError:
+            continue
+        # The command name is in brackets, and can contain spaces and brackets
+        name = line[line.index('(') + 1:line.rindex(')')]
+        parent = int(line[line.rindex(')') + 2:].split()[1])
+        children.setdefault(parent, []).append((int(entry), name))
+
+    found = []
+    queue = [pid]
+    while queue:
+        for child in children.get(queue.pop(), []):
+            found.append(child)
+            queue.append(child[0])
+    return found
+
+
+def _read_diskstats() -> t.Dict[str, t.Tuple[int, int]]:
+    """How many requests each disk has completed, and how many milliseconds they took in total."""
+    try:
+        disks = set(os.listdir('/sys/block'))
+        with open('/proc/diskstats') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    stats = {}
+    for line in lines:
+        fields = line.split()
+        # Partitions are counted in their disk, and loop and ram devices are not real disks
+        if fields[2] not in disks or fields[2].startswith(('loop', 'ram', 'zram')):
+            continue
+        reads, read_ms, writes, write_ms = int(fields[3]), int(fields[6]), int(fields[7]), int(fields[10])
+        stats[fields[2]] = (reads + writes, read_ms + write_ms)
+    return stats
+
+
+def _disk_latency(
+    previous: t.Dict[str, t.Tuple[int, int]],
+    current: t.Dict[str, t.Tuple[int, int]],
+) -> float:
+    """The average time taken to complete a request between two readings, on the slowest disk."""
+    latency = 0.0
+    for disk, (requests, milliseconds) in current.items():
+        if disk not in previous:
+            continue
+        if (completed := requests - previous[disk][0]) > 0:
+            latency = max(latency, (milliseconds - previous[disk][1]) / completed / 1000)
+    return latency
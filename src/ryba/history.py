@@ -0,0 +1,218 @@
+"""
+A record of every backup run, stored in a SQLite database in the data directory.
+"""
+import contextlib
+import datetime
+import pathlib
+import sqlite3
+import statistics
+import threading
+import time
+import typing as t
+
+import attr
+
+from . import config, directories, instrumentation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    command TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS directory_runs (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    status TEXT,
+    files_transferred INTEGER,
+    bytes_transferred INTEGER,
+    snapshots_kept INTEGER,
+    snapshots_dropped INTEGER
+);
+CREATE INDEX IF NOT EXISTS directory_runs_source ON directory_runs (source, target, started);
+CREATE TABLE IF NOT EXISTS phases (
+    directory_run_id INTEGER NOT NULL REFERENCES directory_runs (id),
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+"""
+
+#: How many recent successful runs are used to predict the duration of the next run
+ESTIMATE_RUNS = 5
+
+STATUS_OK = 'ok'
+
+
+def get_default_history_path() -> pathlib.Path:
+    return config.get_data_path() / 'history.sqlite'
+
+
+def _target_key(directory: directories.Directory) -> str:
+    return f"{directory.target.name}:{directory.target_path}"
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class DirectoryRun:
+    """
+    The record of backing up one directory, filled in as the backup progresses.
+    """
+    source: str
+    target: str
+    started: float
+    finished: t.Optional[float] = None
+    status: t.Optional[str] = None
+    files_transferred: t.Optional[int] = None
+    bytes_transferred: t.Optional[int] = None
+    snapshots_kept: t.Optional[int] = None
+    snapshots_dropped: t.Optional[int] = None
+    phases: t.Dict[str, float] = attr.ib(factory=dict)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> t.Iterator[None]:
+        """
+        Record how long the wrapped block takes.
+        Target operations and processes in the block are attributed to this directory and phase.
+        """
+        start = time.monotonic()
+        try:
+            with instrumentation.phase(name, directory=self.source):
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    @property
+    def duration(self) -> t.Optional[float]:
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class History(config.Singleton):
+    """
+    The history database. This can be shared between threads.
+    """
+    _run_id: t.Optional[int]
+
+    def __init__(self, path: pathlib.Path, *, command: str = ''):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.command = command
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._run_id = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _get_run_id(self) -> int:
+        # Only commands that actually back something up get a row in `runs`
+        if self._run_id is None:
+            with self._db:
+                cursor = self._db.execute(
+                    "INSERT INTO runs (started, command) VALUES (?, ?)",
+                    (time.time(), self.command))
+            self._run_id = t.cast(int, cursor.lastrowid)
+        return self._run_id
+
+    @contextlib.contextmanager
+    def record(self, directory: directories.Directory) -> t.Iterator[DirectoryRun]:
+        """
+        Record a run of a directory. The status of the run is taken from
+        whether the wrapped block raises an exception.
+        """
+        run = DirectoryRun(
+            source=str(directory.source_path), target=_target_key(directory),
+            started=time.time())
+        try:
+            yield run
+        except BaseException as exc:
+            run.status = f"{type(exc).__name__}: {exc}"
+            raise
+        else:
+            run.status = STATUS_OK
+        finally:
+            run.finished = time.time()
+            self._save(run)
+
+    def _save(self, run: DirectoryRun) -> None:
+        with self._lock, self._db:
+            run_id = self._get_run_id()
+            cursor = self._db.execute(
+                """
+                INSERT INTO directory_runs (
+                    run_id, source, target, started, finished, status,
+                    files_transferred, bytes_transferred, snapshots_kept, snapshots_dropped
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    run_id, run.source, run.target, run.started, run.finished, run.status,
+                    run.files_transferred, run.bytes_transferred,
+                    run.snapshots_kept, run.snapshots_dropped,
+                ))
+            self._db.executemany(
+                "INSERT INTO phases (directory_run_id, phase, duration) VALUES (?, ?, ?)",
+                [(cursor.lastrowid, phase, duration) for phase, duration in run.phases.items()])
+
+    def directory_runs(
+        self, directory: directories.Directory, *, limit: t.Optional[int] = None,
+    ) -> t.List[DirectoryRun]:
+        """Find the most recent runs for this directory, newest first."""
+        with self._lock:
+            return self._directory_runs(directory, limit=limit)
+
+    def _directory_runs(
+        self, directory: directories.Directory, *, limit: t.Optional[int],
+    ) -> t.List[DirectoryRun]:
+        rows = self._db.execute(
+            """
+            SELECT id, source, target, started, finished, status,
+                files_transferred, bytes_transferred, snapshots_kept, snapshots_dropped
+            FROM directory_runs
+            WHERE source = ? AND target = ?
+            ORDER BY started DESC
+            LIMIT ?
+            """,
+            (str(directory.source_path), _target_key(directory), -1 if limit is None else limit),
+        ).fetchall()
+
+        runs = []
+        for row_id, *fields in rows:
+            phases = dict(self._db.execute(
+                "SELECT phase, duration FROM phases WHERE directory_run_id = ?", (row_id,)))
+            runs.append(DirectoryRun(
+                source=fields[0], target=fields[1], started=fields[2], finished=fields[3],
+                status=fields[4], files_transferred=fields[5], bytes_transferred=fields[6],
+                snapshots_kept=fields[7], snapshots_dropped=fields[8], phases=phases))
+        return runs
+
+    def estimate_duration(self, directory: directories.Directory) -> t.Optional[datetime.timedelta]:
+        """
+        Predict how long the next run of this directory will take,
+        from the median duration of the last few successful runs.
+        """
+        durations = [
+            run.duration for run in self.directory_runs(directory, limit=ESTIMATE_RUNS * 2)
+            if run.status == STATUS_OK and run.duration is not None
+        ][:ESTIMATE_RUNS]
+        if not durations:
+            return None
+        return datetime.timedelta(seconds=statistics.median(durations))
+
+    def estimate_transfer(self, directory: directories.Directory) -> t.Optional[int]:
+        """
+        Predict how many bytes the next run of this directory will send,
+        from the largest of the last few successful runs.
+        """
+        sizes = [
+            run.bytes_transferred for run in self.directory_runs(directory, limit=ESTIMATE_RUNS * 2)
+            if run.status == STATUS_OK and run.bytes_transferred is not None
+        ][:ESTIMATE_RUNS]
+        if not sizes:
+            return None
+        return max(sizes)
@@ -0,0 +1,391 @@
+"""
+Count the operations made on targets, how long they take, and how much data they move,
+broken down by the phase of the backup that made them.
+This makes it obvious when a change makes an operation run once per file
+instead of once per directory.
+
+The resources used by the processes that ryba runs, such as rsync,
+are recorded the same way, broken down by directory and phase.
+"""
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import pathlib
+import threading
+import time
+import types
+import typing as t
+
+import attr
+
+from . import config, logging, processes, targets, units
+
+if t.TYPE_CHECKING:
+    from . import filters
+
+logger = logging.getLogger(__name__)
+
+_phase: contextvars.ContextVar[str] = contextvars.ContextVar('phase', default='other')
+_directory: contextvars.ContextVar[str] = contextvars.ContextVar('directory', default='')
+
+#: The upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+TResult = t.TypeVar('TResult')
+
+
+@contextlib.contextmanager
+def phase(name: str, *, directory: t.Optional[str] = None) -> t.Iterator[None]:
+    """
+    Attribute any target operations and processes in the wrapped block to a phase,
+    and to a directory if one is given.
+    """
+    token = _phase.set(name)
+    directory_token = _directory.set(directory) if directory is not None else None
+    try:
+        yield
+    finally:
+        if directory_token is not None:
+            _directory.reset(directory_token)
+        _phase.reset(token)
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class OperationStats:
+    calls: int = 0
+    errors: int = 0
+    seconds: float = 0
+    #: Bytes sent to or received from the target
+    bytes: int = 0
+    #: How many calls fell in each of the `LATENCY_BUCKETS`, plus one for slower calls
+    histogram: t.List[int] = attr.ib(factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def add(self, seconds: float, size: int, error: bool) -> None:
+        self.calls += 1
+        self.errors += error
+        self.seconds += seconds
+        self.bytes += size
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """An upper bound for the latency of this fraction of calls."""
+        rank = fraction * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Operations(config.Singleton):
+    """Statistics for every target operation made during this run. This can be shared between threads."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stats: t.Dict[t.Tuple[str, str, str], OperationStats] = {}
+
+    def record(self, target: str, operation: str, *, seconds: float, size: int, error: bool) -> None:
+        key = (target, _phase.get(), operation)
+        with self._lock:
+            if key not in self.stats:
+                self.stats[key] = OperationStats()
+            self.stats[key].add(seconds, size, error)
+
+    def to_json(self) -> t.List[t.Dict[str, t.Any]]:
+        with self._lock:
+            return [
+                {
+                    'target': target, 'phase': phase, 'operation': operation,
+                    **attr.asdict(stats),
+                    'histogram': dict(zip([*map(str, LATENCY_BUCKETS), 'inf'], stats.histogram)),
+                }
+                for (target, phase, operation), stats in sorted(self.stats.items())
+            ]
+
+    def write(self, path: pathlib.Path) -> None:
+        path.write_text(json.dumps(self.to_json(), indent=2))
+
+    def log_summary(self) -> None:
+        with self._lock:
+            stats = sorted(self.stats.items())
+        if not stats:
+            return
+        logger.log(logging.MESSAGE, "Target operations:")
+        logger.log(
+            logging.MESSAGE, "  %-12s %-10s %-16s %7s %6s %9s %9s %9s %9s",
+            'target', 'phase', 'operation', 'calls', 'errors', 'total', 'mean', 'p95', 'bytes')
+        for (target, phase, operation), operation_stats in stats:
+            logger.log(
+                logging.MESSAGE, "  %-12s %-10s %-16s %7d %6d %8.3fs %7.1fms %7gms %9s",
+                target, phase, operation, operation_stats.calls, operation_stats.errors,
+                operation_stats.seconds, operation_stats.seconds / operation_stats.calls * 1000,
+                operation_stats.percentile(0.95) * 1000, units.format_size(operation_stats.bytes))
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class ProcessStats:
+    calls: int = 0
+    errors: int = 0
+    seconds: float = 0
+    #: CPU time, for the processes where it could be measured
+    user: float = 0
+    system: float = 0
+    #: The most memory used by any one of the processes, in bytes, if any could be measured
+    max_rss: t.Optional[int] = None
+    #: Bytes read from and written to disk
+    read_bytes: int = 0
+    written_bytes: int = 0
+
+    def add(self, usage: processes.Usage, error: bool) -> None:
+        self.calls += 1
+        self.errors += error
+        self.seconds += usage.seconds
+        self.user += usage.user or 0
+        self.system += usage.system or 0
+        if usage.max_rss is not None:
+            self.max_rss = max(self.max_rss or 0, usage.max_rss)
+        self.read_bytes += usage.read_bytes or 0
+        self.written_bytes += usage.written_bytes or 0
+
+
+class Processes(config.Singleton):
+    """
+    The resources used by every process run during this run,
+    by directory, phase, and command. This can be shared between threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stats: t.Dict[t.Tuple[str, str, str], ProcessStats] = {}
+
+    def record(
+        self,
+        command: t.Sequence[str],
+        usage: processes.Usage,
+        *,
+        error: bool,
+        host: t.Optional[str] = None,
+    ) -> None:
+        name = os.path.basename(command[0]) if command else ''
+        if host is not None:
+            name = f'{host}:{name}'
+        key = (_directory.get(), _phase.get(), name)
+        with self._lock:
+            if key not in self.stats:
+                self.stats[key] = ProcessStats()
+            self.stats[key].add(usage, error)
+
+    def to_json(self) -> t.List[t.Dict[str, t.Any]]:
+        with self._lock:
+            return [
+                {'directory': directory, 'phase': phase, 'command': command, **attr.asdict(stats)}
+                for (directory, phase, command), stats in sorted(self.stats.items())
+            ]
+
+    def write(self, path: pathlib.Path) -> None:
+        path.write_text(json.dumps(self.to_json(), indent=2))
+
+    def log_summary(self) -> None:
+        with self._lock:
+            stats = sorted(self.stats.items())
+        if not stats:
+            return
+        logger.log(logging.MESSAGE, "Processes:")
+        logger.log(
+            logging.MESSAGE, "  %-24s %-10s %-16s %6s %6s %9s %9s %9s %9s %9s %9s",
+            'directory', 'phase', 'command', 'calls', 'errors',
+            'wall', 'user', 'system', 'max rss', 'read', 'written')
+        for (directory, phase, command), process_stats in stats:
+            logger.log(
+                logging.MESSAGE, "  %-24s %-10s %-16s %6d %6d %8.2fs %8.2fs %8.2fs %9s %9s %9s",
+                directory or '-', phase, command, process_stats.calls, process_stats.errors,
+                process_stats.seconds, process_stats.user, process_stats.system,
+                '-' if process_stats.max_rss is None else units.format_size(process_stats.max_rss),
+                units.format_size(process_stats.read_bytes),
+                units.format_size(process_stats.written_bytes))
+
+
+def instrument(context: targets.TargetContext, config: config.Config) -> targets.TargetContext:
+    """Count the operations made on a target context, if operations are being counted for this run."""
+    try:
+        operations = config.get(Operations)
+    except KeyError:
+        return context
+    return InstrumentedContext(context, operations)
+
+
+class InstrumentedContext(targets.TargetContext):
+    """
+    Wraps another target context, recording every operation made on it.
+
+    Operations that `targets.TargetContext` builds out of other operations,
+    such as `list_backups()`, run against this wrapper, so each operation they make is recorded.
+    Where the wrapped context has its own version of one of these,
+    such as reading many files with one agent call, that version is recorded as one operation instead.
+    """
+
+    def __init__(self, inner: targets.TargetContext, operations: Operations):
+        self.inner = inner
+        self.operations = operations
+        self.target = inner.target
+        self.uses_rsync = inner.uses_rsync
+
+    def _overrides(self, name: str) -> bool:
+        """Does the wrapped context have its own version of an operation built out of other operations?"""
+        return getattr(type(self.inner), name) is not getattr(targets.TargetContext, name)
+
+    def _call(
+        self,
+        operation: str,
+        function: t.Callable[[], TResult],
+        *,
+        sent: int = 0,
+        received: t.Callable[[TResult], int] = lambda result: 0,
+    ) -> TResult:
+        start = time.perf_counter()
+        try:
+            result = function()
+        except BaseException:
+            self.operations.record(
+                self.target.name, operation,
+                seconds=time.perf_counter() - start, size=sent, error=True)
+            raise
+        self.operations.record(
+            self.target.name, operation,
+            seconds=time.perf_counter() - start, size=sent + received(result), error=False)
+        return result
+
+    def __enter__(self) -> 'InstrumentedContext':
+        self.inner.__enter__()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: t.Optional[t.Type[BaseException]],
+        exc_value: t.Optional[BaseException],
+        traceback: t.Optional[types.TracebackType],
+    ) -> t.Optional[bool]:
+        return self.inner.__exit__(exc_type, exc_value, traceback)
+
+    def make_path(self, path: pathlib.Path) -> pathlib.Path:
+        return self.inner.make_path(path)
+
+    def execute(self, cmd: t.List[str]) -> None:
+        self._call('execute', lambda: self.inner.execute(cmd))
+
+    def check_output(self, cmd: t.List[str]) -> bytes:
+        return self._call('check_output', lambda: self.inner.check_output(cmd), received=len)
+
+    def exists(self, path: pathlib.Path) -> bool:
+        return self._call('exists', lambda: self.inner.exists(path))
+
+    def read_file(self, path: pathlib.Path) -> bytes:
+        return self._call('read_file', lambda: self.inner.read_file(path), received=len)
+
+    def write_file(self, path: pathlib.Path, contents: bytes) -> None:
+        self._call('write_file', lambda: self.inner.write_file(path, contents), sent=len(contents))
+
+    def list_directory(self, path: pathlib.Path) -> t.List[str]:
+        return self._call('list_directory', lambda: self.inner.list_directory(path))
+
+    def stream_output(self, cmd: t.List[str], output: t.BinaryIO) -> int:
+        return self._call(
+            'stream_output', lambda: self.inner.stream_output(cmd, output), received=lambda size: size)
+
+    def stream_input(self, cmd: t.List[str], input: t.BinaryIO, *, echo: bool) -> int:
+        return self._call('stream_input', lambda: self.inner.stream_input(cmd, input, echo=echo))
+
+    def read_files(self, paths: t.List[pathlib.Path]) -> t.Dict[pathlib.Path, t.Optional[bytes]]:
+        if not self._overrides('read_files'):
+            return super().read_files(paths)
+        return self._call(
+            'read_files', lambda: self.inner.read_files(paths),
+            received=lambda result: sum(len(content) for content in result.values() if content))
+
+    def execute_many(self, cmds: t.List[t.List[str]]) -> None:
+        if not self._overrides('execute_many'):
+            return super().execute_many(cmds)
+        self._call('execute_many', lambda: self.inner.execute_many(cmds))
+
+    def list_backups(self, path: pathlib.Path) -> t.Iterable[targets.Backup]:
+        if not self._overrides('list_backups'):
+            return list(super().list_backups(path))
+        return self._call('list_backups', lambda: list(self.inner.list_backups(path)))
+
+    def receive_files(
+        self,
+        source: pathlib.Path,
+        path: pathlib.Path,
+        *,
+        filter: 'filters.Filter',
+        dry_run: bool,
+    ) -> targets.TransferStats:
+        if not self._overrides('receive_files'):
+            return super().receive_files(source, path, filter=filter, dry_run=dry_run)
+        return self._call(
+            'receive_files',
+            lambda: self.inner.receive_files(source, path, filter=filter, dry_run=dry_run),
+            received=lambda stats: stats.bytes_transferred or 0)
+
+    def restore_files(
+        self,
+        snapshot: pathlib.Path,
+        destination: pathlib.Path,
+        *,
+        only: t.Optional[t.Callable[[str], bool]] = None,
+        jobs: int = 1,
+    ) -> None:
+        if not self._overrides('restore_files'):
+            return super().restore_files(snapshot, destination, only=only, jobs=jobs)
+        self._call(
+            'restore_files',
+            lambda: self.inner.restore_files(snapshot, destination, only=only, jobs=jobs))
+
+    def move_files(self, path: pathlib.Path, moves: t.List[t.Tuple[str, str]]) -> int:
+        if not self._overrides('move_files'):
+            return super().move_files(path, moves)
+        return self._call('move_files', lambda: self.inner.move_files(path, moves))
+
+    def run_with_input(self, cmd: t.List[str], input_file: pathlib.Path, *, echo: bool) -> int:
+        if not self._overrides('run_with_input'):
+            return super().run_with_input(cmd, input_file, echo=echo)
+        return self._call(
+            'run_with_input', lambda: self.inner.run_with_input(cmd, input_file, echo=echo),
+            sent=input_file.stat().st_size)
+
+    def export_snapshot(
+        self,
+        snapshot: pathlib.Path,
+        output: t.BinaryIO,
+        *,
+        compressor: t.Optional[str] = None,
+    ) -> int:
+        if not self._overrides('export_snapshot'):
+            return super().export_snapshot(snapshot, output, compressor=compressor)
+        return self._call(
+            'export_snapshot',
+            lambda: self.inner.export_snapshot(snapshot, output, compressor=compressor),
+            received=lambda size: size)
+
+    def ensure_directory(self, path: pathlib.Path) -> None:
+        if not self._overrides('ensure_directory'):
+            return super().ensure_directory(path)
+        self._call('ensure_directory', lambda: self.inner.ensure_directory(path))
+
+    def create_snapshot(self, current: pathlib.Path, snapshot: pathlib.Path) -> None:
+        if not self._overrides('create_snapshot'):
+            return super().create_snapshot(current, snapshot)
+        self._call('create_snapshot', lambda: self.inner.create_snapshot(current, snapshot))
+
+    def delete_snapshots(self, path: pathlib.Path, names: t.List[str]) -> None:
+        if not self._overrides('delete_snapshots'):
+            return super().delete_snapshots(path, names)
+        self._call('delete_snapshots', lambda: self.inner.delete_snapshots(path, names))
+
+    def free_space(self, path: pathlib.Path) -> int:
+        if not self._overrides('free_space'):
+            return super().free_space(path)
+        return self._call('free_space', lambda: self.inner.free_space(path))
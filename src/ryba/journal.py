@@ -0,0 +1,91 @@
+"""
+A journal of the changes made to the current snapshot during a backup,
+taken from the itemized changes that rsync logs while it transfers files.
+The journal is stored in each snapshot,
+so what changed in a snapshot can be found without comparing it to the previous snapshot.
+"""
+import gzip
+import re
+import typing as t
+
+import attr
+
+#: The `rsync --log-file-format` that the journal is parsed from
+RSYNC_LOG_FORMAT = '%i %n%L'
+
+#: A line in an rsync log file: the date, time, and process ID, then the message
+_LOG_LINE = re.compile(rb'^\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[\d+\] (.*)$')
+#: An itemized change, such as `>f.st...... some/file`, or `*deleting   some/file`
+_CHANGE = re.compile(r'^(\*deleting +|[<>ch.][fdLDS][^ ]{9} )(.*)$')
+
+CREATED = 'created'
+UPDATED = 'updated'
+CHANGED = 'changed'
+DELETED = 'deleted'
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Change:
+    #: The rsync itemize string, such as `>f.st......`
+    itemized: str
+    #: The path relative to the snapshot, with ` -> target` for symlinks
+    path: str
+
+    @property
+    def kind(self) -> str:
+        """
+        What happened to the path: it was `CREATED`, its contents were `UPDATED`,
+        only its attributes were `CHANGED`, or it was `DELETED`.
+        """
+        if self.itemized.startswith('*'):
+            return DELETED
+        if self.itemized[2:].strip('+') == '':
+            return CREATED
+        if self.itemized[0] in '<>ch':
+            return UPDATED
+        return CHANGED
+
+    @property
+    def is_dir(self) -> bool:
+        return self.itemized[1] == 'd'
+
+    def __str__(self) -> str:
+        return f'{self.itemized:<11} {self.path}'
+
+
+def parse_rsync_log(log: bytes, prefix: str = '') -> t.List[Change]:
+    """
+    Find the itemized changes in an `rsync --log-file` written using `RSYNC_LOG_FORMAT`.
+    If `prefix` is given, only changes to paths inside `prefix` are returned,
+    relative to `prefix`.
+    """
+    changes = []
+    for line in log.splitlines():
+        if (log_match := _LOG_LINE.match(line)) is None:
+            continue
+        message = log_match.group(1).decode('utf-8', errors='surrogateescape')
+        if (match := _CHANGE.match(message)) is None:
+            continue
+        itemized, path = match.group(1).rstrip(), match.group(2)
+        if prefix:
+            if path.rstrip('/') == prefix:
+                path = './'
+            elif path.startswith(prefix + '/'):
+                path = path[len(prefix) + 1:]
+            else:
+                continue
+        changes.append(Change(itemized=itemized, path=path))
+    return changes
+
+
+def dump_journal(changes: t.List[Change]) -> bytes:
+    data = ''.join(f'{change}\n' for change in changes)
+    return gzip.compress(data.encode('utf-8', errors='surrogateescape'))
+
+
+def load_journal(data: bytes) -> t.List[Change]:
+    changes = []
+    for line in gzip.decompress(data).decode('utf-8', errors='surrogateescape').splitlines():
+        if (match := _CHANGE.match(line)) is not None:
+            changes.append(Change(itemized=match.group(1).rstrip(), path=match.group(2)))
+    return changes
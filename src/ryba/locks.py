@@ -0,0 +1,218 @@
+"""
+Stop two runs of ryba from backing up the same directory to the same target at once,
+so separate runs can back up different directories at the same time.
+
+A directory is locked on this host using `flock()`,
+which is released automatically if ryba exits for any reason.
+The lock is mirrored on the target with a lease file in the state directory next to the snapshots,
+for runs on other hosts that back up to the same place.
+A lease expires unless it is renewed, so a lease left behind by a host that crashed
+is only obeyed until it expires.
+Targets can not create a file only if it does not already exist,
+so two hosts taking a lease at the same moment might both get it.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import socket
+import threading
+import time
+import typing as t
+
+import attr
+
+from . import (
+    config, constants, directories, exceptions, logging, targets, units)
+
+logger = logging.getLogger(__name__)
+
+#: How often to check whether a lock has been released while waiting for it, in seconds
+POLL_INTERVAL = 1.0
+
+
+class LockedError(exceptions.CommandError):
+    pass
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Lease:
+    """Who holds the lock on a directory on a target, and until when."""
+    host: str
+    pid: int
+    token: str
+    #: When the lease runs out unless it is renewed, as a Unix timestamp
+    expires: float
+
+    def encode(self) -> bytes:
+        return json.dumps(attr.asdict(self)).encode()
+
+    @classmethod
+    def decode(cls, data: t.Optional[bytes]) -> t.Optional['Lease']:
+        """Read a lease file. A missing, empty, or unreadable lease file means the lock is free."""
+        if not data:
+            return None
+        try:
+            return cls(**json.loads(data))
+        except (ValueError, TypeError):
+            return None
+
+    def is_stale(self, now: float) -> bool:
+        """Has the lease run out, or did the process holding it on this host exit without releasing it?"""
+        if self.expires < now:
+            return True
+        if self.host == socket.gethostname() and self.pid != os.getpid():
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return False
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Locker:
+    #: How long to wait for a locked directory before giving up, in seconds
+    wait: float = 0.0
+    #: How long a lease on a target lasts unless it is renewed, in seconds
+    lease: float = 600.0
+
+    @classmethod
+    def from_config(cls, config: config.Config) -> 'Locker':
+        options = dict(config['lock'])
+        for option in ['wait', 'lease']:
+            if option in options:
+                try:
+                    options[option] = units.parse_duration(options[option])
+                except ValueError as exc:
+                    raise exceptions.ConfigError(f"Invalid lock.{option}: {exc}")
+        try:
+            return cls(**options)
+        except TypeError as exc:
+            raise exceptions.ConfigError(str(exc))
+
+    @contextlib.contextmanager
+    def local(self, directories_to_lock: t.Sequence[directories.Directory]) -> t.Iterator[None]:
+        """
+        Lock directories against other runs on this host,
+        waiting up to `wait` seconds for each lock before raising `LockedError`.
+        """
+        deadline = time.monotonic() + self.wait
+        path = config.get_data_path() / 'locks'
+        path.mkdir(parents=True, exist_ok=True)
+        with contextlib.ExitStack() as stack:
+            # Always locking in the same order stops two runs waiting for each other
+            for directory in sorted(directories_to_lock, key=_key):
+                name = hashlib.sha1(_key(directory).encode()).hexdigest()[:16]
+                lock_file = stack.enter_context(open(path / f'{name}.lock', 'a'))
+                waiting = False
+                while True:
+                    try:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        pass
+                    if time.monotonic() >= deadline:
+                        raise LockedError(f"{directory} is locked by another run on this host")
+                    if not waiting:
+                        logger.log(logging.INFO, "Waiting for another run on this host to finish with %s", directory)
+                        waiting = True
+                    time.sleep(POLL_INTERVAL)
+            yield
+
+    @contextlib.contextmanager
+    def target(
+        self,
+        directories_to_lock: t.Sequence[directories.Directory],
+        context: targets.TargetContext,
+    ) -> t.Iterator[None]:
+        """
+        Take a lease on directories on a target,
+        waiting up to `wait` seconds for each before raising `LockedError`.
+        The leases are renewed while the block runs, and released afterwards.
+        """
+        deadline = time.monotonic() + self.wait
+        token = os.urandom(8).hex()
+        held: t.List[directories.Directory] = []
+        try:
+            for directory in sorted(directories_to_lock, key=_key):
+                self._take_lease(directory, context, token, deadline)
+                held.append(directory)
+
+            stop = threading.Event()
+            thread = threading.Thread(
+                target=self._renew, args=(held, context, token, stop), name='ryba-lease', daemon=True)
+            thread.start()
+            try:
+                yield
+            finally:
+                stop.set()
+                thread.join()
+        finally:
+            for directory in held:
+                path = _lease_path(directory)
+                with contextlib.suppress(Exception):
+                    current = Lease.decode(context.read_files([path])[path])
+                    if current is not None and current.token == token:
+                        context.write_file(path, b'')
+
+    def _make_lease(self, token: str) -> Lease:
+        return Lease(host=socket.gethostname(), pid=os.getpid(), token=token, expires=time.time() + self.lease)
+
+    def _take_lease(
+        self,
+        directory: directories.Directory,
+        context: targets.TargetContext,
+        token: str,
+        deadline: float,
+    ) -> None:
+        path = _lease_path(directory)
+        waiting = False
+        while True:
+            current = Lease.decode(context.read_files([path])[path])
+            if current is None or current.is_stale(time.time()):
+                if current is not None:
+                    logger.log(
+                        logging.WARNING, "Ignoring a stale lock on %s held by process %d on %s",
+                        directory, current.pid, current.host)
+                context.ensure_directory(path.parent)
+                context.write_file(path, self._make_lease(token).encode())
+                # Another host might have taken the lease at the same time
+                current = Lease.decode(context.read_files([path])[path])
+                if current is not None and current.token == token:
+                    return
+
+            assert current is not None
+            if time.monotonic() >= deadline:
+                raise LockedError(f"{directory} is locked by process {current.pid} on {current.host}")
+            if not waiting:
+                logger.log(
+                    logging.INFO, "Waiting for process %d on %s to finish with %s",
+                    current.pid, current.host, directory)
+                waiting = True
+            time.sleep(POLL_INTERVAL)
+
+    def _renew(
+        self,
+        held: t.List[directories.Directory],
+        context: targets.TargetContext,
+        token: str,
+        stop: threading.Event,
+    ) -> None:
+        while not stop.wait(self.lease / 3):
+            for directory in held:
+                try:
+                    context.write_file(_lease_path(directory), self._make_lease(token).encode())
+                except Exception as exc:
+                    logger.log(logging.WARNING, "Could not renew the lock on %s: %s", directory, exc)
+
+
+def _lease_path(directory: directories.Directory) -> pathlib.Path:
+    return directory.target_path / constants.STATE_DIRECTORY_NAME / constants.LOCK_FILE_NAME
+
+
+def _key(directory: directories.Directory) -> str:
+    return f"{directory.target.name}:{directory.target_path}"
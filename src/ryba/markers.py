@@ -0,0 +1,185 @@
+"""
+Find directories that are not worth backing up, such as caches and build output,
+by the marker files found in or next to them.
+
+A marker is either the name of a file, such as `CACHEDIR.TAG`,
+which excludes the directory it is found in,
+or a file and a directory separated by a colon, such as `Cargo.toml:target`,
+which excludes that directory next to the file.
+
+Scanning a large tree for markers would take as long as the backup itself,
+so what is found in each directory is cached, keyed by the modification time of the directory.
+A directory only has to be listed again when an entry in it is added, removed, or renamed.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import stat
+import types
+import typing as t
+
+import attr
+
+from . import config, exceptions, filters
+
+#: The name of a cache directory tag, see https://bford.info/cachedir/
+CACHEDIR_TAG = 'CACHEDIR.TAG'
+
+#: Every cache directory tag starts with this
+CACHEDIR_TAG_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Marker:
+    #: The name of the marker file
+    file: str
+    #: The directory next to the marker file to exclude,
+    #: or `None` to exclude the directory the marker file is in
+    directory: t.Optional[str] = None
+
+    @classmethod
+    def parse(cls, marker: str) -> 'Marker':
+        file, _, directory = marker.partition(':')
+        if not file or '/' in file or '/' in directory:
+            raise exceptions.ConfigError(f"Invalid exclude marker {marker!r}")
+        return cls(file=file, directory=directory or None)
+
+    def __str__(self) -> str:
+        return self.file if self.directory is None else f'{self.file}:{self.directory}'
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Listing:
+    """What a scan needs to know about the entries of one directory."""
+    #: The modification time of the directory when it was listed, in nanoseconds
+    mtime: int
+    #: The names of the subdirectories, not including symlinks to directories
+    directories: t.List[str]
+    #: The names of the marker files present
+    markers: t.List[str]
+
+
+class MarkerCache:
+    """
+    A persistent mapping of directories to their `Listing`, stored in a SQLite database
+    in the cache directory. Listings are only valid for the markers they were made with.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS listings (key TEXT PRIMARY KEY, listing TEXT NOT NULL)")
+
+    @classmethod
+    def open(cls, name: str) -> 'MarkerCache':
+        return cls(config.get_cache_path() / 'markers' / f'{name}.sqlite')
+
+    def __enter__(self) -> 'MarkerCache':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: t.Optional[t.Type[BaseException]],
+        exc_value: t.Optional[BaseException],
+        traceback: t.Optional[types.TracebackType],
+    ) -> None:
+        if exc_type is None:
+            self._db.commit()
+        self._db.close()
+
+    def get(self, key: str) -> t.Optional[Listing]:
+        row = self._db.execute("SELECT listing FROM listings WHERE key = ?", (key,)).fetchone()
+        return None if row is None else Listing(**json.loads(row[0]))
+
+    def set(self, key: str, listing: Listing) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO listings (key, listing) VALUES (?, ?)",
+            (key, json.dumps(attr.asdict(listing))))
+
+
+def find_marked(
+    root: pathlib.Path,
+    markers: t.Sequence[Marker],
+    *,
+    filter: filters.Filter,
+    cache: MarkerCache,
+) -> t.List[pathlib.PurePosixPath]:
+    """
+    Find every directory under `root` excluded by a marker, relative to `root`.
+    Directories already excluded by `filter` are not scanned.
+    The root directory itself is never excluded.
+    """
+    fingerprint = hashlib.sha1('\0'.join(sorted(map(str, markers))).encode()).hexdigest()[:16]
+    names = {marker.file for marker in markers}
+    root_device = root.stat().st_dev
+    marked = []
+    stack = [pathlib.PurePosixPath()]
+    while stack:
+        directory = stack.pop()
+        try:
+            directory_stat = os.lstat(root / directory)
+        except OSError:
+            continue
+        if filter.one_file_system and directory_stat.st_dev != root_device:
+            continue
+
+        key = f'{fingerprint}:{root / directory}'
+        listing = cache.get(key)
+        if listing is None or listing.mtime != directory_stat.st_mtime_ns:
+            try:
+                listing = _list(root / directory, names, directory_stat.st_mtime_ns)
+            except OSError:
+                continue
+            cache.set(key, listing)
+
+        found = [marker for marker in markers if marker.file in listing.markers]
+        if directory.parts and any(marker.directory is None for marker in found):
+            marked.append(directory)
+            continue
+
+        excluded = {marker.directory for marker in found if marker.directory is not None}
+        for name in sorted(listing.directories, reverse=True):
+            path = directory / name
+            if name in excluded:
+                marked.append(path)
+            elif not filter.excluded(str(path), True):
+                stack.append(path)
+    return sorted(marked)
+
+
+def _list(path: pathlib.Path, names: t.Set[str], mtime: int) -> Listing:
+    directories = []
+    markers = []
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            directories.append(entry.name)
+        elif entry.name in names and _is_marker(entry):
+            markers.append(entry.name)
+    return Listing(mtime=mtime, directories=sorted(directories), markers=sorted(markers))
+
+
+def _is_marker(entry: 'os.DirEntry[str]') -> bool:
+    """A cache directory tag only counts if it has the right signature, as other programs expect."""
+    if entry.name != CACHEDIR_TAG:
+        return True
+    try:
+        if not stat.S_ISREG(entry.stat(follow_symlinks=False).st_mode):
+            return False
+        with open(entry.path, 'rb') as f:
+            return f.read(len(CACHEDIR_TAG_SIGNATURE)) == CACHEDIR_TAG_SIGNATURE
+    except OSError:
+        return False
+
+
+def exclude_pattern(path: pathlib.PurePosixPath) -> str:
+    """An anchored rsync pattern that excludes exactly the directory at `path`."""
+    pattern = str(path)
+    if any(char in pattern for char in '*?['):
+        # rsync matches wildcard characters literally if they are escaped with a backslash
+        pattern = re.sub(r'([*?\[\\])', r'\\\1', pattern)
+    return f'/{pattern}/'
@@ -0,0 +1,168 @@
+"""
+Find files and directories that were moved or renamed in a source directory since the last backup,
+so they can be moved on the target before rsync runs.
+
+rsync only looks for a similar file to build on in the same directory (`--fuzzy`),
+so a moved file is otherwise sent again in full, and stored twice in the snapshots.
+Files are recognised by their device, inode, size, and modification time,
+and directories by their device and inode,
+compared against an index of the source made at the last backup, kept in the cache directory.
+A wrong guess only costs time, as rsync still makes the target match the source afterwards.
+"""
+import hashlib
+import os
+import pathlib
+import sqlite3
+import stat
+import types
+import typing as t
+
+import attr
+
+from . import config, directories
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Entry:
+    device: int
+    inode: int
+    #: The size and modification time of a file, in nanoseconds. Both are 0 for directories.
+    size: int
+    mtime: int
+    is_dir: bool
+
+    @property
+    def inode_key(self) -> t.Tuple[int, int]:
+        return (self.device, self.inode)
+
+
+#: Every file and directory in a source directory, by path relative to the source directory
+Index = t.Dict[str, Entry]
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Move:
+    source: str
+    destination: str
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Plan:
+    """The moves to make on the target, and the index to save once the backup has finished."""
+    index: Index
+    moves: t.List[Move]
+
+    @classmethod
+    def make(cls, directory: directories.Directory) -> 'Plan':
+        index = scan(directory)
+        with IndexStore.open(directory) as store:
+            previous = store.load()
+        return cls(index=index, moves=find_moves(previous, index))
+
+    def save(self, directory: directories.Directory) -> None:
+        with IndexStore.open(directory) as store:
+            store.save(self.index)
+
+
+def scan(directory: directories.Directory) -> Index:
+    """Index every regular file and directory in the source that is not excluded."""
+    index = {}
+    for path, entry_stat in directory.filter().walk(directory.source_path):
+        if stat.S_ISDIR(entry_stat.st_mode):
+            index[str(path)] = Entry(
+                device=entry_stat.st_dev, inode=entry_stat.st_ino, size=0, mtime=0, is_dir=True)
+        elif stat.S_ISREG(entry_stat.st_mode):
+            index[str(path)] = Entry(
+                device=entry_stat.st_dev, inode=entry_stat.st_ino,
+                size=entry_stat.st_size, mtime=entry_stat.st_mtime_ns, is_dir=False)
+    return index
+
+
+def find_moves(previous: Index, current: Index) -> t.List[Move]:
+    """
+    Find the moves that turn the tree in `previous` in to the tree in `current`, in the order to make them.
+    Moving a directory moves everything in it,
+    so later moves take the earlier ones in to account.
+    Only paths that did not exist before are moved to,
+    and only paths that no longer exist, or are now something else, are moved from.
+    """
+    previous_paths: t.Dict[t.Tuple[int, int], t.Optional[str]] = {}
+    for path, entry in previous.items():
+        # Hard linked files can not be told apart, and rsync links them again anyway
+        key = entry.inode_key
+        previous_paths[key] = None if key in previous_paths else path
+
+    moved_directories: t.List[t.Tuple[str, str]] = []
+
+    def moved_to(path: str) -> str:
+        """Where a path from the previous tree is now on the target, after the moves so far."""
+        for source, destination in moved_directories:
+            if path == source or path.startswith(source + '/'):
+                path = destination + path[len(source):]
+        return path
+
+    moves = []
+    # Parents sort before their contents, so directories are moved before anything inside them
+    for path, entry in sorted(current.items()):
+        if path in previous or (old := previous_paths.get(entry.inode_key)) is None:
+            continue
+        old_entry = previous[old]
+        if old_entry != entry or current.get(old, None) == old_entry:
+            continue
+        source = moved_to(old)
+        if source == path or path.startswith(source + '/'):
+            continue
+        moves.append(Move(source=source, destination=path))
+        if entry.is_dir:
+            moved_directories.append((source, path))
+    return moves
+
+
+class IndexStore:
+    """
+    The index of a source directory made at the last backup to one target,
+    stored in a SQLite database in the cache directory.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(str(path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "path BLOB PRIMARY KEY, device INTEGER, inode INTEGER, "
+            "size INTEGER, mtime INTEGER, is_dir INTEGER)")
+
+    @classmethod
+    def open(cls, directory: directories.Directory) -> 'IndexStore':
+        key = f"{directory.source_path}:{directory.target.name}:{directory.target_path}"
+        name = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return cls(config.get_cache_path() / 'moves' / f'{name}.sqlite')
+
+    def __enter__(self) -> 'IndexStore':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: t.Optional[t.Type[BaseException]],
+        exc_value: t.Optional[BaseException],
+        traceback: t.Optional[types.TracebackType],
+    ) -> None:
+        if exc_type is None:
+            self._db.commit()
+        self._db.close()
+
+    def load(self) -> Index:
+        return {
+            os.fsdecode(path): Entry(device=device, inode=inode, size=size, mtime=mtime, is_dir=bool(is_dir))
+            for path, device, inode, size, mtime, is_dir in self._db.execute("SELECT * FROM entries")
+        }
+
+    def save(self, index: Index) -> None:
+        self._db.execute("DELETE FROM entries")
+        self._db.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (os.fsencode(path), entry.device, entry.inode, entry.size, entry.mtime, entry.is_dir)
+                for path, entry in index.items()
+            ))
@@ -0,0 +1,116 @@
+"""
+Run commands, measuring how much time, CPU, memory, and disk I/O each one uses.
+
+Almost all the work of a backup happens in other processes such as rsync,
+so this is where to look when a backup is slow or runs out of memory.
+Each measurement is passed to the function set with `set_recorder()`,
+which `instrumentation` uses to report them at the end of a run.
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+import typing as t
+
+import attr
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Usage:
+    """The resources used by one process. Anything that could not be measured is `None`."""
+    #: How long the process ran for
+    seconds: float
+    #: CPU time spent in the process and in the kernel on its behalf
+    user: t.Optional[float] = None
+    system: t.Optional[float] = None
+    #: The most memory the process used at once, in bytes
+    max_rss: t.Optional[int] = None
+    #: Bytes the process read from and wrote to disk
+    read_bytes: t.Optional[int] = None
+    written_bytes: t.Optional[int] = None
+
+    @classmethod
+    def from_rusage(cls, seconds: float, rusage: resource.struct_rusage) -> 'Usage':
+        return cls(
+            seconds=seconds, user=rusage.ru_utime, system=rusage.ru_stime,
+            max_rss=_child_max_rss(rusage.ru_maxrss),
+            read_bytes=rusage.ru_inblock * 512, written_bytes=rusage.ru_oublock * 512)
+
+
+def _child_max_rss(max_rss: int) -> t.Optional[int]:
+    """
+    The most memory a child process used, in bytes, if it is known.
+    Linux counts the memory used by this process before the child started a new program
+    as memory used by the child, so a child only using a little memory
+    appears to use as much as this process.
+    Only a child that used more memory than this process ever has can be measured.
+    """
+    if max_rss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+    # Kilobytes on Linux, but bytes on macOS
+    return max_rss * (1 if sys.platform == 'darwin' else 1024)
+
+
+#: Called as `recorder(command, usage, error=error, host=host)`
+Recorder = t.Callable[..., None]
+
+_recorder: t.Optional[Recorder] = None
+
+
+def set_recorder(recorder: t.Optional[Recorder]) -> None:
+    """Set the function called with the resources used by every process."""
+    global _recorder
+    _recorder = recorder
+
+
+def record(
+    command: t.Sequence[str],
+    usage: Usage,
+    *,
+    error: bool,
+    host: t.Optional[str] = None,
+) -> None:
+    """Record the resources used by a process. Processes run on another computer give its `host`."""
+    if _recorder is not None:
+        _recorder(command, usage, error=error, host=host)
+
+
+def wait(process: 'subprocess.Popen[bytes]', started: float) -> int:
+    """
+    Wait for a process to finish and record the resources it used.
+    Use this instead of `process.wait()`.
+    `started` is the `time.monotonic()` from just before the process was started.
+    """
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # The process has already been waited for, so its resources are unknown
+        process.wait()
+        usage = Usage(seconds=time.monotonic() - started)
+    else:
+        process.returncode = os.waitstatus_to_exitcode(status)
+        usage = Usage.from_rusage(time.monotonic() - started, rusage)
+    record(t.cast(t.List[str], process.args), usage, error=process.returncode != 0)
+    return process.returncode
+
+
+def check_call(cmd: t.List[str]) -> None:
+    """Like `subprocess.check_call()`, recording the resources the command used."""
+    started = time.monotonic()
+    with subprocess.Popen(cmd) as process:
+        returncode = wait(process, started)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def check_output(cmd: t.List[str]) -> bytes:
+    """Like `subprocess.check_output()`, recording the resources the command used."""
+    started = time.monotonic()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+        assert process.stdout is not None
+        output = process.stdout.read()
+        returncode = wait(process, started)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output)
+    return output
@@ -1,9 +1,13 @@
 from ._base import Rotator, Verdict, rotators
 from ._date import DateBucket
 from ._simple import KeepAll, KeepLatest
+from ._space import SpaceBudget
+from ._tiered import Tiered
 
-__all__ = ['Verdict', 'Rotator', 'rotators', 'DateBucket', 'KeepAll', 'KeepLatest']
+__all__ = ['Verdict', 'Rotator', 'rotators', 'DateBucket', 'KeepAll', 'KeepLatest', 'SpaceBudget', 'Tiered']
 
 rotators['all'] = KeepAll
 rotators['latest'] = KeepLatest
 rotators['date-bucket'] = DateBucket
+rotators['space-budget'] = SpaceBudget
+rotators['tiered'] = Tiered
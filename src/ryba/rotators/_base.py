@@ -1,11 +1,12 @@
 import abc
 import datetime
 import enum
+import pathlib
 import typing as t
 
-from .. import config, registry, targets
+from .. import config, exceptions, registry, targets
 
-Verdict = enum.Enum("Verdict", ["keep", "drop"])
+Verdict = enum.Enum("Verdict", ["keep", "drop", "migrate"])
 
 
 class Rotator(config.Configurable, abc.ABC):
@@ -15,13 +16,35 @@ class Rotator(config.Configurable, abc.ABC):
     def from_config_identifier(
         cls, identifier: str, config: config.Config
     ) -> 'Rotator':
-        options = config['rotate'][identifier].copy()
-        rotator_class = rotators[options.pop('strategy')]
-        return rotator_class.from_options(name=identifier, rotator=options)
+        return cls.from_strategy(identifier, config['rotate'][identifier], config)
+
+    @classmethod
+    def from_strategy(cls, name: str, options: dict, config: config.Config) -> 'Rotator':
+        """Create a rotator from a table of options naming the strategy to use."""
+        options = options.copy()
+        try:
+            rotator_class = rotators[options.pop('strategy')]
+        except KeyError:
+            raise exceptions.ConfigError(f"Rotator {name!r} has no valid 'strategy'")
+        return rotator_class.from_options(name=name, rotator=options, config=config)
 
     @classmethod
     @abc.abstractmethod
-    def from_options(cls, name: str, rotator: dict) -> 'Rotator': ...
+    def from_options(cls, name: str, rotator: dict, config: config.Config) -> 'Rotator': ...
+
+    def inspect(
+        self,
+        context: targets.TargetContext,
+        path: pathlib.Path,
+        backups: t.List[targets.Backup],
+    ) -> 'Rotator':
+        """
+        Gather anything else this rotator needs to know about the backups in `path`,
+        other than their timestamps.
+        Returns a rotator to use when rotating this directory.
+        Most rotators only need the timestamps, and return themselves.
+        """
+        return self
 
     def should_rotate(self) -> t.Union[t.Literal[True], str]:
         """
@@ -30,6 +53,14 @@ class Rotator(config.Configurable, abc.ABC):
         """
         return True
 
+    def migrate_target(self) -> t.Optional[targets.Target]:
+        """The target to move snapshots with the verdict `Verdict.migrate` to."""
+        return None
+
+    def migrated_rotator(self) -> t.Optional['Rotator']:
+        """The rotator for the snapshots already moved to the `migrate_target()`."""
+        return None
+
     @abc.abstractmethod
     def rotate_backups(
         self, timestamp: datetime.datetime, backups: t.List[targets.Backup]
@@ -39,8 +70,9 @@ class Rotator(config.Configurable, abc.ABC):
         timestamp, while `backups` is a list of backup timestamps.
 
         Implementations should return a tuple of `(backup, verdict, reason)`
-        for each backup timestamp, where `verdict` is `Verdict.keep` or
-        `Verdict.drop`, and `reason` is a short explanation of the verdict.
+        for each backup timestamp, where `verdict` is `Verdict.keep`,
+        `Verdict.drop`, or `Verdict.migrate` to move the backup to the `migrate_target()`,
+        and `reason` is a short explanation of the verdict.
         """
 
     def __str__(self) -> str:
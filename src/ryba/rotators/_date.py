@@ -4,7 +4,7 @@ import typing as t
 
 import attr
 
-from .. import targets
+from .. import config, targets
 from ._base import Rotator, Verdict
 
 
@@ -88,7 +88,7 @@ class DateBucket(Rotator):
     prefer_newest: bool = False
 
     @classmethod
-    def from_options(cls, name: str, rotator: dict) -> 'DateBucket':
+    def from_options(cls, name: str, rotator: dict, config: config.Config) -> 'DateBucket':
         return cls(name=name, **rotator)
 
     def rotate_backups(
@@ -3,7 +3,7 @@ import typing as t
 
 import attr
 
-from .. import exceptions, targets
+from .. import config, exceptions, targets
 from ._base import Rotator, Verdict
 
 
@@ -12,7 +12,7 @@ class KeepAll(Rotator):
     name: str
 
     @classmethod
-    def from_options(cls, name: str, rotator: dict) -> 'KeepAll':
+    def from_options(cls, name: str, rotator: dict, config: config.Config) -> 'KeepAll':
         if rotator != {}:
             raise exceptions.ConfigError("'all' stragegy does not take any options")
         return cls(name=name)
@@ -32,7 +32,7 @@ class KeepLatest(Rotator):
     count: int
 
     @classmethod
-    def from_options(cls, name: str, rotator: dict) -> 'KeepLatest':
+    def from_options(cls, name: str, rotator: dict, config: config.Config) -> 'KeepLatest':
         return cls(name=name, **rotator)
 
     def rotate_backups(
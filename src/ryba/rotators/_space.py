@@ -0,0 +1,236 @@
+import collections
+import datetime
+import gzip
+import hashlib
+import os
+import pathlib
+import struct
+import typing as t
+
+import attr
+
+from .. import config, exceptions, logging, targets, units
+from ._base import Rotator, Verdict
+
+logger = logging.getLogger(__name__)
+
+#: The device, inode, and allocated size of one inode in a snapshot
+_INODE = struct.Struct('<QQQ')
+
+InodeKey = t.Tuple[int, int]
+SnapshotInodes = t.Dict[InodeKey, int]
+
+
+def _usage_cache_path(context: targets.TargetContext, path: pathlib.Path) -> pathlib.Path:
+    digest = hashlib.sha256(str(context.make_path(path)).encode()).hexdigest()[:16]
+    return config.get_cache_path() / 'snapshot-usage' / f'{context.target.name}-{digest}'
+
+
+def _scan_snapshot(context: targets.TargetContext, path: pathlib.Path) -> SnapshotInodes:
+    """Find the space used by every inode in a snapshot, using one `find` command."""
+    output = context.check_output([
+        'find', str(context.make_path(path)), '-printf', '%D\\t%i\\t%b\\0'])
+    inodes: SnapshotInodes = {}
+    for record in output.split(b'\0'):
+        if record:
+            device, inode, blocks = record.split(b'\t')
+            inodes[int(device), int(inode)] = int(blocks) * 512
+    return inodes
+
+
+def snapshot_inodes(
+    context: targets.TargetContext,
+    path: pathlib.Path,
+    backups: t.List[targets.Backup],
+) -> t.Dict[targets.Backup, SnapshotInodes]:
+    """
+    Find the inodes in each snapshot in `path`, and the space each one uses.
+
+    Snapshots never change once they are made,
+    so the inodes in each snapshot are cached locally,
+    and only snapshots made since the last rotation need to be scanned.
+    Snapshots that do not exist yet are treated as empty.
+    """
+    cache_path = _usage_cache_path(context, path)
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    usage = {}
+    cache_files = set()
+    for backup in backups:
+        cache_file = cache_path / f'{backup.name}-{int(backup.timestamp.timestamp())}.gz'
+        cache_files.add(cache_file.name)
+        if cache_file.exists():
+            data = gzip.decompress(cache_file.read_bytes())
+            usage[backup] = {
+                (device, inode): size for device, inode, size in _INODE.iter_unpack(data)}
+            continue
+        if not context.exists(path / backup.name):
+            # Such as the snapshot a dry run would have made
+            usage[backup] = {}
+            continue
+
+        logger.log(logging.INFO, "Measuring snapshot %s", backup.name)
+        inodes = _scan_snapshot(context, path / backup.name)
+        data = b''.join(_INODE.pack(device, inode, size) for (device, inode), size in inodes.items())
+        temporary_file = cache_file.with_suffix('.tmp')
+        temporary_file.write_bytes(gzip.compress(data))
+        os.replace(temporary_file, cache_file)
+        usage[backup] = inodes
+
+    # Forget about snapshots that have been deleted
+    for cache_file in cache_path.iterdir():
+        if cache_file.name not in cache_files:
+            cache_file.unlink()
+
+    return usage
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class SpaceBudget(Rotator):
+    """
+    Keeps as many snapshots as fit within a budget.
+
+    Snapshots share hard linked files,
+    so dropping a snapshot only frees the space used by files that are in no other snapshot.
+    Snapshots are dropped until the budget is met,
+    picking the snapshot that frees the most space for the least lost history each time.
+    A snapshot is worth the time between the snapshots either side of it,
+    so snapshots close together are dropped before isolated snapshots.
+    The latest snapshot and any snapshots kept by the `minimum` rotator are never dropped.
+    """
+    name: str
+
+    #: The most space the snapshots for a directory can use, in bytes
+    budget: t.Optional[int] = None
+    #: Drop snapshots until at least this many bytes are free on the target
+    free_space: t.Optional[int] = None
+    #: Snapshots kept by this rotator are never dropped
+    minimum: t.Optional[Rotator] = None
+
+    #: The inodes in each snapshot, found by `inspect()`
+    inodes: t.Optional[t.Dict[targets.Backup, SnapshotInodes]] = None
+    #: The free space on the target, found by `inspect()`
+    available: t.Optional[int] = None
+
+    @classmethod
+    def from_options(cls, name: str, rotator: dict, config: config.Config) -> 'SpaceBudget':
+        options = rotator.copy()
+        for option in ['budget', 'free_space']:
+            if option in options:
+                try:
+                    options[option] = units.parse_size(options[option])
+                except ValueError as exc:
+                    raise exceptions.ConfigError(f"Invalid {option} for rotator {name!r}: {exc}")
+        if 'budget' not in options and 'free_space' not in options:
+            raise exceptions.ConfigError(f"Rotator {name!r} needs a 'budget' or a 'free_space'")
+
+        minimum = options.pop('minimum', None)
+        if isinstance(minimum, str):
+            minimum = config.get((Rotator, minimum))  # type: ignore
+        elif isinstance(minimum, dict):
+            minimum = Rotator.from_strategy(f'{name}.minimum', minimum, config)
+
+        try:
+            return cls(name=name, minimum=minimum, **options)
+        except TypeError as exc:
+            raise exceptions.ConfigError(str(exc))
+
+    def inspect(
+        self,
+        context: targets.TargetContext,
+        path: pathlib.Path,
+        backups: t.List[targets.Backup],
+    ) -> 'SpaceBudget':
+        if not context.uses_rsync:
+            raise exceptions.CommandError(
+                f"Rotator {self.name!r} can only measure targets that store plain files")
+        return attr.evolve(
+            self,
+            minimum=self.minimum.inspect(context, path, backups) if self.minimum else None,
+            inodes=snapshot_inodes(context, path, backups),
+            available=context.free_space(path) if self.free_space is not None else None)
+
+    def rotate_backups(
+        self, timestamp: datetime.datetime, backups: t.List[targets.Backup]
+    ) -> t.Iterable[t.Tuple[targets.Backup, Verdict, str]]:
+        backups = sorted(backups)
+        if not backups:
+            return
+        if self.inodes is None:
+            # Without a target to measure, such as when testing the rotator
+            yield from ((backup, Verdict.keep, "Snapshot sizes are unknown") for backup in backups)
+            return
+        inodes = {backup: self.inodes.get(backup, {}) for backup in backups}
+
+        protected = {backups[-1]: "Latest"}
+        if self.minimum is not None:
+            for backup, verdict, explanation in self.minimum.rotate_backups(timestamp, backups):
+                if verdict is Verdict.keep:
+                    protected.setdefault(backup, f"Minimum retention: {explanation}")
+
+        # How many kept snapshots each inode is in
+        references: t.Counter[InodeKey] = collections.Counter()
+        sizes: SnapshotInodes = {}
+        for backup_inodes in inodes.values():
+            references.update(backup_inodes.keys())
+            sizes.update(backup_inodes)
+        # How much space each snapshot would free if it were dropped
+        unique = {
+            backup: sum(size for key, size in backup_inodes.items() if references[key] == 1)
+            for backup, backup_inodes in inodes.items()
+        }
+        used = sum(sizes.values())
+        freed = 0
+
+        def over_budget() -> bool:
+            if self.budget is not None and used - freed > self.budget:
+                return True
+            if self.free_space is not None and self.available is not None:
+                return self.available + freed < self.free_space
+            return False
+
+        kept = list(backups)
+        dropped: t.Dict[targets.Backup, str] = {}
+        while over_budget():
+            candidates = [
+                (self._worth(kept, index) / unique[backup], backup)
+                for index, backup in enumerate(kept)
+                if backup not in protected and unique[backup] > 0
+            ]
+            if not candidates:
+                logger.log(
+                    logging.WARNING, "Can not meet the budget for rotator %r, %s still used",
+                    self.name, units.format_size(used - freed))
+                break
+            _, backup = min(candidates)
+            kept.remove(backup)
+            freed += unique[backup]
+            dropped[backup] = f"Frees {units.format_size(unique[backup])}"
+
+            # Inodes shared with only one other snapshot are now unique to that snapshot
+            for key, size in inodes[backup].items():
+                references[key] -= 1
+                if references[key] == 1:
+                    for other in kept:
+                        if key in inodes[other]:
+                            unique[other] += size
+                            break
+
+        for backup in backups:
+            if backup in dropped:
+                yield backup, Verdict.drop, dropped[backup]
+            elif backup in protected:
+                yield backup, Verdict.keep, protected[backup]
+            else:
+                yield backup, Verdict.keep, f"Fits in budget, using {units.format_size(unique[backup])}"
+
+    @staticmethod
+    def _worth(kept: t.List[targets.Backup], index: int) -> float:
+        """
+        How much history a snapshot holds, in seconds:
+        the time between the snapshots either side of it.
+        The oldest snapshot holds the time until the next snapshot.
+        """
+        after = kept[index + 1].timestamp
+        before = kept[index - 1].timestamp if index > 0 else kept[index].timestamp
+        return max((after - before).total_seconds(), 1)
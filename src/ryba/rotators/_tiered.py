@@ -0,0 +1,105 @@
+import datetime
+import pathlib
+import typing as t
+
+import attr
+
+from .. import config, exceptions, targets
+from ._base import Rotator, Verdict
+
+
+def _sub_rotator(name: str, option: str, value: t.Any, config: config.Config) -> Rotator:
+    if isinstance(value, str):
+        return config.get((Rotator, value))  # type: ignore
+    if isinstance(value, dict):
+        return Rotator.from_strategy(f'{name}.{option}', value, config)
+    raise exceptions.ConfigError(f"Rotator {name!r} needs a '{option}' rotator")
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class Tiered(Rotator):
+    """
+    Keeps recent snapshots on the target, and moves older snapshots to a colder target.
+
+    Snapshots kept by the `hot` rotator stay where they are.
+    The `cold` rotator is run over these snapshots and the snapshots already on the cold target together,
+    so a snapshot is only migrated if it would be kept alongside what has already been migrated.
+    Snapshots it keeps that are not kept by the `hot` rotator are migrated to the `target`.
+    Everything else is dropped.
+    Snapshots already on the cold target are rotated using the `cold` rotator as well.
+    """
+    name: str
+
+    #: Snapshots kept by this rotator stay on the hot target
+    hot: Rotator
+    #: Snapshots kept by this rotator are migrated to the cold target
+    cold: Rotator
+    #: The cold target, where migrated snapshots are kept at the same path as on the hot target
+    target: targets.Target
+    #: The snapshots already on the cold target, found by `inspect()`
+    _cold_backups: t.List[targets.Backup] = attr.ib(factory=list)
+
+    @classmethod
+    def from_options(cls, name: str, rotator: dict, config: config.Config) -> 'Tiered':
+        options = rotator.copy()
+        hot = _sub_rotator(name, 'hot', options.pop('hot', None), config)
+        cold = _sub_rotator(name, 'cold', options.pop('cold', None), config)
+        if 'target' not in options:
+            raise exceptions.ConfigError(f"Rotator {name!r} needs a cold 'target'")
+        target = config.get((targets.Target, options.pop('target')))  # type: ignore
+        try:
+            return cls(name=name, hot=hot, cold=cold, target=target, **options)
+        except TypeError as exc:
+            raise exceptions.ConfigError(str(exc))
+
+    def inspect(
+        self,
+        context: targets.TargetContext,
+        path: pathlib.Path,
+        backups: t.List[targets.Backup],
+    ) -> 'Tiered':
+        if not context.uses_rsync:
+            raise exceptions.CommandError(
+                f"Rotator {self.name!r} can only migrate from targets that store plain files")
+        with self.target.connect() as cold_context:
+            cold_backups = list(cold_context.list_backups(path)) if cold_context.exists(path) else []
+        return attr.evolve(
+            self,
+            hot=self.hot.inspect(context, path, backups),
+            cold=self.cold.inspect(context, path, backups),
+            cold_backups=cold_backups)
+
+    def migrate_target(self) -> t.Optional[targets.Target]:
+        return self.target
+
+    def migrated_rotator(self) -> t.Optional[Rotator]:
+        return self.cold
+
+    def rotate_backups(
+        self, timestamp: datetime.datetime, backups: t.List[targets.Backup]
+    ) -> t.Iterable[t.Tuple[targets.Backup, Verdict, str]]:
+        hot = _kept(self.hot, timestamp, backups)
+        migrated = {backup.name for backup in self._cold_backups}
+        cold = _kept(self.cold, timestamp, sorted({*backups, *self._cold_backups}))
+        for backup in sorted(backups):
+            if backup in hot:
+                yield backup, Verdict.keep, f"Hot tier: {hot[backup]}"
+            elif backup.name in migrated:
+                yield backup, Verdict.drop, "Already on the cold tier"
+            elif backup in cold:
+                yield backup, Verdict.migrate, f"Cold tier: {cold[backup]}"
+            else:
+                yield backup, Verdict.drop, "Not kept by either tier"
+
+
+def _kept(
+    rotator: Rotator, timestamp: datetime.datetime, backups: t.List[targets.Backup],
+) -> t.Dict[targets.Backup, str]:
+    """The backups a rotator keeps, and why."""
+    if (reason := rotator.should_rotate()) is not True:
+        return {backup: reason for backup in backups}
+    return {
+        backup: explanation
+        for backup, verdict, explanation in rotator.rotate_backups(timestamp, backups)
+        if verdict is Verdict.keep
+    }
@@ -0,0 +1,103 @@
+"""
+Run rsync, and the options every command that runs rsync shares.
+"""
+import os
+import re
+import subprocess
+import sys
+import time
+import typing as t
+
+from . import exceptions, logging, processes
+
+logger = logging.getLogger(__name__)
+
+#: How much of the end of the rsync output to keep to find the transfer statistics
+OUTPUT_TAIL = 1 << 16
+
+#: Exit codes that mean some files could not be copied, see `check_returncode()`
+PARTIAL_RETURNCODES = (23, 24)
+
+
+def preserve_options() -> t.List[str]:
+    # The following rsync options are intended to preserve
+    # as much filesystem metadata as possible.
+    return ['--acls', '--archive', '--hard-links', '--numeric-ids', '--xattrs']
+
+
+def ensure_trailing_slash(path: str) -> str:
+    """Ensure a path ends with a slash."""
+    if not path.endswith('/'):
+        return path + '/'
+    return path
+
+
+def run(command: t.List[str], *, echo: bool) -> t.Tuple[int, bytes]:
+    """
+    Run rsync, passing its output through to stdout if `echo` is set.
+    Returns the exit code and the tail end of the output,
+    which will contain the transfer statistics.
+    """
+    tail = b''
+    started = time.monotonic()
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        assert process.stdout is not None
+        while chunk := os.read(process.stdout.fileno(), 1 << 16):
+            if echo:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+            tail = (tail + chunk)[-OUTPUT_TAIL:]
+        returncode = processes.wait(process, started)
+    return returncode, tail
+
+
+def check_returncode(returncode: int, *, action: str = "Backup") -> None:
+    """
+    Raise an `RsyncError` if rsync failed.
+    `action` names what failed in the message, such as "Backup" or "Restore".
+    """
+    # From `man rsync':
+    #  - 23: Partial transfer due to error.
+    #  - 24: Partial transfer due to vanished source files.
+    # This can be expected on a running system
+    # without proper filesystem snapshots :-).
+    if returncode == 0 or returncode in PARTIAL_RETURNCODES:
+        if returncode != 0:
+            logger.log(
+                logging.WARNING,
+                "Ignoring `partial transfer' warnings (rsync exited with %i).",
+                returncode,
+            )
+    else:
+        logger.log(logging.ERROR, "%s failed! (rsync exited with %i)", action, returncode)
+        raise exceptions.RsyncError("rsync call failed", returncode)
+
+
+_FILES_TRANSFERRED = re.compile(rb'^Number of regular files transferred: ([\d,.]+)$', re.MULTILINE)
+_BYTES_TRANSFERRED = re.compile(rb'^Total transferred file size: ([\d,.]+[KMGTP]?) bytes$', re.MULTILINE)
+
+
+def parse_stats(output: bytes) -> t.Tuple[t.Optional[int], t.Optional[int]]:
+    """
+    Find the statistics printed by `rsync --info=stats2` in its output.
+    Returns how many files and how many bytes were transferred, if rsync printed them.
+    """
+    files = bytes_ = None
+    if (match := _FILES_TRANSFERRED.search(output)) is not None:
+        files = int(_parse_number(match.group(1).decode()))
+    if (match := _BYTES_TRANSFERRED.search(output)) is not None:
+        bytes_ = int(_parse_number(match.group(1).decode()))
+    return files, bytes_
+
+
+def _parse_number(value: str) -> float:
+    """
+    Parse a number as printed by `rsync --human-readable`.
+    Large numbers are printed with a suffix in units of 1000, such as `1.23M`.
+    The decimal point depends on the locale.
+    Smaller numbers may contain thousands separators, such as `12,345`.
+    """
+    if value[-1] in 'KMGTP':
+        multiplier: int = 1000 ** ('KMGTP'.index(value[-1]) + 1)
+        return float(value[:-1].replace(',', '.')) * multiplier
+    return float(re.sub(r'[,.]', '', value))
@@ -1,12 +1,20 @@
-from ._base import Backup, Target, TargetContext, target_types
+from ._base import Backup, Target, TargetContext, TransferStats, target_types
+from ._chunks import ChunkStore, ChunkStoreContext
 from ._local import Local, LocalContext
+from ._manifest import ManifestContext
+from ._s3 import S3, S3Context
 from ._ssh import SSH, SSHContext
 
 target_types['local'] = Local
 target_types['ssh'] = SSH
+target_types['chunks'] = ChunkStore
+target_types['s3'] = S3
 
 __all__ = [
-    'Backup', 'Target', 'TargetContext', 'target_types',
+    'Backup', 'Target', 'TargetContext', 'TransferStats', 'target_types',
+    'ChunkStore', 'ChunkStoreContext',
     'Local', 'LocalContext',
+    'ManifestContext',
+    'S3', 'S3Context',
     'SSH', 'SSHContext',
 ]
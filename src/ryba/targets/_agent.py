@@ -0,0 +1,94 @@
+"""
+The local end of the ryba agent. See `_helper.py` for the remote end.
+"""
+import base64
+import pathlib
+import shlex
+import threading
+import typing as t
+
+import paramiko
+
+from .. import logging
+from . import _helper
+
+logger = logging.getLogger(__name__)
+
+#: Reads the length of the agent source code, then the source code, then runs it.
+#: The agent then reads requests from the rest of stdin.
+BOOTSTRAP = (
+    "import sys; "
+    "n = int(sys.stdin.buffer.readline()); "
+    "exec(compile(sys.stdin.buffer.read(n), 'ryba-agent', 'exec'))"
+)
+
+
+class AgentError(Exception):
+    """Raised when an operation fails on the target."""
+
+
+class Agent:
+    """
+    A connection to a ryba agent running on the target, over one SSH channel.
+    Many operations can be sent in one request using `request()`,
+    saving a round trip for each operation.
+    """
+
+    def __init__(self, channel: paramiko.Channel):
+        self._channel = channel
+        self._stdin = channel.makefile_stdin('wb')
+        self._stdout = channel.makefile('rb')
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, transport: paramiko.Transport, python: str = 'python3') -> 'Agent':
+        """
+        Start the agent on the target, sending it the agent source code.
+        Raises `AgentError` if the agent could not be started,
+        for example if Python is not installed on the target.
+        """
+        source = pathlib.Path(_helper.__file__).read_bytes()
+        channel = transport.open_session()
+        channel.exec_command(shlex.join([python, '-c', BOOTSTRAP]))
+        agent = cls(channel)
+        agent._stdin.write(b'%d\n' % len(source) + source)
+        agent._stdin.flush()
+        try:
+            version = agent.call('ping')
+        except (AgentError, EOFError, OSError) as exc:
+            agent.close()
+            raise AgentError(f"Could not start agent: {exc}") from exc
+        if version != _helper.PROTOCOL_VERSION:
+            agent.close()
+            raise AgentError(f"Agent speaks protocol version {version}, expected {_helper.PROTOCOL_VERSION}")
+        return agent
+
+    def close(self) -> None:
+        self._channel.close()
+
+    def request(self, operations: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+        """
+        Send many operations in one request.
+        Returns a result for each operation,
+        either `{"ok": value}` or `{"error": message}`.
+        """
+        with self._lock:
+            _helper.write_message(t.cast(t.BinaryIO, self._stdin), operations)
+            return t.cast(
+                t.List[t.Dict[str, t.Any]],
+                _helper.read_message(t.cast(t.BinaryIO, self._stdout)))
+
+    def call(self, op: str, **arguments: t.Any) -> t.Any:
+        """Send a single operation and return its result, raising `AgentError` if it failed."""
+        (result,) = self.request([{'op': op, **arguments}])
+        if 'error' in result:
+            raise AgentError(result['error'])
+        return result['ok']
+
+    @staticmethod
+    def decode(data: str) -> bytes:
+        return base64.b64decode(data)
+
+    @staticmethod
+    def encode(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
@@ -1,12 +1,23 @@
 import abc
 import datetime
+import os
 import pathlib
+import tempfile
 import typing as t
 
 import attr
 import iso8601
 
-from .. import config, constants, exceptions, registry
+from .. import config, constants, exceptions, registry, rsync, units
+
+if t.TYPE_CHECKING:
+    from .. import filters, journal
+
+#: How much of a stream to copy at a time
+STREAM_CHUNK_SIZE = 1 << 20
+
+#: How many files to move with each remote command
+MOVE_BATCH_SIZE = 500
 
 
 @attr.s(auto_attribs=True, kw_only=True, frozen=True)
@@ -15,6 +26,15 @@ class Backup:
     timestamp: datetime.datetime
 
 
+@attr.s(auto_attribs=True, kw_only=True)
+class TransferStats:
+    """Statistics about a transfer, as reported by `rsync --stats`."""
+    files_transferred: t.Optional[int] = None
+    bytes_transferred: t.Optional[int] = None
+    #: The changes made to the current snapshot, if they are known
+    changes: t.Optional[t.List['journal.Change']] = None
+
+
 class ContextException(exceptions.CommandError):
     """
     Raised when there is an error connecting to / activating the target context.
@@ -48,8 +68,12 @@ class Target(config.Configurable, abc.ABC):
     @abc.abstractmethod
     def from_options(cls, name: str, config: dict) -> "Target": ...
 
-    @abc.abstractmethod
-    def rsync_arguments(self, destination: pathlib.Path) -> t.Tuple[str, t.List[str]]: ...
+    def rsync_arguments(self, destination: pathlib.Path) -> t.Tuple[str, t.List[str]]:
+        """
+        How to name `destination` on this target to rsync, and any options rsync needs for this target.
+        Targets that do not store plain files can not be used with rsync.
+        """
+        raise ContextException(f"Target {self.name} does not store plain files, so can not be used with rsync")
 
     @abc.abstractmethod
     def connect(self) -> 'TargetContext':
@@ -61,6 +85,12 @@ class Target(config.Configurable, abc.ABC):
 
 
 class TargetContext(t.ContextManager['TargetContext']):
+    target: Target
+
+    #: Files are sent to this target using rsync.
+    #: Targets that store files some other way implement `receive_files()` instead.
+    uses_rsync: bool = True
+
     @abc.abstractmethod
     def make_path(self, path: pathlib.Path) -> pathlib.Path:
         """
@@ -72,6 +102,10 @@ class TargetContext(t.ContextManager['TargetContext']):
     def execute(self, cmd: t.List[str]) -> None:
         """Run a command on the target."""
 
+    @abc.abstractmethod
+    def check_output(self, cmd: t.List[str]) -> bytes:
+        """Run a command on the target and return its standard output."""
+
     @abc.abstractmethod
     def exists(self, path: pathlib.Path) -> bool: ...
 
@@ -84,21 +118,232 @@ class TargetContext(t.ContextManager['TargetContext']):
     @abc.abstractmethod
     def list_directory(self, path: pathlib.Path) -> t.List[str]: ...
 
+    def read_files(self, paths: t.List[pathlib.Path]) -> t.Dict[pathlib.Path, t.Optional[bytes]]:
+        """
+        Read many files at once. Files that do not exist are returned as `None`.
+        Targets where each operation is expensive can override this to read
+        all the files at once.
+        """
+        return {
+            path: self.read_file(path) if self.exists(path) else None
+            for path in paths
+        }
+
+    def execute_many(self, cmds: t.List[t.List[str]]) -> None:
+        """
+        Run many commands on the target, stopping at the first one that fails.
+        Targets where each operation is expensive can override this to run
+        all the commands at once.
+        """
+        for cmd in cmds:
+            self.execute(cmd)
+
+    def receive_files(
+        self,
+        source: pathlib.Path,
+        path: pathlib.Path,
+        *,
+        filter: 'filters.Filter',
+        dry_run: bool,
+    ) -> TransferStats:
+        """
+        Copy the files in `source` to the current snapshot in `path`.
+        Targets that store plain files are sent files with rsync,
+        and the backup command builds its own rsync command for them instead of calling this.
+        Targets that do not use rsync override this.
+        """
+        current = self.make_path(path / constants.CURRENT_SNAPSHOT_NAME)
+        destination, arguments = self.target.rsync_arguments(current)
+        command = [
+            'rsync', '--human-readable', '--info=stats2', '--delete-after', '--delete-excluded',
+            *rsync.preserve_options(), *arguments]
+        if filter.one_file_system:
+            command.append('--one-file-system')
+        command.extend(f"--filter={'+' if rule.include else '-'} {rule.pattern}" for rule in filter.rules)
+        if dry_run:
+            command.append('--dry-run')
+        else:
+            self.execute(['mkdir', '-p', str(current)])
+        command.extend([rsync.ensure_trailing_slash(str(source)), rsync.ensure_trailing_slash(destination)])
+        returncode, output = rsync.run(command, echo=False)
+        rsync.check_returncode(returncode)
+        files_transferred, bytes_transferred = rsync.parse_stats(output)
+        return TransferStats(files_transferred=files_transferred, bytes_transferred=bytes_transferred)
+
+    def restore_files(
+        self,
+        snapshot: pathlib.Path,
+        destination: pathlib.Path,
+        *,
+        only: t.Optional[t.Callable[[str], bool]] = None,
+        jobs: int = 1,
+    ) -> None:
+        """
+        Copy the files in a snapshot to the local directory `destination`.
+        If `only` is given, only the paths it returns true for are restored.
+        Targets that store plain files are copied from with one rsync,
+        though the restore command builds its own rsync commands for them instead of calling this.
+        Targets that do not use rsync override this.
+        """
+        source, arguments = self.target.rsync_arguments(self.make_path(snapshot))
+        command = [
+            'rsync', '--human-readable', *rsync.preserve_options(), *arguments,
+            *(f'--exclude=/{name}' for name in constants.SNAPSHOT_FILE_NAMES)]
+        with tempfile.TemporaryDirectory(prefix='ryba-restore-') as temporary_directory:
+            if only is not None:
+                listing = self.check_output(['find', str(self.make_path(snapshot)), '-mindepth', '1', '-printf', '%P\\0'])
+                paths = [path for path in listing.split(b'\0') if path and only(os.fsdecode(path))]
+                files_from = pathlib.Path(temporary_directory) / 'paths'
+                files_from.write_bytes(b''.join(path + b'\0' for path in paths))
+                command.extend([f'--files-from={files_from}', '--from0'])
+            command.extend([rsync.ensure_trailing_slash(source), rsync.ensure_trailing_slash(str(destination))])
+            returncode, _ = rsync.run(command, echo=False)
+        rsync.check_returncode(returncode, action="Restore")
+
+    @abc.abstractmethod
+    def stream_output(self, cmd: t.List[str], output: t.BinaryIO) -> int:
+        """
+        Run a command on the target, copying its standard output to `output` as it is produced,
+        instead of collecting it all in memory. Returns how many bytes were copied.
+        """
+
+    @abc.abstractmethod
+    def stream_input(self, cmd: t.List[str], input: t.BinaryIO, *, echo: bool) -> int:
+        """
+        Run a command on the target, copying everything from `input` to its standard input,
+        and passing its output through to stdout if `echo` is set. Returns the exit code.
+        `input` must be a real file or pipe, such as the output of another process.
+        """
+
+    def run_with_input(self, cmd: t.List[str], input_file: pathlib.Path, *, echo: bool) -> int:
+        """
+        Run a command on the target with a local file as its standard input,
+        passing its output through to stdout if `echo` is set. Returns the exit code.
+        """
+        with open(input_file, 'rb') as input:
+            return self.stream_input(cmd, input, echo=echo)
+
+    def export_snapshot(
+        self,
+        snapshot: pathlib.Path,
+        output: t.BinaryIO,
+        *,
+        compressor: t.Optional[str] = None,
+    ) -> int:
+        """
+        Write a snapshot to `output` as a tar archive,
+        compressed by piping it through the `compressor` command.
+        The archive is made and compressed on the target, then streamed back.
+        Files that are hard linked together in the snapshot are stored as hard links.
+        Returns the size of the archive.
+        """
+        cmd = [
+            'tar', '--create', '--file=-', '--directory', str(self.make_path(snapshot)),
+            '--numeric-owner', '--acls', '--xattrs', '--sparse',
+            *(f'--exclude=./{name}' for name in constants.SNAPSHOT_FILE_NAMES),
+        ]
+        if compressor is not None:
+            cmd.append(f'--use-compress-program={compressor}')
+        cmd.append('.')
+        return self.stream_output(cmd, output)
+
+    def move_files(self, path: pathlib.Path, moves: t.List[t.Tuple[str, str]]) -> int:
+        """
+        Move files and directories inside `path`, given as `(source, destination)` paths relative to `path`,
+        creating the parent directories of each destination as needed.
+        Moves whose source is missing or whose destination already exists are skipped.
+        Returns how many were moved.
+        """
+        moved = 0
+        for start in range(0, len(moves), MOVE_BATCH_SIZE):
+            arguments = [name for move in moves[start:start + MOVE_BATCH_SIZE] for name in move]
+            output = self.check_output(['sh', '-c', _MOVE_SCRIPT, 'sh', str(self.make_path(path)), *arguments])
+            moved += int(output.split()[-1])
+        return moved
+
+    def ensure_directory(self, path: pathlib.Path) -> None:
+        """
+        Create a directory, and any missing parents, unless it already exists.
+        Targets without real directories, such as object stores, override this to do nothing.
+        """
+        if not self.exists(path):
+            self.execute(["mkdir", "-p", str(self.make_path(path))])
+
+    def free_space(self, path: pathlib.Path) -> int:
+        """How many bytes are available on the file system that `path` is on."""
+        output = self.check_output(['df', '-P', '-k', str(self.make_path(path))])
+        # The last line is the file system; the fourth column is the available space
+        return int(output.decode().splitlines()[-1].split()[3]) * 1024
+
+    def create_snapshot(self, current: pathlib.Path, snapshot: pathlib.Path) -> None:
+        """Copy the current snapshot to a new snapshot, hard linking all the files."""
+        self.execute([
+            "cp", "--archive", "--link", "--no-target-directory", "--force",
+            str(self.make_path(current)), str(self.make_path(snapshot)),
+        ])
+
+    def delete_snapshots(self, path: pathlib.Path, names: t.List[str]) -> None:
+        """Delete some snapshots from `path`."""
+        commands = []
+        for name in names:
+            entry_path = self.make_path(path / name)
+            commands.append(["chmod", "-R", "u+wX", str(entry_path)])
+            commands.append(["rm", "-rf", str(entry_path)])
+        self.execute_many(commands)
+
     def list_backups(self, path: pathlib.Path) -> t.Iterable[Backup]:
         """
         Find all the backups in a directory. A `(directory name, timestamp)`
         tuple is returned for each backup directory found.
+        Entries starting with a dot are ryba's own, and are never backups.
+        Entries that are not directories have no timestamp file, so they are skipped too.
         """
-        entries = self.list_directory(path)
+        entries = [entry for entry in self.list_directory(path) if not entry.startswith('.')]
+        timestamp_files = self.read_files([
+            path / entry / constants.TIMESTAMP_FILE_NAME for entry in entries])
         for entry in entries:
-            timestamp_file = path / entry / constants.TIMESTAMP_FILE_NAME
-            if not self.exists(timestamp_file):
+            content = timestamp_files[path / entry / constants.TIMESTAMP_FILE_NAME]
+            if content is None:
                 continue
-            content = self.read_file(timestamp_file).decode()
             try:
-                yield Backup(name=entry, timestamp=iso8601.parse_date(content))
+                yield Backup(name=entry, timestamp=iso8601.parse_date(content.decode()))
             except ValueError:
                 continue
 
 
+def parse_bwlimit(name: str, config: dict) -> dict:
+    """Parse the `bwlimit` option of a target, such as `'10MB'`, in to bytes per second."""
+    if 'bwlimit' in config:
+        try:
+            config['bwlimit'] = units.parse_size(config['bwlimit'])
+        except ValueError as exc:
+            raise exceptions.ConfigError(f"Invalid bwlimit for target {name!r}: {exc}")
+    return config
+
+
+def copy_stream(read: t.Callable[[int], bytes], output: t.BinaryIO) -> int:
+    """Copy everything from a `read()` function to `output`, returning how many bytes were copied."""
+    copied = 0
+    while data := read(STREAM_CHUNK_SIZE):
+        output.write(data)
+        copied += len(data)
+    return copied
+
+
+#: Moves each pair of arguments after the first, which is the directory to work in,
+#: and prints how many were moved
+_MOVE_SCRIPT = """
+cd "$1" || exit 1
+shift
+moved=0
+while [ "$#" -ge 2 ]; do
+    if [ -e "$1" ] && [ ! -e "$2" ] && mkdir -p -- "$(dirname -- "$2")" && mv -- "$1" "$2"; then
+        moved=$((moved + 1))
+    fi
+    shift 2
+done
+echo "$moved"
+"""
+
+
 target_types = registry.Registry[t.Type[Target]]()
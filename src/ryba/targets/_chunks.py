@@ -0,0 +1,169 @@
+"""
+A target that splits files in to content-defined chunks,
+and stores each unique chunk once.
+
+Large files that change a little between backups,
+such as virtual machine images, mailboxes, and databases,
+only need the chunks around each change stored again,
+instead of a whole new copy of the file.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import tempfile
+import typing as t
+import zlib
+
+import attr
+
+from .. import constants, exceptions
+from . import _local, _manifest
+
+#: Chunks are never smaller than this, except at the end of a file
+MIN_CHUNK_SIZE = 1 << 18
+#: The average size of a chunk
+AVERAGE_CHUNK_SIZE = 1 << 20
+#: Chunks are never larger than this
+MAX_CHUNK_SIZE = 1 << 22
+#: How much of a file to read at once.
+#: Every chunk found in a block is hashed and stored before the next block is read.
+READ_SIZE = 4 * MAX_CHUNK_SIZE
+
+
+def iter_chunks(stream: t.BinaryIO) -> t.Iterator[bytes]:
+    """
+    Split the contents of a file in to content-defined chunks using FastCDC.
+    Chunk boundaries depend only on the content around them,
+    so an insertion or deletion only changes the chunks around it,
+    and later chunks still line up with the chunks from previous backups.
+
+    The file is read in to one buffer that is reused for the whole file.
+    A chunk near the end of the buffer might continue past it,
+    so it is moved to the start of the buffer and chunked again once more of the file is read.
+    """
+    try:
+        from fastcdc import fastcdc
+    except ImportError:
+        raise exceptions.ConfigError("Chunk stores need fastcdc to be installed: pip install ryba[chunks]")
+
+    buffer = memoryview(bytearray(READ_SIZE + MAX_CHUNK_SIZE))
+    length = 0
+    eof = False
+    while not eof:
+        while length < len(buffer) and not eof:
+            read = stream.readinto(buffer[length:])  # type: ignore[attr-defined]
+            length += read
+            eof = not read
+
+        consumed = 0
+        for chunk in fastcdc(buffer[:length], MIN_CHUNK_SIZE, AVERAGE_CHUNK_SIZE, MAX_CHUNK_SIZE):
+            if not eof and chunk.offset + MAX_CHUNK_SIZE > length:
+                break
+            yield bytes(buffer[chunk.offset:chunk.offset + chunk.length])
+            consumed = chunk.offset + chunk.length
+        buffer[:length - consumed] = buffer[consumed:length]
+        length -= consumed
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class ChunkStore(_local.Local):
+    """
+    A chunk store in a directory on the local machine,
+    such as a mounted external hard drive.
+    """
+    #: How many chunks to hash and compress at once
+    jobs: int = 4
+
+    def connect(self) -> 'ChunkStoreContext':
+        return ChunkStoreContext(target=self)
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class ChunkStoreContext(_manifest.ManifestContext, _local.LocalContext):
+    """
+    Chunks are named by their SHA-256 digest,
+    compressed using zlib,
+    and stored under the objects directory next to the snapshots
+    in files named `ab/cdef...`.
+    Hashing and compressing release the GIL,
+    so up to `jobs` chunks of a file are hashed and compressed at once in threads.
+    """
+    target: ChunkStore
+    #: The chunks known to exist in each object store
+    _known: t.Dict[pathlib.Path, t.Set[str]] = attr.ib(factory=dict, init=False)
+
+    def _object_path(self, path: pathlib.Path, name: str) -> pathlib.Path:
+        return self.make_path(path / constants.OBJECTS_DIRECTORY_NAME / name[:2] / name[2:])
+
+    def store_file(self, path: pathlib.Path, source: pathlib.Path) -> _manifest.StoredFile:
+        if path not in self._known:
+            self._known[path] = self.list_objects(path)
+        known = self._known[path]
+
+        names: t.List[str] = []
+        stored = size = 0
+        pending: t.Deque['concurrent.futures.Future[t.Tuple[str, t.Optional[bytes]]]'] = collections.deque()
+
+        def write_next() -> None:
+            nonlocal stored
+            name, data = pending.popleft().result()
+            names.append(name)
+            if name not in known:
+                # Only chunks that were already known are left uncompressed
+                assert data is not None
+                stored += self._write_object(path, name, data)
+                known.add(name)
+
+        jobs = self.target.jobs
+        with open(source, 'rb') as f, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            file_stat = os.fstat(f.fileno())
+            for chunk in iter_chunks(f):
+                size += len(chunk)
+                pending.append(executor.submit(_prepare_chunk, chunk, known))
+                if len(pending) > jobs:
+                    write_next()
+            while pending:
+                write_next()
+            # Any chunks already written are left for the next rotation to clean up
+            if size != file_stat.st_size or _manifest.changed_since(file_stat, os.fstat(f.fileno())):
+                raise _manifest.FileChangedError(str(source))
+        return names, stored, file_stat
+
+    def _write_object(self, path: pathlib.Path, name: str, data: bytes) -> int:
+        """Write an object atomically, so an interrupted backup never leaves a partial chunk."""
+        object_path = self._object_path(path, name)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=object_path.parent, prefix='.tmp-', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, object_path)
+        return len(data)
+
+    def read_object(self, path: pathlib.Path, name: str) -> bytes:
+        data = zlib.decompress(self._object_path(path, name).read_bytes())
+        if hashlib.sha256(data).hexdigest() != name:
+            raise ValueError(f"Chunk {name} is damaged")
+        return data
+
+    def list_objects(self, path: pathlib.Path) -> t.Set[str]:
+        objects_path = self.make_path(path / constants.OBJECTS_DIRECTORY_NAME)
+        if not objects_path.exists():
+            return set()
+        return {
+            prefix.name + entry.name
+            for prefix in os.scandir(objects_path) if prefix.is_dir()
+            for entry in os.scandir(prefix.path) if not entry.name.startswith('.tmp-')
+        }
+
+    def remove_objects(self, path: pathlib.Path, names: t.Iterable[str]) -> None:
+        known = self._known.get(path, set())
+        for name in names:
+            self._object_path(path, name).unlink(missing_ok=True)
+            known.discard(name)
+
+
+def _prepare_chunk(chunk: bytes, known: t.Set[str]) -> t.Tuple[str, t.Optional[bytes]]:
+    """Name a chunk, and compress it if it is not already known to be stored."""
+    name = hashlib.sha256(chunk).hexdigest()
+    return name, None if name in known else zlib.compress(chunk)
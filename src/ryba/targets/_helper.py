@@ -0,0 +1,327 @@
+"""
+The ryba agent, run on SSH targets to batch up target operations.
+
+This module is sent to the target and run with `python3`.
+It must only use the standard library, and must not import anything else from ryba.
+
+Messages in both directions are a four byte big-endian length
+followed by that many bytes of JSON.
+Each request is a list of operations, `[{"op": name, ...arguments}, ...]`.
+The response is a list of results, one per operation,
+each either `{"ok": value}` or `{"error": message}`.
+Binary data is base64 encoded.
+"""
+import base64
+import json
+import os
+import queue
+import resource
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+import typing as t
+
+PROTOCOL_VERSION = 3
+
+#: How many directories `clone_tree` works on at once
+CLONE_JOBS = 16
+
+_LENGTH = struct.Struct('>I')
+
+
+def write_message(stream: t.BinaryIO, message: t.Any) -> None:
+    data = json.dumps(message, separators=(',', ':')).encode()
+    stream.write(_LENGTH.pack(len(data)) + data)
+    stream.flush()
+
+
+def read_message(stream: t.BinaryIO) -> t.Any:
+    header = stream.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        raise EOFError
+    (length,) = _LENGTH.unpack(header)
+    data = stream.read(length)
+    if len(data) < length:
+        raise EOFError
+    return json.loads(data)
+
+
+def _encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode(data: str) -> bytes:
+    return base64.b64decode(data)
+
+
+def op_ping() -> int:
+    return PROTOCOL_VERSION
+
+
+def op_exists(paths: t.List[str]) -> t.List[bool]:
+    return [os.path.exists(path) for path in paths]
+
+
+def op_read(paths: t.List[str]) -> t.List[t.Optional[str]]:
+    """Read many files. Files that are missing or can not be read are returned as `null`."""
+    contents: t.List[t.Optional[str]] = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                contents.append(_encode(f.read()))
+        except OSError:
+            contents.append(None)
+    return contents
+
+
+def op_write(path: str, data: str) -> None:
+    with open(path, 'wb') as f:
+        f.write(_decode(data))
+
+
+def op_listdir(path: str) -> t.List[str]:
+    return os.listdir(path)
+
+
+def op_run(argv: t.List[str]) -> t.Dict[str, t.Any]:
+    """Run a command, returning its output and the resources it used."""
+    started = time.monotonic()
+    # The agent's stdin carries requests, so it must not be inherited
+    with subprocess.Popen(
+        argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ) as process:
+        stdout_stream, stderr_stream = process.stdout, process.stderr
+        assert stdout_stream is not None and stderr_stream is not None
+        stderr: t.List[bytes] = []
+        stderr_reader = threading.Thread(target=lambda: stderr.append(stderr_stream.read()))
+        stderr_reader.start()
+        stdout = stdout_stream.read()
+        stderr_reader.join()
+        # Waiting with wait4() gives the resources used by this process alone
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = _exit_code(status)
+    return {
+        'returncode': process.returncode,
+        'stdout': _encode(stdout),
+        'stderr': _encode(stderr[0]),
+        'usage': {
+            'seconds': time.monotonic() - started,
+            'user': rusage.ru_utime,
+            'system': rusage.ru_stime,
+            'max_rss': _child_max_rss(rusage.ru_maxrss),
+            'read_bytes': rusage.ru_inblock * 512,
+            'written_bytes': rusage.ru_oublock * 512,
+        },
+    }
+
+
+def _child_max_rss(max_rss: int) -> t.Optional[int]:
+    """
+    The most memory a child process used, in bytes, if it is known.
+    The child appears to use at least as much memory as the agent,
+    so a child that used less than that can not be measured.
+    """
+    if max_rss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+    # Kilobytes on Linux, but bytes on macOS
+    return max_rss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def op_run_many(argvs: t.List[t.List[str]]) -> t.List[t.Dict[str, t.Any]]:
+    """Run many commands, stopping after the first one that fails."""
+    results = []
+    for argv in argvs:
+        results.append(op_run(argv))
+        if results[-1]['returncode'] != 0:
+            break
+    return results
+
+
+def _run_workers(
+    function: t.Callable[..., t.Iterable[t.Tuple[str, str]]],
+    items: t.Iterable[t.Tuple[str, str]],
+    jobs: int,
+) -> None:
+    """
+    Call `function` on every item using `jobs` threads.
+    `function` can return more items, which are then also worked on.
+    The first error raised by `function` is raised once all the threads have stopped.
+    """
+    # Working depth first keeps the queue short for wide trees
+    work: 'queue.LifoQueue[t.Optional[t.Tuple[str, str]]]' = queue.LifoQueue()
+    errors: t.List[BaseException] = []
+
+    def worker() -> None:
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            try:
+                if not errors:
+                    for new_item in function(*item):
+                        work.put(new_item)
+            except BaseException as exc:
+                errors.append(exc)
+            finally:
+                work.task_done()
+
+    for item in items:
+        work.put(item)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    work.join()
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _clone_directory(source: str, destination: str) -> t.List[t.Tuple[str, str]]:
+    """
+    Hard link everything in the `source` directory in to `destination`,
+    making the subdirectories which are returned to be cloned next.
+    Existing files in `destination` are replaced, like `cp --force`.
+    """
+    subdirectories = []
+    # Working relative to open directories saves looking up the whole path for every entry
+    source_fd = os.open(source, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        destination_fd = os.open(destination, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with os.scandir(source_fd) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        # The directory must be writable until everything in it is linked,
+                        # its real mode is set by `_copy_directory_metadata()`
+                        try:
+                            os.mkdir(name, 0o700, dir_fd=destination_fd)
+                        except FileExistsError:
+                            pass
+                        subdirectories.append((
+                            os.path.join(source, name), os.path.join(destination, name)))
+                        continue
+                    try:
+                        os.link(
+                            name, name, src_dir_fd=source_fd, dst_dir_fd=destination_fd,
+                            follow_symlinks=False)
+                    except FileExistsError:
+                        os.unlink(name, dir_fd=destination_fd)
+                        os.link(
+                            name, name, src_dir_fd=source_fd, dst_dir_fd=destination_fd,
+                            follow_symlinks=False)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+    return subdirectories
+
+
+def _copy_directory_metadata(source: str, destination: str) -> t.List[t.Tuple[str, str]]:
+    """Copy the ownership, extended attributes, mode, and timestamps of a directory."""
+    source_stat = os.lstat(source)
+    try:
+        os.chown(destination, source_stat.st_uid, source_stat.st_gid)
+    except PermissionError:
+        # Only root can give files away, the same as `cp --archive`
+        pass
+    if hasattr(os, 'listxattr'):
+        for name in os.listxattr(source, follow_symlinks=False):
+            try:
+                os.setxattr(destination, name, os.getxattr(source, name, follow_symlinks=False))
+            except OSError:
+                # Some namespaces can only be set by root, or are not supported everywhere
+                pass
+    os.chmod(destination, stat.S_IMODE(source_stat.st_mode))
+    os.utime(destination, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return []
+
+
+def clone_tree(source: str, destination: str, jobs: int = CLONE_JOBS) -> int:
+    """
+    Copy the directory tree at `source` to `destination`, hard linking every file,
+    like `cp --archive --link --no-target-directory --force`.
+    Many directories are cloned at once, which is much faster than `cp`
+    on storage that can handle many operations at a time.
+
+    Linking a file in to a directory changes the modification time of the directory,
+    so the metadata of each directory is copied once everything has been linked,
+    deepest directories first.
+    Returns the number of directories cloned.
+    """
+    try:
+        os.mkdir(destination, 0o700)
+    except FileExistsError:
+        pass
+
+    directories = [(source, destination)]
+
+    def clone(source: str, destination: str) -> t.List[t.Tuple[str, str]]:
+        subdirectories = _clone_directory(source, destination)
+        directories.extend(subdirectories)
+        return subdirectories
+
+    _run_workers(clone, [(source, destination)], jobs)
+
+    # A directory made read only or unsearchable would stop the directories inside it being changed,
+    # so every level of the tree is finished before the level above it is started
+    levels: t.Dict[int, t.List[t.Tuple[str, str]]] = {}
+    for directory in directories:
+        levels.setdefault(directory[1].count(os.sep), []).append(directory)
+    for depth in sorted(levels, reverse=True):
+        _run_workers(_copy_directory_metadata, levels[depth], jobs)
+    return len(directories)
+
+
+def op_clone(source: str, destination: str, jobs: int = CLONE_JOBS) -> int:
+    return clone_tree(source, destination, jobs)
+
+
+OPERATIONS: t.Dict[str, t.Callable[..., t.Any]] = {
+    'ping': op_ping,
+    'exists': op_exists,
+    'read': op_read,
+    'write': op_write,
+    'listdir': op_listdir,
+    'run': op_run,
+    'run_many': op_run_many,
+    'clone': op_clone,
+}
+
+
+def handle(request: t.List[t.Dict[str, t.Any]]) -> t.List[t.Dict[str, t.Any]]:
+    results = []
+    for operation in request:
+        arguments = dict(operation)
+        try:
+            function = OPERATIONS[arguments.pop('op')]
+            results.append({'ok': function(**arguments)})
+        except Exception as exc:
+            results.append({'error': f"{type(exc).__name__}: {exc}"})
+    return results
+
+
+def main() -> None:
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        try:
+            request = read_message(stdin)
+        except EOFError:
+            return
+        write_message(stdout, handle(request))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,14 @@
+import os
 import pathlib
 import subprocess
+import time
 import types
 import typing as t
 
 import attr
 
-from .. import exceptions, logging
-from . import _base
+from .. import exceptions, logging, processes
+from . import _base, _helper
 
 logger = logging.getLogger(__name__)
 
@@ -15,17 +17,25 @@ logger = logging.getLogger(__name__)
 class Local(_base.Target):
     name: str
     path: pathlib.Path
+    #: How many directories to clone at once when creating a snapshot.
+    #: With one job, snapshots are created using `cp` instead.
+    snapshot_jobs: int = 1
+    #: The most bytes per second to send to this target
+    bwlimit: t.Optional[int] = None
 
     @classmethod
     def from_options(cls, name: str, config: dict) -> "Local":
         path = pathlib.Path(config.pop('path')).expanduser()
         try:
-            return cls(name=name, path=path)
+            return cls(name=name, path=path, **_base.parse_bwlimit(name, config))
         except TypeError as exc:
             raise exceptions.ConfigError(str(exc))
 
     def rsync_arguments(self, destination: pathlib.Path) -> t.Tuple[str, t.List[str]]:
         options: t.List[str] = []
+        if self.bwlimit is not None:
+            # rsync takes the limit in units of 1024 bytes per second
+            options.append(f'--bwlimit={max(1, self.bwlimit // 1024)}')
         target_str = str(self.path / destination)
         return (target_str, options)
 
@@ -63,7 +73,43 @@ class LocalContext(_base.TargetContext):
     def execute(self, cmd: t.List[str]) -> None:
         """Run a command on the target."""
         logger.log(logging.DEBUG, logging.command(cmd))
-        subprocess.check_call(cmd)
+        processes.check_call(cmd)
+
+    def check_output(self, cmd: t.List[str]) -> bytes:
+        logger.log(logging.DEBUG, logging.command(cmd))
+        return processes.check_output(cmd)
+
+    def stream_output(self, cmd: t.List[str], output: t.BinaryIO) -> int:
+        logger.log(logging.DEBUG, logging.command(cmd))
+        started = time.monotonic()
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+            assert process.stdout is not None
+            copied = _base.copy_stream(process.stdout.read, output)
+            returncode = processes.wait(process, started)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return copied
+
+    def stream_input(self, cmd: t.List[str], input: t.BinaryIO, *, echo: bool) -> int:
+        logger.log(logging.DEBUG, logging.command(cmd))
+        started = time.monotonic()
+        stdout = None if echo else subprocess.DEVNULL
+        with subprocess.Popen(cmd, stdin=input, stdout=stdout) as process:
+            return processes.wait(process, started)
+
+    def move_files(self, path: pathlib.Path, moves: t.List[t.Tuple[str, str]]) -> int:
+        base = self.make_path(path)
+        moved = 0
+        for source, destination in moves:
+            if not os.path.lexists(base / source) or os.path.lexists(base / destination):
+                continue
+            try:
+                (base / destination).parent.mkdir(parents=True, exist_ok=True)
+                os.rename(base / source, base / destination)
+            except OSError:
+                continue
+            moved += 1
+        return moved
 
     def exists(self, path: pathlib.Path) -> bool:
         return self.make_path(path).exists()
@@ -76,3 +122,14 @@ class LocalContext(_base.TargetContext):
 
     def list_directory(self, path: pathlib.Path) -> t.List[str]:
         return [p.name for p in sorted(self.make_path(path).iterdir())]
+
+    def create_snapshot(self, current: pathlib.Path, snapshot: pathlib.Path) -> None:
+        """
+        Clone the current snapshot using hard links, many directories at a time if `snapshot_jobs` is set.
+        `cp` is faster than cloning one directory at a time, so it is used otherwise.
+        """
+        if self.target.snapshot_jobs <= 1:
+            return super().create_snapshot(current, snapshot)
+        source, destination = self.make_path(current), self.make_path(snapshot)
+        logger.log(logging.DEBUG, "Cloning %s to %s", source, destination)
+        _helper.clone_tree(str(source), str(destination), self.target.snapshot_jobs)
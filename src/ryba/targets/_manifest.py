@@ -0,0 +1,416 @@
+"""
+Targets that store each snapshot as a manifest file
+listing every file along with the content-addressed objects that hold its contents,
+instead of as a tree of hard linked files written by rsync.
+"""
+import abc
+import concurrent.futures
+import gzip
+import json
+import os
+import pathlib
+import shlex
+import stat
+import subprocess
+import tarfile
+import time
+import typing as t
+
+import attr
+
+from .. import constants, logging, processes
+from . import _base
+
+if t.TYPE_CHECKING:
+    from .. import filters
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+class FileChangedError(Exception):
+    """Raised when a file changes while it is being stored."""
+
+
+#: The names of the objects holding the contents of a stored file, in order,
+#: how many bytes of new objects were stored,
+#: and the stat of the file taken when it was opened to be stored
+StoredFile = t.Tuple[t.List[str], int, os.stat_result]
+
+
+def changed_since(before: os.stat_result, after: os.stat_result) -> bool:
+    """Whether a file looks to have been modified between two stats of it."""
+    return (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns)
+
+
+@attr.s(auto_attribs=True, kw_only=True, frozen=True)
+class Entry:
+    """A file, directory, or symlink in a snapshot."""
+    path: str
+    type: str
+    mode: int
+    uid: int
+    gid: int
+    mtime_ns: int
+    size: int = 0
+    #: The objects that hold the contents of a file, in order
+    objects: t.Tuple[str, ...] = ()
+    #: Where a symlink points to
+    link: t.Optional[str] = None
+
+    @classmethod
+    def from_stat(cls, path: str, file_stat: os.stat_result, **kwargs: t.Any) -> 'Entry':
+        if stat.S_ISDIR(file_stat.st_mode):
+            entry_type = 'directory'
+        elif stat.S_ISLNK(file_stat.st_mode):
+            entry_type = 'symlink'
+        else:
+            entry_type = 'file'
+        return cls(
+            path=path, type=entry_type, mode=stat.S_IMODE(file_stat.st_mode),
+            uid=file_stat.st_uid, gid=file_stat.st_gid, mtime_ns=file_stat.st_mtime_ns,
+            **kwargs)
+
+    def unchanged(self, file_stat: os.stat_result) -> bool:
+        """Can this entry be reused for a file with this stat, without reading the file again?"""
+        return (
+            self.type == 'file'
+            and self.size == file_stat.st_size
+            and self.mtime_ns == file_stat.st_mtime_ns)
+
+
+def dump_manifest(entries: t.Iterable[Entry]) -> bytes:
+    """Serialise a manifest as gzipped JSON lines, with a header line first."""
+    lines = [json.dumps({'version': MANIFEST_VERSION})]
+    for entry in entries:
+        data = attr.asdict(entry, filter=lambda a, v: v is not None and v != ())
+        lines.append(json.dumps(data, separators=(',', ':')))
+    return gzip.compress('\n'.join(lines).encode() + b'\n', compresslevel=6, mtime=0)
+
+
+def load_manifest(data: bytes) -> t.List[Entry]:
+    lines = gzip.decompress(data).decode().splitlines()
+    header = json.loads(lines[0])
+    if header.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {header.get('version')!r}")
+    entries = []
+    for line in lines[1:]:
+        fields = json.loads(line)
+        fields['objects'] = tuple(fields.get('objects', ()))
+        entries.append(Entry(**fields))
+    return entries
+
+
+class ManifestContext(_base.TargetContext):
+    """
+    A target context that stores snapshots as manifests.
+
+    Each backed up directory has its own object store,
+    found next to the snapshots in the target directory.
+    The current snapshot is a directory holding only the manifest,
+    so snapshots are still created by hard linking the current snapshot,
+    and rotated by deleting snapshot directories.
+    Objects that are no longer referenced by any manifest
+    are deleted after snapshots are rotated.
+    """
+    uses_rsync = False
+
+    @abc.abstractmethod
+    def store_file(self, path: pathlib.Path, source: pathlib.Path) -> StoredFile:
+        """
+        Store the contents of the local file `source` in the object store in `path`.
+        Returns the names of the objects holding the contents, in order,
+        how many bytes of new objects were stored,
+        and the stat of the file the contents were read from.
+        Raises `FileNotFoundError` if the file vanished,
+        or `FileChangedError` if it changed while it was being stored.
+        """
+
+    @abc.abstractmethod
+    def read_object(self, path: pathlib.Path, name: str) -> bytes: ...
+
+    @abc.abstractmethod
+    def list_objects(self, path: pathlib.Path) -> t.Set[str]: ...
+
+    @abc.abstractmethod
+    def remove_objects(self, path: pathlib.Path, names: t.Iterable[str]) -> None: ...
+
+    def read_manifest(self, snapshot: pathlib.Path) -> t.Optional[t.List[Entry]]:
+        """Read the manifest for a snapshot, or `None` if the snapshot has no manifest."""
+        manifest_path = snapshot / constants.MANIFEST_FILE_NAME
+        data = self.read_files([manifest_path])[manifest_path]
+        if data is None:
+            return None
+        return load_manifest(data)
+
+    def receive_files(
+        self,
+        source: pathlib.Path,
+        path: pathlib.Path,
+        *,
+        filter: 'filters.Filter',
+        dry_run: bool,
+    ) -> _base.TransferStats:
+        """
+        Store every file in `source` that has changed since the last backup,
+        then write a new manifest for the current snapshot.
+        Files with the same size and modification time as in the previous manifest
+        are assumed to be unchanged and are not read again.
+        """
+        current = path / constants.CURRENT_SNAPSHOT_NAME
+        previous = {entry.path: entry for entry in self.read_manifest(current) or []}
+
+        entries: t.List[t.Optional[Entry]] = []
+        changed: t.Dict[int, t.Tuple[str, os.stat_result]] = {}
+        for relative_path, file_stat in filter.walk(source):
+            name = str(relative_path)
+            if stat.S_ISLNK(file_stat.st_mode):
+                entries.append(Entry.from_stat(name, file_stat, link=os.readlink(source / relative_path)))
+            elif stat.S_ISDIR(file_stat.st_mode):
+                entries.append(Entry.from_stat(name, file_stat))
+            elif stat.S_ISREG(file_stat.st_mode):
+                if (entry := previous.get(name)) is not None and entry.unchanged(file_stat):
+                    entries.append(entry)
+                else:
+                    # Filled in once the file is stored
+                    changed[len(entries)] = (name, file_stat)
+                    entries.append(None)
+            else:
+                logger.log(logging.INFO, "Skipping special file %r", name)
+
+        stored_files = stored_bytes = transferred_bytes = 0
+        stored = {} if dry_run else self.store_files(path, [source / name for name, _ in changed.values()])
+        for index, (name, file_stat) in changed.items():
+            objects: t.Sequence[str] = ()
+            if not dry_run:
+                if (result := stored[source / name]) is None:
+                    logger.log(logging.WARNING, "File %r changed or vanished during backup", name)
+                    continue
+                # The entry must describe the file as it was when its contents were read,
+                # which can differ from when the directory was walked
+                objects, new_bytes, file_stat = result
+                stored_bytes += new_bytes
+            stored_files += 1
+            transferred_bytes += file_stat.st_size
+            entries[index] = Entry.from_stat(
+                name, file_stat, size=file_stat.st_size, objects=tuple(objects))
+
+        logger.log(
+            logging.INFO, "Stored %d changed files, %d bytes of new objects",
+            stored_files, stored_bytes)
+        if not dry_run:
+            self.write_manifest(current, dump_manifest(entry for entry in entries if entry is not None))
+        return _base.TransferStats(files_transferred=stored_files, bytes_transferred=transferred_bytes)
+
+    def store_files(
+        self,
+        path: pathlib.Path,
+        sources: t.List[pathlib.Path],
+    ) -> t.Dict[pathlib.Path, t.Optional[StoredFile]]:
+        """
+        Store many files using `store_file()`.
+        Files that vanish or change before they can be stored are returned as `None`.
+        Targets that can store many files at once can override this.
+        """
+        results: t.Dict[pathlib.Path, t.Optional[StoredFile]] = {}
+        for source in sources:
+            logger.log(logging.DEBUG, "Storing %s", source)
+            try:
+                results[source] = self.store_file(path, source)
+            except (FileNotFoundError, FileChangedError):
+                results[source] = None
+        return results
+
+    def write_manifest(self, snapshot: pathlib.Path, data: bytes) -> None:
+        # The manifest is hard linked in to every snapshot,
+        # so it must be replaced rather than written over
+        manifest_path = snapshot / constants.MANIFEST_FILE_NAME
+        temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        self.execute(["mkdir", "-p", str(self.make_path(snapshot))])
+        self.write_file(temporary_path, data)
+        self.execute(["mv", str(self.make_path(temporary_path)), str(self.make_path(manifest_path))])
+
+    def delete_snapshots(self, path: pathlib.Path, names: t.List[str]) -> None:
+        super().delete_snapshots(path, names)
+        self.collect_garbage(path)
+
+    def collect_garbage(self, path: pathlib.Path) -> None:
+        """Delete every object in `path` that is not used by any snapshot."""
+        referenced: t.Set[str] = set()
+        snapshots = [
+            name for name in self.list_directory(path)
+            if name != constants.OBJECTS_DIRECTORY_NAME
+        ]
+        manifest_paths = [path / name / constants.MANIFEST_FILE_NAME for name in snapshots]
+        for data in self.read_files(manifest_paths).values():
+            if data is not None:
+                for entry in load_manifest(data):
+                    referenced.update(entry.objects)
+
+        unused = self.list_objects(path) - referenced
+        logger.log(logging.INFO, "Deleting %d unused objects", len(unused))
+        self.remove_objects(path, unused)
+
+    def restore_files(
+        self,
+        snapshot: pathlib.Path,
+        destination: pathlib.Path,
+        *,
+        only: t.Optional[t.Callable[[str], bool]] = None,
+        jobs: int = 1,
+    ) -> None:
+        """
+        Recreate the files from a snapshot in the local directory `destination`.
+        If `only` is given, only the entries it returns true for are restored.
+        Files that already exist with the same size and modification time are skipped.
+        Up to `jobs` files are restored at once.
+        """
+        entries = self.read_manifest(snapshot)
+        if entries is None:
+            raise FileNotFoundError(f"No manifest found in {str(snapshot)!r}")
+        path = snapshot.parent
+
+        directories = []
+        files = []
+        for entry in entries:
+            if only is not None and not only(entry.path):
+                continue
+            target = destination / entry.path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if entry.type == 'directory':
+                target.mkdir(exist_ok=True)
+                directories.append((target, entry))
+                continue
+            if entry.type == 'symlink':
+                assert entry.link is not None
+                if target.is_symlink():
+                    target.unlink()
+                target.symlink_to(entry.link)
+                _restore_ownership(target, entry)
+                continue
+            try:
+                existing = os.lstat(target)
+            except FileNotFoundError:
+                pass
+            else:
+                if stat.S_ISREG(existing.st_mode) and entry.unchanged(existing):
+                    continue
+            files.append((target, entry))
+
+        def restore_file(target: pathlib.Path, entry: Entry) -> None:
+            logger.log(logging.DEBUG, "Restoring %s", entry.path)
+            # Existing files may be read only, and should not be left half written
+            temporary = target.with_name(f'.{target.name}.ryba-restore')
+            with open(temporary, 'wb') as f:
+                for name in entry.objects:
+                    f.write(self.read_object(path, name))
+            os.chmod(temporary, entry.mode)
+            _restore_ownership(temporary, entry)
+            os.replace(temporary, target)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for _ in executor.map(lambda item: restore_file(*item), files):
+                pass
+
+        # Set directory metadata last, as writing files updates their mtime
+        for target, entry in reversed(directories):
+            os.chmod(target, entry.mode)
+            _restore_ownership(target, entry)
+
+    def export_snapshot(
+        self,
+        snapshot: pathlib.Path,
+        output: t.BinaryIO,
+        *,
+        compressor: t.Optional[str] = None,
+    ) -> int:
+        """
+        Write a snapshot to `output` as a tar archive,
+        reading each file one object at a time and compressing the archive locally.
+        Manifests do not record which files were hard linked together,
+        so each file is stored separately.
+        """
+        entries = self.read_manifest(snapshot)
+        if entries is None:
+            raise FileNotFoundError(f"No manifest found in {str(snapshot)!r}")
+        path = snapshot.parent
+
+        if compressor is None:
+            counter = _CountingWriter(output)
+            self._write_tar(path, entries, t.cast(t.BinaryIO, counter))
+            return counter.written
+
+        cmd = shlex.split(compressor)
+        logger.log(logging.DEBUG, logging.command(cmd))
+        started = time.monotonic()
+        with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            assert process.stdin is not None and process.stdout is not None
+            copied = executor.submit(_base.copy_stream, process.stdout.read, output)
+            with process.stdin:
+                self._write_tar(path, entries, t.cast(t.BinaryIO, process.stdin))
+            result = copied.result()
+            returncode = processes.wait(process, started)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return result
+
+    def _write_tar(self, path: pathlib.Path, entries: t.List[Entry], fileobj: t.BinaryIO) -> None:
+        with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+            for entry in entries:
+                info = tarfile.TarInfo(entry.path)
+                info.mode, info.uid, info.gid = entry.mode, entry.uid, entry.gid
+                info.mtime = entry.mtime_ns / 1e9
+                if entry.type == 'directory':
+                    info.type = tarfile.DIRTYPE
+                    archive.addfile(info)
+                elif entry.type == 'symlink':
+                    assert entry.link is not None
+                    info.type, info.linkname = tarfile.SYMTYPE, entry.link
+                    archive.addfile(info)
+                else:
+                    info.size = entry.size
+                    archive.addfile(info, _ObjectReader(self, path, entry.objects))
+
+
+class _ObjectReader:
+    """A file object reading the contents of a file from its objects, one object at a time."""
+
+    def __init__(self, context: ManifestContext, path: pathlib.Path, names: t.Iterable[str]):
+        self._objects = (context.read_object(path, name) for name in names)
+        self._data = b''
+        self._offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while size != 0:
+            if self._offset == len(self._data):
+                if (data := next(self._objects, None)) is None:
+                    break
+                self._data, self._offset = data, 0
+                continue
+            end = len(self._data) if size < 0 else min(len(self._data), self._offset + size)
+            parts.append(self._data[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+
+class _CountingWriter:
+    def __init__(self, output: t.BinaryIO):
+        self.output = output
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        return self.output.write(data)
+
+
+def _restore_ownership(target: pathlib.Path, entry: Entry) -> None:
+    try:
+        os.chown(target, entry.uid, entry.gid, follow_symlinks=False)
+    except PermissionError:
+        pass
+    os.utime(target, ns=(entry.mtime_ns, entry.mtime_ns), follow_symlinks=False)
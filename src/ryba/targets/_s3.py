@@ -0,0 +1,345 @@
+"""
+A target that stores backups in an S3 compatible object store.
+
+This needs the optional `boto3` dependency, installed with `pip install ryba[s3]`.
+"""
+import concurrent.futures
+import functools
+import hashlib
+import os
+import pathlib
+import types
+import typing as t
+
+import attr
+
+from .. import config, constants, exceptions, logging
+from . import _base, _manifest
+
+logger = logging.getLogger(__name__)
+
+#: Files larger than this are uploaded in parts
+MULTIPART_THRESHOLD = 64 << 20
+#: The size of each part in a multipart upload
+MULTIPART_CHUNK_SIZE = 16 << 20
+#: The most keys that can be deleted in one request
+DELETE_BATCH_SIZE = 1000
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class S3(_base.Target):
+    name: str
+    bucket: str
+    path: pathlib.Path = attr.ib(default=pathlib.Path('/'), converter=pathlib.Path)
+    endpoint_url: t.Optional[str] = None
+    region: t.Optional[str] = None
+    profile: t.Optional[str] = None
+    #: How many files and parts of files to upload at once
+    jobs: int = 8
+    #: The most bytes per second to upload to this target
+    bwlimit: t.Optional[int] = None
+
+    @classmethod
+    def from_options(cls, name: str, config: dict) -> "S3":
+        try:
+            return cls(name=name, **_base.parse_bwlimit(name, config))
+        except TypeError as exc:
+            raise exceptions.ConfigError(str(exc))
+
+    def connect(self) -> 'S3Context':
+        return S3Context(target=self)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+@attr.s(auto_attribs=True, kw_only=True)
+class S3Context(_manifest.ManifestContext):
+    """
+    Files are stored whole as objects named by the SHA-256 digest of their contents,
+    under the objects directory next to the snapshots.
+    Files are uploaded concurrently, and large files are uploaded in parts concurrently.
+
+    Listing every object in a bucket is slow,
+    so the objects known to exist are cached locally between backups.
+    The listing is refreshed from the bucket whenever snapshots are rotated,
+    and each object is checked before a new file is stored as a reference to it.
+    """
+    target: S3
+    #: The objects known to exist in each object store
+    _known: t.Dict[pathlib.Path, t.Set[str]] = attr.ib(factory=dict, init=False)
+
+    @functools.cached_property
+    def client(self) -> t.Any:
+        try:
+            import boto3.session
+            import botocore.config
+        except ImportError:
+            raise exceptions.ConfigError(
+                f"Target {self.target.name} needs boto3 to be installed: pip install ryba[s3]")
+        session = boto3.session.Session(
+            profile_name=self.target.profile, region_name=self.target.region)
+        return session.client(
+            's3', endpoint_url=self.target.endpoint_url,
+            config=botocore.config.Config(max_pool_connections=self.target.jobs * 2))
+
+    def __enter__(self) -> "S3Context":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: t.Optional[t.Type[BaseException]],
+        exc_value: t.Optional[BaseException],
+        traceback: t.Optional[types.TracebackType],
+    ) -> None:
+        if 'client' in self.__dict__:
+            self.client.close()
+
+    def make_path(self, path: pathlib.Path) -> pathlib.Path:
+        if path.is_absolute():
+            path = path.relative_to('/')
+        return self.target.path / path
+
+    def _key(self, path: pathlib.Path) -> str:
+        return str(self.make_path(path)).lstrip('/')
+
+    def _prefix(self, path: pathlib.Path) -> str:
+        """The prefix for all keys inside a directory."""
+        key = self._key(path)
+        return f'{key}/' if key else ''
+
+    def execute(self, cmd: t.List[str]) -> None:
+        raise _base.ContextException(f"Can not run commands on S3 target {self.target.name}")
+
+    def check_output(self, cmd: t.List[str]) -> bytes:
+        raise _base.ContextException(f"Can not run commands on S3 target {self.target.name}")
+
+    def stream_output(self, cmd: t.List[str], output: t.BinaryIO) -> int:
+        raise _base.ContextException(f"Can not run commands on S3 target {self.target.name}")
+
+    def stream_input(self, cmd: t.List[str], input: t.BinaryIO, *, echo: bool) -> int:
+        raise _base.ContextException(f"Can not run commands on S3 target {self.target.name}")
+
+    def ensure_directory(self, path: pathlib.Path) -> None:
+        pass
+
+    def exists(self, path: pathlib.Path) -> bool:
+        if not self._key(path) or self._read_or_none(path, method='head_object') is not None:
+            return True
+        # Directories only exist as a prefix of other keys
+        response = self.client.list_objects_v2(
+            Bucket=self.target.bucket, Prefix=self._prefix(path), MaxKeys=1)
+        return bool(response['KeyCount'])
+
+    def read_file(self, path: pathlib.Path) -> bytes:
+        response = self.client.get_object(Bucket=self.target.bucket, Key=self._key(path))
+        return t.cast(bytes, response['Body'].read())
+
+    def read_files(self, paths: t.List[pathlib.Path]) -> t.Dict[pathlib.Path, t.Optional[bytes]]:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.target.jobs) as executor:
+            return dict(zip(paths, executor.map(self._read_or_none, paths)))
+
+    def _read_or_none(self, path: pathlib.Path, method: str = 'get_object') -> t.Optional[t.Any]:
+        import botocore.exceptions
+        try:
+            response = getattr(self.client, method)(Bucket=self.target.bucket, Key=self._key(path))
+        except botocore.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response['Body'].read() if method == 'get_object' else response
+
+    def write_file(self, path: pathlib.Path, contents: bytes) -> None:
+        self.client.put_object(Bucket=self.target.bucket, Key=self._key(path), Body=contents)
+
+    def list_directory(self, path: pathlib.Path) -> t.List[str]:
+        prefix = self._prefix(path)
+        names: t.List[str] = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.target.bucket, Prefix=prefix, Delimiter='/'):
+            names.extend(p['Prefix'][len(prefix):].rstrip('/') for p in page.get('CommonPrefixes', []))
+            names.extend(o['Key'][len(prefix):] for o in page.get('Contents', []))
+        return sorted(names)
+
+    def _list_keys(self, path: pathlib.Path) -> t.Iterator[str]:
+        """Every key inside a directory, recursively."""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.target.bucket, Prefix=self._prefix(path)):
+            yield from (o['Key'] for o in page.get('Contents', []))
+
+    def _delete_keys(self, keys: t.Iterable[str]) -> None:
+        keys = list(keys)
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            self.client.delete_objects(Bucket=self.target.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]],
+                'Quiet': True,
+            })
+
+    def create_snapshot(self, current: pathlib.Path, snapshot: pathlib.Path) -> None:
+        """A snapshot only holds a manifest, so copying the manifest is enough."""
+        self.client.copy_object(
+            Bucket=self.target.bucket,
+            Key=self._key(snapshot / constants.MANIFEST_FILE_NAME),
+            CopySource={
+                'Bucket': self.target.bucket,
+                'Key': self._key(current / constants.MANIFEST_FILE_NAME),
+            })
+
+    def delete_snapshots(self, path: pathlib.Path, names: t.List[str]) -> None:
+        for name in names:
+            self._delete_keys(self._list_keys(path / name))
+        self.collect_garbage(path)
+
+    def write_manifest(self, snapshot: pathlib.Path, data: bytes) -> None:
+        # Replacing an object is atomic, and snapshots are copies not hard links
+        self.write_file(snapshot / constants.MANIFEST_FILE_NAME, data)
+
+    def _objects_path(self, path: pathlib.Path) -> pathlib.Path:
+        return path / constants.OBJECTS_DIRECTORY_NAME
+
+    def _listing_cache_path(self, path: pathlib.Path) -> pathlib.Path:
+        location = f'{self.target.endpoint_url}|{self.target.bucket}|{self._key(path)}'
+        digest = hashlib.sha256(location.encode()).hexdigest()[:16]
+        return config.get_cache_path() / 's3' / f'{self.target.name}-{digest}.txt'
+
+    def _save_listing(self, path: pathlib.Path) -> None:
+        cache_path = self._listing_cache_path(path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = cache_path.with_suffix('.tmp')
+        temporary_path.write_text(''.join(f'{name}\n' for name in sorted(self._known[path])))
+        temporary_path.replace(cache_path)
+
+    def _known_objects(self, path: pathlib.Path) -> t.Set[str]:
+        if path not in self._known:
+            cache_path = self._listing_cache_path(path)
+            if cache_path.exists():
+                self._known[path] = set(cache_path.read_text().split())
+            else:
+                self.list_objects(path)
+        return self._known[path]
+
+    def list_objects(self, path: pathlib.Path) -> t.Set[str]:
+        prefix = self._prefix(self._objects_path(path))
+        names = {key[len(prefix):] for key in self._list_keys(self._objects_path(path))}
+        self._known[path] = set(names)
+        self._save_listing(path)
+        return names
+
+    def read_object(self, path: pathlib.Path, name: str) -> bytes:
+        data = self.read_file(self._objects_path(path) / name)
+        if hashlib.sha256(data).hexdigest() != name:
+            raise ValueError(f"Object {name} is damaged")
+        return data
+
+    def remove_objects(self, path: pathlib.Path, names: t.Iterable[str]) -> None:
+        names = list(names)
+        self._delete_keys(self._key(self._objects_path(path) / name) for name in names)
+        self._known_objects(path).difference_update(names)
+        self._save_listing(path)
+
+    def store_file(self, path: pathlib.Path, source: pathlib.Path) -> _manifest.StoredFile:
+        if (result := self.store_files(path, [source])[source]) is None:
+            raise _manifest.FileChangedError(str(source))
+        return result
+
+    def store_files(
+        self,
+        path: pathlib.Path,
+        sources: t.List[pathlib.Path],
+    ) -> t.Dict[pathlib.Path, t.Optional[_manifest.StoredFile]]:
+        """
+        Hash every file, then upload the files that are not already in the bucket.
+        Up to `jobs` files are hashed at once,
+        and up to `jobs` files or parts of files are uploaded at once.
+
+        Objects can be deleted without this host knowing, such as by a rotation on another host
+        or a lifecycle rule, so objects in the cached listing are checked before they are used.
+        Only changed files are stored, so this is one request for each changed file
+        whose contents are already in the bucket.
+        """
+        import boto3.s3.transfer
+
+        known = self._known_objects(path)
+        transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=self.target.jobs, max_bandwidth=self.target.bwlimit)
+
+        results: t.Dict[pathlib.Path, t.Optional[_manifest.StoredFile]] = {}
+        #: The first source with each object name, for files with identical contents
+        uploading: t.Dict[str, pathlib.Path] = {}
+        duplicates: t.List[t.Tuple[pathlib.Path, os.stat_result, pathlib.Path]] = []
+        uploads = []
+        manager = boto3.s3.transfer.create_transfer_manager(self.client, transfer_config)
+        hashers = concurrent.futures.ThreadPoolExecutor(max_workers=self.target.jobs)
+
+        def hash_file(source: pathlib.Path) -> t.Tuple[os.stat_result, str, bool]:
+            file_stat, name = _hash_file(source)
+            exists = name in known and self._read_or_none(
+                self._objects_path(path) / name, method='head_object') is not None
+            return file_stat, name, exists
+
+        with manager, hashers:
+            hashes = [(source, hashers.submit(hash_file, source)) for source in sources]
+            for source, future in hashes:
+                try:
+                    file_stat, name, exists = future.result()
+                except (FileNotFoundError, _manifest.FileChangedError):
+                    results[source] = None
+                    continue
+                if name in known and not exists:
+                    logger.log(
+                        logging.WARNING, "Object %s is missing from %s, uploading it again",
+                        name, self.target.name)
+                    known.discard(name)
+                if name in known:
+                    results[source] = ([name], 0, file_stat)
+                elif name in uploading:
+                    duplicates.append((source, file_stat, uploading[name]))
+                else:
+                    logger.log(logging.DEBUG, "Uploading %s", source)
+                    uploading[name] = source
+                    key = self._key(self._objects_path(path) / name)
+                    uploads.append((source, file_stat, name, key, manager.upload(
+                        str(source), self.target.bucket, key)))
+
+            for source, file_stat, name, key, upload in uploads:
+                upload.result()
+                if not _unchanged(source, file_stat):
+                    # The object does not match its name, so it must not be kept
+                    self._delete_keys([key])
+                    results[source] = None
+                    continue
+                known.add(name)
+                results[source] = ([name], file_stat.st_size, file_stat)
+
+        for source, file_stat, original in duplicates:
+            if (result := results[original]) is not None:
+                results[source] = (result[0], 0, file_stat)
+            else:
+                results[source] = None
+
+        self._save_listing(path)
+        return results
+
+
+def _hash_file(source: pathlib.Path) -> t.Tuple[os.stat_result, str]:
+    """
+    Hash a file, returning its stat from when it was opened along with its digest.
+    Raises `FileChangedError` if it changed while it was being read.
+    """
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        file_stat = os.fstat(f.fileno())
+        while block := f.read(1 << 20):
+            digest.update(block)
+        if _manifest.changed_since(file_stat, os.fstat(f.fileno())):
+            raise _manifest.FileChangedError(str(source))
+    return file_stat, digest.hexdigest()
+
+
+def _unchanged(source: pathlib.Path, before: os.stat_result) -> bool:
+    try:
+        after = os.stat(source)
+    except FileNotFoundError:
+        return False
+    return not _manifest.changed_since(before, after)
@@ -3,6 +3,8 @@ import functools
 import pathlib
 import shlex
 import sys
+import threading
+import time
 import types
 import typing as t
 
@@ -10,10 +12,11 @@ import attr
 import paramiko.config
 import paramiko.ssh_exception
 import spur
+import spur.results
 import spur.ssh
 
-from .. import exceptions, logging
-from . import _base
+from .. import exceptions, logging, processes
+from . import _agent, _base
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +28,12 @@ class SSH(_base.Target):
     username: t.Optional[str] = None
     port: t.Optional[int] = None
     path: pathlib.Path = pathlib.Path('/')
+    agent: bool = True
+    #: How many directories the agent clones at once when creating a snapshot.
+    #: With one job, snapshots are created using `cp` instead.
+    snapshot_jobs: int = 1
+    #: The most bytes per second to send to this target
+    bwlimit: t.Optional[int] = None
 
     @hostname.default
     def _default_hostname(self) -> str:
@@ -33,7 +42,7 @@ class SSH(_base.Target):
     @classmethod
     def from_options(cls, name: str, config: dict) -> "SSH":
         try:
-            return cls(name=name, **config)
+            return cls(name=name, **_base.parse_bwlimit(name, config))
         except TypeError as exc:
             raise exceptions.ConfigError(str(exc))
 
@@ -45,6 +54,9 @@ class SSH(_base.Target):
             ssh_options += ['-p', str(self.port)]
         if ssh_options:
             options += ['-e', shlex.join(['ssh'] + ssh_options)]
+        if self.bwlimit is not None:
+            # rsync takes the limit in units of 1024 bytes per second
+            options.append(f'--bwlimit={max(1, self.bwlimit // 1024)}')
 
         if self.username:
             target_str = f'{self.username}@{self.hostname}:{destination}'
@@ -83,6 +95,23 @@ class SSHContext(_base.TargetContext):
     def sftp(self) -> paramiko.SFTPClient:
         return t.cast(paramiko.SFTPClient, self.client._open_sftp_client())
 
+    @functools.cached_property
+    def agent(self) -> t.Optional[_agent.Agent]:
+        """
+        The ryba agent running on the target, if it is enabled and could be started.
+        Target operations are sent through the agent when it is available,
+        otherwise each operation is a separate SSH command or SFTP request.
+        """
+        if not self.target.agent:
+            return None
+        try:
+            agent = _agent.Agent.start(self.client._get_ssh_transport())
+        except _agent.AgentError as exc:
+            logger.log(logging.INFO, "Not using the ryba agent on %s: %s", self.target, exc)
+            return None
+        self._stack.callback(agent.close)
+        return agent
+
     def __enter__(self) -> 'SSHContext':
         self._stack.__enter__()
         self._stack.enter_context(self.client)
@@ -102,6 +131,8 @@ class SSHContext(_base.TargetContext):
         self._stack.__exit__(exc_type, exc_value, traceback)
         with contextlib.suppress(AttributeError):
             del self.sftp
+        with contextlib.suppress(AttributeError):
+            del self.agent
         del self.client
 
     def _test_connection(self) -> None:
@@ -132,19 +163,139 @@ class SSHContext(_base.TargetContext):
 
     def execute(self, cmd: t.List[str]) -> None:
         logger.log(logging.DEBUG, logging.command(cmd, hostname=self.target.hostname))
-        self.client.run(cmd, stdout=sys.stdout, stderr=sys.stderr)
+        if self.agent is not None:
+            self._check_agent_result(cmd, self.agent.call('run', argv=cmd))
+            return
+        self._run(cmd, stdout=sys.stdout, stderr=sys.stderr)
+
+    def execute_many(self, cmds: t.List[t.List[str]]) -> None:
+        if self.agent is None:
+            return super().execute_many(cmds)
+        for cmd in cmds:
+            logger.log(logging.DEBUG, logging.command(cmd, hostname=self.target.hostname))
+        for cmd, result in zip(cmds, self.agent.call('run_many', argvs=cmds)):
+            self._check_agent_result(cmd, result)
+
+    def _check_agent_result(self, cmd: t.List[str], result: t.Dict[str, t.Any]) -> None:
+        """
+        Pass through the output of a command run by the agent,
+        and raise an error if it failed, the same as `spur` would.
+        """
+        processes.record(
+            cmd, processes.Usage(**result['usage']),
+            error=result['returncode'] != 0, host=self.target.hostname)
+        stdout, stderr = _agent.Agent.decode(result['stdout']), _agent.Agent.decode(result['stderr'])
+        sys.stdout.buffer.write(stdout)
+        sys.stderr.buffer.write(stderr)
+        if result['returncode'] != 0:
+            raise spur.results.RunProcessError(result['returncode'], stdout, stderr)
+
+    def check_output(self, cmd: t.List[str]) -> bytes:
+        logger.log(logging.DEBUG, logging.command(cmd, hostname=self.target.hostname))
+        return t.cast(bytes, self._run(cmd, stderr=sys.stderr).output)
+
+    def _run(self, cmd: t.List[str], **kwargs: t.Any) -> spur.results.ExecutionResult:
+        """
+        Run a command using spur, recording how long it took.
+        Only the agent can measure the other resources used by commands on the target.
+        """
+        started = time.monotonic()
+        error = True
+        try:
+            result = self.client.run(cmd, **kwargs)
+            error = False
+            return result
+        finally:
+            processes.record(
+                cmd, processes.Usage(seconds=time.monotonic() - started),
+                error=error, host=self.target.hostname)
+
+    def stream_output(self, cmd: t.List[str], output: t.BinaryIO) -> int:
+        # spur keeps a copy of all the output of a command,
+        # so large outputs are read straight from an SSH channel instead
+        logger.log(logging.DEBUG, logging.command(cmd, hostname=self.target.hostname))
+        started = time.monotonic()
+        with contextlib.closing(self.client._get_ssh_transport().open_session()) as channel:
+            channel.exec_command(shlex.join(cmd))
+            copied = _base.copy_stream(channel.recv, output)
+            stderr = b''.join(iter(lambda: channel.recv_stderr(_base.STREAM_CHUNK_SIZE), b''))
+            returncode = channel.recv_exit_status()
+        processes.record(
+            cmd, processes.Usage(seconds=time.monotonic() - started),
+            error=returncode != 0, host=self.target.hostname)
+        sys.stderr.buffer.write(stderr)
+        if returncode != 0:
+            raise spur.results.RunProcessError(returncode, b'', stderr)
+        return copied
+
+    def stream_input(self, cmd: t.List[str], input: t.BinaryIO, *, echo: bool) -> int:
+        logger.log(logging.DEBUG, logging.command(cmd, hostname=self.target.hostname))
+        started = time.monotonic()
+        with contextlib.closing(self.client._get_ssh_transport().open_session()) as channel:
+            channel.exec_command(shlex.join(cmd))
+
+            def send() -> None:
+                while data := input.read(_base.STREAM_CHUNK_SIZE):
+                    channel.sendall(data)
+                channel.shutdown_write()
+
+            # Sending in another thread stops a command with a lot of output
+            # from blocking while nobody reads it
+            sender = threading.Thread(target=send, name='ryba-ssh-input', daemon=True)
+            sender.start()
+            while data := channel.recv(_base.STREAM_CHUNK_SIZE):
+                if echo:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.buffer.flush()
+            sender.join()
+            stderr = b''.join(iter(lambda: channel.recv_stderr(_base.STREAM_CHUNK_SIZE), b''))
+            returncode = channel.recv_exit_status()
+        processes.record(
+            cmd, processes.Usage(seconds=time.monotonic() - started),
+            error=returncode != 0, host=self.target.hostname)
+        sys.stderr.buffer.write(stderr)
+        return t.cast(int, returncode)
 
     def exists(self, path: pathlib.Path) -> bool:
+        if self.agent is not None:
+            return t.cast(bool, self.agent.call('exists', paths=[str(self.make_path(path))])[0])
         result = self.client.run(['test', '-e', str(self.make_path(path))], allow_error=True)
         return t.cast(int, result.return_code) == 0
 
     def read_file(self, path: pathlib.Path) -> bytes:
+        if self.agent is not None:
+            (contents,) = self.agent.call('read', paths=[str(self.make_path(path))])
+            if contents is None:
+                raise FileNotFoundError(str(path))
+            return _agent.Agent.decode(contents)
         with self.sftp.open(str(self.make_path(path)), 'rb') as f:
             return t.cast(bytes, f.read())
 
+    def read_files(self, paths: t.List[pathlib.Path]) -> t.Dict[pathlib.Path, t.Optional[bytes]]:
+        if self.agent is None:
+            return super().read_files(paths)
+        contents = self.agent.call('read', paths=[str(self.make_path(path)) for path in paths])
+        return {
+            path: None if content is None else _agent.Agent.decode(content)
+            for path, content in zip(paths, contents)
+        }
+
     def write_file(self, path: pathlib.Path, contents: bytes) -> None:
+        if self.agent is not None:
+            self.agent.call('write', path=str(self.make_path(path)), data=_agent.Agent.encode(contents))
+            return
         with self.sftp.open(str(self.make_path(path)), 'wb') as f:
             f.write(contents)
 
     def list_directory(self, path: pathlib.Path) -> t.List[str]:
+        if self.agent is not None:
+            return t.cast(t.List[str], self.agent.call('listdir', path=str(self.make_path(path))))
         return self.sftp.listdir(str(self.make_path(path)))
+
+    def create_snapshot(self, current: pathlib.Path, snapshot: pathlib.Path) -> None:
+        if self.agent is None or self.target.snapshot_jobs <= 1:
+            return super().create_snapshot(current, snapshot)
+        source, destination = self.make_path(current), self.make_path(snapshot)
+        logger.log(logging.DEBUG, "Cloning %s to %s on %s", source, destination, self.target.hostname)
+        self.agent.call(
+            'clone', source=str(source), destination=str(destination), jobs=self.target.snapshot_jobs)
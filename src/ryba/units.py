@@ -0,0 +1,69 @@
+"""
+Parsing and formatting quantities for people to read and write.
+"""
+import datetime
+import re
+import typing as t
+
+SIZE_SUFFIXES = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
+
+
+def format_size(size: float) -> str:
+    """Format a number of bytes, using units of 1000: `format_size(1234567) == '1.2 MB'`."""
+    for suffix in SIZE_SUFFIXES[:-1]:
+        if abs(size) < 1000:
+            break
+        size /= 1000
+    else:
+        suffix = SIZE_SUFFIXES[-1]
+    if suffix == 'B':
+        return f'{size:.0f} {suffix}'
+    return f'{size:.1f} {suffix}'
+
+
+_SIZE = re.compile(r'(\d+(?:\.\d+)?)\s*(?:([kmgtp])(i)?)?b?', re.IGNORECASE)
+
+
+def parse_size(value: t.Union[str, int]) -> int:
+    """
+    Parse a size such as `'500GB'` or `'1.5TiB'` into a number of bytes.
+    Suffixes like `GB` are in units of 1000, while suffixes like `GiB` are in units of 1024.
+    Plain numbers are taken as bytes.
+    """
+    if isinstance(value, int):
+        return value
+    match = _SIZE.fullmatch(value.strip())
+    if match is None:
+        raise ValueError(f"Invalid size {value!r}")
+    number, prefix, binary = match.groups()
+    multiplier = 1
+    if prefix is not None:
+        base = 1024 if binary else 1000
+        multiplier = base ** ('kmgtp'.index(prefix.lower()) + 1)
+    return int(float(number) * multiplier)
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration to the nearest second: `format_duration(75.2) == '0:01:15'`."""
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+_DURATION_UNITS = {
+    'ms': 0.001, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)\s*(ms|[smhdw])')
+
+
+def parse_duration(value: t.Union[str, int, float]) -> float:
+    """
+    Parse a duration such as `'50ms'`, `'90s'`, `'6h'`, or `'1d12h'` into a number of seconds.
+    Plain numbers are taken as seconds.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip().lower()
+    if _DURATION_PART.sub('', value).strip():
+        raise ValueError(f"Invalid duration {value!r}")
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        raise ValueError(f"Invalid duration {value!r}")
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)